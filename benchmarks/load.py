@@ -0,0 +1,303 @@
+# Starts a local cluster (a leader on SQLite, chunk servers and a user service on localhost ports)
+# and measures upload, read, list, rename and delete through the user service for every
+# combination of file size and concurrency. Results are written as JSON so runs on different
+# commits can be compared with --compare.
+# Run from the repository root: python benchmarks/load.py [--sizes 4K,256K,4M] [--concurrency 1,8,32]
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Readable file contents, /readfile/ returns the data as text
+LETTERS = bytes(range(97, 123)) * 10
+BYTE_TABLE = bytes(LETTERS[i % len(LETTERS)] for i in range(256))
+STARTUP_TIMEOUT = 60  # Seconds
+
+
+def parse_size(value):
+    units = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+    value = value.strip().upper()
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * p / 100))]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Cluster:
+    def __init__(self, directory, chunk_server_count, env):
+        self.directory = directory
+        self.chunk_server_count = chunk_server_count
+        self.env = env
+        self.processes = []
+        self.leader_url = f"http://127.0.0.1:{free_port()}"
+        self.user_url = f"http://127.0.0.1:{free_port()}"
+
+    def start_service(self, name, service, url, env):
+        log = open(os.path.join(self.directory, f"{name}.log"), "w")
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", url.rsplit(":", 1)[1], "--log-level", "warning"],
+            cwd=os.path.join(ROOT, service), env={**os.environ, **self.env, **env}, stdout=log, stderr=subprocess.STDOUT
+        )
+        self.processes.append(process)
+
+    async def start(self, session):
+        database = os.path.join(self.directory, "leader.db")
+        self.start_service("leader", "leader", self.leader_url, {"DATABASE_URL": f"sqlite:///{database}"})
+        await self.wait_for(session, f"{self.leader_url}/chunk_servers/")
+        for i in range(self.chunk_server_count):
+            port = free_port()
+            self.start_service(f"chunk_server_{i}", "chunk_server", f"http://127.0.0.1:{port}", {
+                "CHUNK_DIR": os.path.join(self.directory, f"chunks_{i}"),
+                "PORT": str(port),
+                "LEADER_URL": self.leader_url,
+            })
+        await self.wait_for(session, f"{self.leader_url}/chunk_servers/", lambda servers: len(servers) == self.chunk_server_count)
+        self.start_service("user", "user", self.user_url, {"LEADER_URL": self.leader_url})
+        await self.wait_for(session, f"{self.user_url}/docs")
+
+    async def wait_for(self, session, url, ready=None):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200 and (ready is None or ready(await response.json())):
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"{url} did not become ready, see the logs in {self.directory}")
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+async def run_operations(concurrency, operations):
+    # Runs the operations with at most concurrency in flight, returns latencies, errors and wall time
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def run(operation):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await operation()
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors.append(str(e))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run(operation) for operation in operations))
+    return latencies, errors, time.perf_counter() - started
+
+
+def summarize(endpoint, size, concurrency, latencies, errors, seconds, bytes_per_op):
+    latencies = sorted(latencies)
+    result = {
+        "endpoint": endpoint,
+        "size": size,
+        "concurrency": concurrency,
+        "ops": len(latencies),
+        "errors": len(errors),
+        "seconds": seconds,
+        "ops_per_second": len(latencies) / seconds if seconds else 0.0,
+        "mb_per_second": len(latencies) * bytes_per_op / seconds / 1e6 if seconds else 0.0,
+        **{f"p{p}_ms": percentile(latencies, p) * 1000 if latencies else None for p in (50, 95, 99)},
+    }
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+async def check(response, status=200):
+    if response.status != status:
+        raise RuntimeError(f"{response.method} {response.url.path} returned {response.status}: {(await response.text())[:200]}")
+
+
+async def run_workloads(session, user_url, size, concurrency, file_count, rng, prefix):
+    folder = f"{prefix}/{size}-{concurrency}"
+    names = [f"file_{i:05d}.txt" for i in range(file_count)]
+    results = []
+
+    def record(endpoint, outcome, bytes_per_op=0):
+        result = summarize(endpoint, size, concurrency, *outcome, bytes_per_op)
+        results.append(result)
+        print(
+            f"{endpoint:<12} {size:>10} B x{concurrency:<4} {result['ops_per_second']:9.1f} ops/s "
+            f"{result['mb_per_second']:8.2f} MB/s  p50 {result['p50_ms'] or 0:8.1f} ms  "
+            f"p95 {result['p95_ms'] or 0:8.1f} ms  p99 {result['p99_ms'] or 0:8.1f} ms  errors {result['errors']}"
+        )
+
+    def upload(name):
+        # Every file gets its own content, otherwise deduplication turns later uploads into no-ops
+        data = rng.randbytes(size).translate(BYTE_TABLE)
+
+        async def operation():
+            form = aiohttp.FormData()
+            form.add_field("file", data, filename=name)
+            form.add_field("name", name)
+            form.add_field("path", folder)
+            async with session.post(f"{user_url}/uploadfile/", data=form) as response:
+                await check(response)
+        return operation
+
+    def read(name, stream=False):
+        async def operation():
+            params = {"full_path": f"{folder}/{name}"}
+            if stream:
+                params["stream"] = "true"
+            async with session.get(f"{user_url}/readfile/", params=params) as response:
+                await check(response)
+                await response.read()
+        return operation
+
+    def list_folder():
+        async def operation():
+            async with session.get(f"{user_url}/listfiles/", params={"folder_path": folder}) as response:
+                await check(response)
+                await response.read()
+        return operation
+
+    def rename(name):
+        async def operation():
+            params = {"old_path": f"{folder}/{name}", "new_path": f"{folder}/renamed_{name}"}
+            async with session.put(f"{user_url}/namemappings/", params=params) as response:
+                await check(response)
+        return operation
+
+    def delete(name):
+        async def operation():
+            async with session.delete(f"{user_url}/namemappings/{folder}/renamed_{name}") as response:
+                await check(response)
+        return operation
+
+    # Always in this order, reads after the first one are served partly from the user's chunk cache
+    record("upload", await run_operations(concurrency, [upload(name) for name in names]), size)
+    record("read", await run_operations(concurrency, [read(name) for name in names]), size)
+    record("read_stream", await run_operations(concurrency, [read(name, stream=True) for name in names]), size)
+    record("list", await run_operations(concurrency, [list_folder() for name in names]))
+    record("rename", await run_operations(concurrency, [rename(name) for name in names]))
+    record("delete", await run_operations(concurrency, [delete(name) for name in names]))
+    return results
+
+
+def measure_placement(rng, server_count=100, chunk_count=100000):
+    # Chunk placement runs in the user service for every chunk of every upload and read
+    sys.path.insert(0, os.path.join(ROOT, "user"))
+    from app.utils.chunk_utils import get_chunk_server_positions
+    from app.utils.hash_ring import HashRing
+    servers = []
+    for i in range(server_count):
+        url = f"http://chunk-server-{i}:8100"
+        servers.append({"url": url, "position": str(int(hashlib.md5(url.encode('utf-8')).hexdigest(), 16)), "fail_count": 0})
+    chunk_hashes = [f"{rng.getrandbits(128):032x}" for _ in range(chunk_count)]
+    ring = HashRing(servers)
+    started = time.perf_counter()
+    for chunk_hash in chunk_hashes:
+        get_chunk_server_positions(chunk_hash, ring)
+    elapsed = time.perf_counter() - started
+    print(f"{'placement':<12} {server_count} servers {chunk_count / elapsed:14,.0f} chunks/s")
+    return {"endpoint": "placement", "size": 0, "concurrency": 1, "ops": chunk_count, "errors": 0,
+            "seconds": elapsed, "ops_per_second": chunk_count / elapsed}
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(r["endpoint"], r["size"], r["concurrency"]): r for r in baseline["results"]}
+    print(f"\nCompared with {baseline_path} ({baseline.get('commit')}):")
+    for result in results:
+        old = previous.get((result["endpoint"], result["size"], result["concurrency"]))
+        if not old or not old["ops_per_second"]:
+            continue
+        line = f"{result['endpoint']:<12} {result['size']:>10} B x{result['concurrency']:<4} ops/s {result['ops_per_second'] / old['ops_per_second']:6.2f}x"
+        if result.get("p99_ms") and old.get("p99_ms"):
+            line += f"  p99 {result['p99_ms'] / old['p99_ms']:6.2f}x"
+        print(line)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load test a local cluster")
+    parser.add_argument("--sizes", default="4K,256K,4M", help="Comma separated file sizes, K/M/G suffixes allowed")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma separated numbers of concurrent clients")
+    parser.add_argument("--files", type=int, default=20, help="Files per size and concurrency level")
+    parser.add_argument("--chunk-servers", type=int, default=3)
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE passed to every service, repeatable")
+    parser.add_argument("--output", help="Result file, benchmarks/results/<time>-<commit>.json by default")
+    parser.add_argument("--compare", help="Earlier result file to compare with")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    env = dict(item.split("=", 1) for item in args.env)
+    rng = random.Random(args.seed)
+    commit = git_commit()
+    prefix = f"bench/{int(time.time())}"
+
+    results = [measure_placement(rng)]
+    with tempfile.TemporaryDirectory(prefix="dfs-bench-") as directory:
+        cluster = Cluster(directory, args.chunk_servers, env)
+        timeout = aiohttp.ClientTimeout(total=600)
+        connector = aiohttp.TCPConnector(limit=max(concurrency_levels) * 2)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            try:
+                await cluster.start(session)
+                for size in sizes:
+                    for concurrency in concurrency_levels:
+                        results += await run_workloads(session, cluster.user_url, size, concurrency, args.files, rng, prefix)
+            finally:
+                cluster.stop()
+
+    output = args.output or os.path.join(ROOT, "benchmarks", "results", f"{time.strftime('%Y%m%d-%H%M%S')}-{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "started_at": prefix.split("/")[1],
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "parameters": {**vars(args), "env": env},
+            "results": results,
+        }, f, indent=2)
+    print(f"\nResults written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
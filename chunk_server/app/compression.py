@@ -0,0 +1,176 @@
+import os
+import time
+import zlib
+import hashlib
+import threading
+from collections import Counter
+
+# Stored chunks and encoded frames carry one of these in their flags byte.
+# Values from FLAG_DICTIONARY up are deflate with the dictionary of that number.
+FLAG_RAW = 0
+FLAG_DEFLATE = 1
+FLAG_DICTIONARY = 2
+MAX_DICTIONARY = 255
+
+# Raw deflate streams without header or checksum, chunks are verified by their MD5 anyway.
+# A 8 KB window keeps the per-chunk copy of the primed compressor cheap.
+WINDOW_BITS = 13
+MEMORY_LEVEL = 8
+SEGMENT_LENGTH = 64
+NGRAM_LENGTH = 8
+
+
+def train_dictionary(samples, size):
+    # Picks the 64-byte segments of the samples whose 8-byte substrings occur in the most
+    # samples. zlib encodes nearby matches more cheaply, so the most useful segments go last.
+    frequency = Counter()
+    for sample in samples:
+        frequency.update({sample[i:i + NGRAM_LENGTH] for i in range(len(sample) - NGRAM_LENGTH + 1)})
+    scores = {}
+    for sample in samples:
+        for i in range(0, len(sample) - SEGMENT_LENGTH + 1, SEGMENT_LENGTH):
+            segment = sample[i:i + SEGMENT_LENGTH]
+            if segment not in scores:
+                scores[segment] = sum(
+                    frequency[segment[j:j + NGRAM_LENGTH]] for j in range(0, SEGMENT_LENGTH - NGRAM_LENGTH + 1, 4)
+                )
+    chosen = []
+    total = 0
+    for segment in sorted(scores, key=scores.get, reverse=True):
+        if total + len(segment) > size:
+            break
+        chosen.append(segment)
+        total += len(segment)
+    return b"".join(reversed(chosen))
+
+
+# Compresses chunks one by one with a dictionary trained from the chunks this server stored.
+# Until enough samples are collected chunks are compressed without a dictionary. Dictionaries
+# are kept forever next to the segments, stored chunks refer to them by number.
+class ChunkCodec:
+    def __init__(self, directory, enabled=True, level=6, dictionary_size=8192, sample_bytes=1024 * 1024):
+        self.directory = os.path.join(directory, "dictionaries")
+        self.enabled = enabled
+        self.level = level
+        self.dictionary_size = dictionary_size
+        self.sample_bytes = sample_bytes
+        self.dictionaries = {}
+        self.dictionary_ids = {}
+        self.compressors = {}
+        self.current = None
+        self.samples = []
+        self.sampled = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            "chunks_compressed": 0,
+            "chunks_stored_raw": 0,
+            "logical_bytes_written": 0,
+            "physical_bytes_written": 0,
+            "compress_cpu_seconds": 0.0,
+            "decompress_cpu_seconds": 0.0,
+            "chunks_sent": 0,
+            "chunks_sent_encoded": 0,
+            "bytes_sent": 0,
+            "upload_bytes_received": 0,
+            "upload_bytes_decoded": 0,
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".dict"):
+                with open(os.path.join(self.directory, name), "rb") as f:
+                    self._add_dictionary(int(name.split(".")[0]), f.read())
+
+    def _add_dictionary(self, number, dictionary):
+        self.dictionaries[number] = dictionary
+        self.dictionary_ids[number] = hashlib.md5(dictionary).hexdigest()
+        self.compressors[number] = zlib.compressobj(
+            self.level, zlib.DEFLATED, -WINDOW_BITS, MEMORY_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary
+        )
+        if self.current is None or number > self.current:
+            self.current = number
+
+    def compress(self, data):
+        # Returns (flags, payload), chunks that do not shrink are stored as they are
+        if not self.enabled:
+            return FLAG_RAW, data
+        started = time.thread_time()
+        number = self.current
+        if number is None:
+            flags = FLAG_DEFLATE
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -WINDOW_BITS, MEMORY_LEVEL)
+        else:
+            flags = FLAG_DICTIONARY + number - 1
+            compressor = self.compressors[number].copy()
+        payload = compressor.compress(data) + compressor.flush()
+        if len(payload) >= len(data):
+            flags, payload = FLAG_RAW, data
+        with self.lock:
+            if self.current is None and self.sampled < self.sample_bytes:
+                self.samples.append(data)
+                self.sampled += len(data)
+            self.stats["chunks_compressed" if flags else "chunks_stored_raw"] += 1
+            self.stats["logical_bytes_written"] += len(data)
+            self.stats["physical_bytes_written"] += len(payload)
+            self.stats["compress_cpu_seconds"] += time.thread_time() - started
+        return flags, payload
+
+    def decompress(self, flags, payload):
+        if flags == FLAG_RAW:
+            return payload
+        started = time.thread_time()
+        if flags == FLAG_DEFLATE:
+            decompressor = zlib.decompressobj(-WINDOW_BITS)
+        else:
+            decompressor = zlib.decompressobj(-WINDOW_BITS, zdict=self.dictionaries[flags - FLAG_DICTIONARY + 1])
+        data = decompressor.decompress(payload) + decompressor.flush()
+        with self.lock:
+            self.stats["decompress_cpu_seconds"] += time.thread_time() - started
+        return data
+
+    def dictionary_number(self, flags):
+        return flags - FLAG_DICTIONARY + 1 if flags >= FLAG_DICTIONARY else None
+
+    def train(self):
+        # Trains the first dictionary once enough chunks were sampled, returns its number
+        with self.lock:
+            if self.current is not None or self.sampled < self.sample_bytes:
+                return None
+            samples, self.samples = self.samples, []
+        dictionary = train_dictionary(samples, self.dictionary_size)
+        if not dictionary:
+            return None
+        number = 1
+        path = os.path.join(self.directory, f"{number:03d}.dict")
+        with open(path + ".tmp", "wb") as f:
+            f.write(dictionary)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        with self.lock:
+            self._add_dictionary(number, dictionary)
+        return number
+
+    def record_sent(self, chunk_count, encoded, sent_bytes):
+        with self.lock:
+            self.stats["chunks_sent"] += chunk_count
+            if encoded:
+                self.stats["chunks_sent_encoded"] += chunk_count
+            self.stats["bytes_sent"] += sent_bytes
+
+    def record_upload(self, received_bytes, decoded_bytes):
+        with self.lock:
+            self.stats["upload_bytes_received"] += received_bytes
+            self.stats["upload_bytes_decoded"] += decoded_bytes
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            "enabled": self.enabled,
+            "dictionaries": {number: self.dictionary_ids[number] for number in self.dictionaries},
+            "current_dictionary": self.current,
+            "sampled_bytes": self.sampled,
+            "write_ratio": stats["logical_bytes_written"] / stats["physical_bytes_written"] if stats["physical_bytes_written"] else 1.0,
+            "upload_ratio": stats["upload_bytes_decoded"] / stats["upload_bytes_received"] if stats["upload_bytes_received"] else 1.0,
+        }
@@ -0,0 +1,40 @@
+import struct
+
+# Each frame is a 16 byte MD5 digest, a 4 byte big-endian length and the chunk data
+FRAME_HEADER = struct.Struct(">16sI")
+
+
+def encode_frame(chunk_hash, data):
+    return FRAME_HEADER.pack(bytes.fromhex(chunk_hash), len(data)) + data
+
+
+def decode_frames(payload):
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+        digest, length = FRAME_HEADER.unpack_from(view, offset)
+        offset += FRAME_HEADER.size
+        if offset + length > len(view):
+            raise ValueError("Truncated chunk frame")
+        yield digest.hex(), bytes(view[offset:offset + length])
+        offset += length
+
+
+# Frames of chunks sent as stored, with the compression flags byte after the digest
+ENCODED_FRAME_HEADER = struct.Struct(">16sBI")
+
+
+def encode_encoded_frame(chunk_hash, flags, data):
+    return ENCODED_FRAME_HEADER.pack(bytes.fromhex(chunk_hash), flags, len(data)) + data
+
+
+def decode_encoded_frames(payload):
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+        digest, flags, length = ENCODED_FRAME_HEADER.unpack_from(view, offset)
+        offset += ENCODED_FRAME_HEADER.size
+        if offset + length > len(view):
+            raise ValueError("Truncated chunk frame")
+        yield digest.hex(), flags, bytes(view[offset:offset + length])
+        offset += length
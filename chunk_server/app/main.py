@@ -1,25 +1,70 @@
 import socket
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query
+import struct
+import hashlib
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query, Request, Response
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 import os
-import requests
-import aiofiles
+import time
+import zlib
+import shutil
+import httpx
 from datetime import datetime, timedelta
 import asyncio
+from app.framing import encode_frame, decode_frames, encode_encoded_frame
+from app.storage import SegmentStore, TRANSACTION_ID_SIZE
+from app.compression import ChunkCodec
+from app.http_client import get_client, close_client
+from app import metrics
+from app.metrics import Counter, Gauge
 
 app = FastAPI()
+app.middleware("http")(metrics.trace_requests)
+app.include_router(metrics.router)
 
 # Directory to store chunks
-CHUNK_DIR = "/tmp/chunks"
+CHUNK_DIR = os.getenv("CHUNK_DIR", "/tmp/chunks")
+SEGMENT_SIZE = int(os.getenv("SEGMENT_SIZE", 64 * 1024 * 1024))
+COMPACTION_THRESHOLD = float(os.getenv("COMPACTION_THRESHOLD", 0.5))
+MAINTENANCE_INTERVAL = 60  # Seconds
+# Pending chunks and upload transactions not finalized within this time are dropped
+PENDING_TTL = float(os.getenv("PENDING_TTL", 600))  # Seconds
+# "deflate" compresses stored chunks with a dictionary trained on this server's data, "none" stores them raw
+COMPRESSION = os.getenv("COMPRESSION", "deflate")
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", 6))
+COMPRESSION_DICT_SIZE = int(os.getenv("COMPRESSION_DICT_SIZE", 8192))
+COMPRESSION_SAMPLE_BYTES = int(os.getenv("COMPRESSION_SAMPLE_BYTES", 1024 * 1024))
 
 # Ensure the chunk directory exists
 os.makedirs(CHUNK_DIR, exist_ok=True)
 
+codec = ChunkCodec(
+    CHUNK_DIR,
+    enabled=COMPRESSION == "deflate",
+    level=COMPRESSION_LEVEL,
+    dictionary_size=COMPRESSION_DICT_SIZE,
+    sample_bytes=COMPRESSION_SAMPLE_BYTES,
+)
+store = SegmentStore(CHUNK_DIR, segment_size=SEGMENT_SIZE, compaction_threshold=COMPACTION_THRESHOLD, codec=codec)
+store.import_files(CHUNK_DIR)
+
 # Leader URL and Port
 LEADER_URL = os.getenv("LEADER_URL", "http://host.docker.internal:8000")
 PORT = int(os.getenv("PORT", 8100))
 HEALTH_CHECK_INTERVAL = 60  # Seconds
 RECONNECT_INTERVAL = 10  # Seconds
+# Push liveness and load stats to the leader, 0 leaves liveness to the leader's health checks
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", 0))  # Seconds
+REPLICATION_TIMEOUT = float(os.getenv("REPLICATION_TIMEOUT", 30))  # Seconds
+
+request_count = 0
+
+bytes_received = Counter("chunk_bytes_received_total", "Chunk bytes received for storage, before compression")
+bytes_served = Counter("chunk_bytes_served_total", "Chunk bytes sent to clients as transferred")
+Gauge("chunks_stored", "Committed chunks", function=lambda: len(store))
+Gauge("chunks_pending", "Chunks waiting to be finalized", function=lambda: store.pending_count())
+Gauge("transactions_open", "Upload transactions waiting to be committed", function=lambda: len(store.transactions))
+Gauge("chunk_bytes_stored", "Bytes of live records in the segment files", function=lambda: sum(store.live_bytes.values()))
 
 
 class Chunk(BaseModel):
@@ -31,10 +76,50 @@ class ChunkHashes(BaseModel):
     chunks: list[str]
 
 
+class ChunkReplication(BaseModel):
+    chunks: list[str]
+    sources: list[str]
+
+
 @app.on_event("startup")
 async def startup_event():
     await register_with_leader()
     asyncio.create_task(check_health())
+    asyncio.create_task(maintain_store())
+    if HEARTBEAT_INTERVAL > 0:
+        asyncio.create_task(send_heartbeats())
+
+
+@app.middleware("http")
+async def count_requests(request: Request, call_next):
+    global request_count
+    request_count += 1
+    return await call_next(request)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_client()
+    store.close()
+
+
+async def maintain_store():
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        try:
+            dictionary = await asyncio.to_thread(codec.train)
+            if dictionary is not None:
+                print(f"Trained compression dictionary {dictionary}.")
+            expired, expired_transactions = await asyncio.to_thread(store.expire_pending, PENDING_TTL)
+            if expired or expired_transactions:
+                print(f"Expired {expired} pending chunks and {expired_transactions} upload transactions.")
+            compacted = await asyncio.to_thread(store.compact)
+            if compacted:
+                print(f"Compacted {compacted} segments.")
+            elif store.dirty:
+                await asyncio.to_thread(store.checkpoint)
+        except Exception as e:
+            print(f"Error maintaining chunk store: {e}")
 
 
 async def check_health():
@@ -54,12 +139,44 @@ def get_ip_address():
     return ip_address
 
 
+def get_server_url():
+    return f"http://{get_ip_address()}:{PORT}"
+
+
+async def send_heartbeats():
+    global last_health_check
+    last_count = request_count
+    last_time = time.monotonic()
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        now = time.monotonic()
+        stats = {
+            "url": get_server_url(),
+            "chunk_count": len(store),
+            "pending_count": store.pending_count(),
+            "free_disk": shutil.disk_usage(CHUNK_DIR).free,
+            "request_rate": (request_count - last_count) / (now - last_time),
+            "compression_ratio": codec.get_stats()["write_ratio"],
+        }
+        last_count = request_count
+        last_time = now
+        try:
+            response = await get_client().post(f"{LEADER_URL}/heartbeat/", json=stats, timeout=HEARTBEAT_INTERVAL)
+            if response.status_code == 200:
+                last_health_check = datetime.now()
+            elif response.status_code == 404:
+                print("Leader does not know this server, registering again.")
+                await register_with_leader()
+        except httpx.HTTPError as e:
+            print(f"Error sending heartbeat to the leader: {e}")
+
+
 async def register_with_leader():
     while True:
         try:
-            response = requests.post(
+            response = await get_client().post(
                 f"{LEADER_URL}/register_chunk_server/",
-                params={"url": f"http://{get_ip_address()}:{PORT}"},
+                params={"url": get_server_url()},
             )
             if response.status_code == 200:
                 print("Successfully registered with the leader.")
@@ -80,45 +197,177 @@ def health_check():
     return {"status": "ok"}
 
 
+def parse_transaction(transaction):
+    # Upload transaction IDs are 32 hex digits, None when the client does not group its writes
+    if transaction is None:
+        return None
+    try:
+        transaction_id = bytes.fromhex(transaction)
+    except ValueError:
+        transaction_id = b""
+    if len(transaction_id) != TRANSACTION_ID_SIZE:
+        raise HTTPException(status_code=400, detail="Invalid transaction ID")
+    return transaction_id
+
+
+def pending_response(count, transaction):
+    # The header tells the client its chunks are grouped, older servers finalize by hash
+    headers = {"X-Upload-Transaction": transaction} if transaction is not None else None
+    return JSONResponse({"message": f"Stored {count} chunks in pending mode"}, headers=headers)
+
+
 @app.post("/store_chunks_pending/")
-async def store_chunks_pending(chunks: list[Chunk]):
-    for chunk in chunks:
-        chunk_path = os.path.join(CHUNK_DIR, f"pending_{chunk.chunk_hash}")
-        os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
-        async with aiofiles.open(chunk_path, "w", encoding="utf-8") as f:
-            await f.write(chunk.data)
-    return {"message": f"Stored {len(chunks)} chunks in pending mode"}
+def store_chunks_pending(chunks: list[Chunk], transaction: str = Query(None, description="Upload transaction the chunks belong to")):
+    transaction_id = parse_transaction(transaction)
+    try:
+        chunks = [(chunk.chunk_hash, chunk.data.encode("utf-8")) for chunk in chunks]
+        store.put_pending(chunks, transaction_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid chunk hash")
+    bytes_received.inc(sum(len(data) for chunk_hash, data in chunks))
+    return pending_response(len(chunks), transaction)
+
+
+@app.post("/store_chunks_pending_raw/")
+async def store_chunks_pending_raw(request: Request, transaction: str = Query(None, description="Upload transaction the chunks belong to")):
+    # Same as /store_chunks_pending/ but the body is a stream of binary frames,
+    # optionally compressed as a whole with Content-Encoding: deflate
+    transaction_id = parse_transaction(transaction)
+    payload = await request.body()
+    encoding = request.headers.get("content-encoding", "identity")
+    if encoding not in ("identity", "deflate"):
+        raise HTTPException(status_code=415, detail=f"Unsupported content encoding {encoding}")
+    try:
+        if encoding == "deflate":
+            received = len(payload)
+            with metrics.span("decompress"):
+                payload = await asyncio.to_thread(zlib.decompress, payload)
+            codec.record_upload(received, len(payload))
+        chunks = list(decode_frames(payload))
+        with metrics.span("store"):
+            await asyncio.to_thread(store.put_pending, chunks, transaction_id)
+    except (struct.error, ValueError, zlib.error):
+        raise HTTPException(status_code=400, detail="Malformed chunk frames")
+    bytes_received.inc(sum(len(data) for chunk_hash, data in chunks))
+    return pending_response(len(chunks), transaction)
+
+
+@app.post("/commit_transaction/")
+async def commit_transaction(transaction: str = Query(..., description="Upload transaction to commit")):
+    # Makes every chunk of the upload readable with one log record and one shared fsync
+    count = await asyncio.to_thread(store.commit_transaction, parse_transaction(transaction))
+    if count is None:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    return {"message": f"Committed {count} chunks"}
+
+
+@app.post("/abort_transaction/")
+def abort_transaction(transaction: str = Query(..., description="Upload transaction to abort")):
+    count = store.abort_transaction(parse_transaction(transaction))
+    return {"message": f"Aborted {count} chunks"}
 
 
 @app.post("/finalize_chunks/")
 def finalize_chunks(chunks: ChunkHashes):
-    for chunk_hash in chunks.chunks:
-        pending_chunk_path = os.path.join(CHUNK_DIR, f"pending_{chunk_hash}")
-        final_chunk_path = os.path.join(CHUNK_DIR, chunk_hash)
-        if os.path.exists(pending_chunk_path):
-            os.rename(pending_chunk_path, final_chunk_path)
+    try:
+        store.finalize(chunks.chunks)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid chunk hash")
     return {"message": "Chunks finalized"}
 
 
 @app.post("/delete_chunks/")
 def delete_chunks(chunks: ChunkHashes):
-    for chunk_hash in chunks.chunks:
-        chunk_path = os.path.join(CHUNK_DIR, chunk_hash)
-        if os.path.exists(chunk_path):
-            os.remove(chunk_path)
+    try:
+        store.delete(chunks.chunks)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid chunk hash")
     return {"message": "Chunks deleted"}
 
 
+@app.post("/replicate_chunks/")
+async def replicate_chunks(replication: ChunkReplication):
+    # Pulls the chunks this server does not have yet from the sources, tried in order.
+    # Used by the leader's rebalancer, returns the chunks no source had.
+    try:
+        missing = store.missing(replication.chunks)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid chunk hash")
+    copied = 0
+    for source in replication.sources:
+        if not missing:
+            break
+        try:
+            response = await get_client().post(f"{source}/get_chunks/", json={"chunks": missing}, timeout=REPLICATION_TIMEOUT)
+            response.raise_for_status()
+            chunks = list(decode_frames(response.content))
+        except (httpx.HTTPError, struct.error, ValueError):
+            continue
+        chunks = [(chunk_hash, data) for chunk_hash, data in chunks if hashlib.md5(data).hexdigest() == chunk_hash]
+        copied += await asyncio.to_thread(store.put_committed, chunks)
+        received = {chunk_hash for chunk_hash, data in chunks}
+        missing = [chunk_hash for chunk_hash in missing if chunk_hash not in received]
+    return {"copied": copied, "missing": missing}
+
+
 @app.get("/get_chunk")
 def get_chunk(
     chunk_hash: str = Query(..., description="The hash of the chunk to fetch")
 ):
-    chunk_path = os.path.join(CHUNK_DIR, chunk_hash)
-    if not os.path.exists(chunk_path):
+    try:
+        chunk_data = store.get(chunk_hash)
+    except ValueError:
+        chunk_data = None
+    if chunk_data is None:
         raise HTTPException(status_code=404, detail="Chunk not found")
-    with open(chunk_path, "rb") as f:
-        chunk_data = f.read()
-    return chunk_data
+    bytes_served.inc(len(chunk_data))
+    return Response(content=chunk_data, media_type="application/octet-stream")
+
+
+@app.post("/get_chunks/")
+def get_chunks(chunks: ChunkHashes, request: Request):
+    # Chunks that are not stored here are left out, the caller falls back to replicas.
+    # Clients that accept the deflate chunk encoding get the chunks as stored, with the
+    # dictionaries they need listed in X-Chunk-Dictionaries.
+    encoded = request.headers.get("x-accept-chunk-encoding") == "deflate"
+    frames = []
+    dictionaries = set()
+    with metrics.span("read_store"):
+        for chunk_hash in chunks.chunks:
+            try:
+                stored = store.get_encoded(chunk_hash)
+            except ValueError:
+                continue
+            if stored is None:
+                continue
+            flags, payload = stored
+            if encoded:
+                frames.append(encode_encoded_frame(chunk_hash, flags, payload))
+                if codec.dictionary_number(flags) is not None:
+                    dictionaries.add(codec.dictionary_number(flags))
+            else:
+                frames.append(encode_frame(chunk_hash, codec.decompress(flags, payload)))
+    body = b"".join(frames)
+    headers = {}
+    if encoded:
+        headers["X-Chunk-Encoding"] = "deflate"
+        headers["X-Chunk-Dictionaries"] = ",".join(f"{number}:{codec.dictionary_ids[number]}" for number in sorted(dictionaries))
+    codec.record_sent(len(frames), encoded, len(body))
+    bytes_served.inc(len(body))
+    return Response(content=body, media_type="application/octet-stream", headers=headers)
+
+
+@app.get("/dictionaries/{number}")
+def get_dictionary(number: int):
+    dictionary = codec.dictionaries.get(number)
+    if dictionary is None:
+        raise HTTPException(status_code=404, detail="Dictionary not found")
+    return Response(content=dictionary, media_type="application/octet-stream")
+
+
+@app.get("/stats/compression")
+def get_compression_stats():
+    return {**codec.get_stats(), "chunk_count": len(store)}
 
 
 if __name__ == "__main__":
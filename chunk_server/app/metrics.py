@@ -0,0 +1,177 @@
+import os
+import time
+import uuid
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from fastapi import APIRouter, Request, Response
+
+router = APIRouter()
+
+# Passed on to every service a request calls, so one slow request can be followed across the services
+TRACE_HEADER = "X-Request-ID"
+# Requests slower than this are logged with the time spent in each stage, 0 logs every request
+TRACE_LOG_THRESHOLD = float(os.getenv("TRACE_LOG_THRESHOLD", 1))  # Seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry = []
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+# Metrics in the Prometheus text format, rendered by GET /metrics
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        # Synchronous endpoints update metrics from the threadpool
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield self.name, format_labels(self.labels, key), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, description, labels=(), function=None):
+        # With a function the value is read when the metrics are rendered
+        super().__init__(name, description, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(labels[name] for name in self.labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, "", self.function()
+        yield from super().samples()
+
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", format_labels(self.labels + ("le",), key + (bound,)), cumulative
+            yield f"{self.name}_sum", format_labels(self.labels, key), total
+            yield f"{self.name}_count", format_labels(self.labels, key), cumulative
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines += [f"{name}{labels} {value}" for name, labels, value in metric.samples()]
+    return "\n".join(lines) + "\n"
+
+
+request_latency = Histogram("http_request_duration_seconds", "Time to the response headers per endpoint", ("method", "endpoint", "status"))
+stage_latency = Histogram("stage_duration_seconds", "Time spent in each stage of handling a request", ("stage",))
+
+
+class Trace:
+    def __init__(self, trace_id):
+        self.id = trace_id
+        self.spans = []
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def trace_id():
+    trace = current_trace.get()
+    return trace.id if trace is not None else None
+
+
+def record_span(stage, elapsed):
+    stage_latency.observe(elapsed, stage=stage)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.spans.append((stage, elapsed))
+
+
+@contextmanager
+def span(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - started)
+
+
+def log_trace(trace, request, status, elapsed):
+    # Spans of the same stage are summed, with the number of times it ran when more than once
+    stages = {}
+    for stage, seconds in trace.spans:
+        total, count = stages.get(stage, (0.0, 0))
+        stages[stage] = (total + seconds, count + 1)
+    parts = [f"{stage}={total * 1000:.1f}ms" + (f"/{count}" if count > 1 else "") for stage, (total, count) in stages.items()]
+    print(f"trace={trace.id} {request.method} {request.url.path} {status} {elapsed * 1000:.1f}ms {' '.join(parts)}".rstrip())
+
+
+async def trace_requests(request: Request, call_next):
+    # Continues the caller's trace or starts a new one, and times the request per endpoint.
+    # Streamed responses are timed to their headers.
+    trace = Trace(request.headers.get(TRACE_HEADER) or uuid.uuid4().hex[:16])
+    token = current_trace.set(trace)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers[TRACE_HEADER] = trace.id
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        route = request.scope.get("route")
+        # Unmatched paths share one label so they cannot grow the metrics without bound
+        endpoint = route.path if route is not None else "unmatched"
+        request_latency.observe(elapsed, method=request.method, endpoint=endpoint, status=status)
+        if elapsed >= TRACE_LOG_THRESHOLD and endpoint != "/metrics":
+            log_trace(trace, request, status, elapsed)
+        current_trace.reset(token)
+
+
+@router.get("/metrics")
+def get_metrics():
+    return Response(content=render(), media_type="text/plain; version=0.0.4")
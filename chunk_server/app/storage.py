@@ -0,0 +1,550 @@
+import os
+import mmap
+import struct
+import threading
+import time
+from collections import defaultdict
+
+# Record kinds written to the segment log
+PENDING = 1
+COMMITTED = 2
+COMMIT = 3
+DELETE = 4
+# A pending chunk of an upload transaction, the data starts with the transaction ID
+TRANSACTION_PENDING = 5
+# Commit or abort every chunk of the transaction named in the digest field
+TRANSACTION_COMMIT = 6
+TRANSACTION_ABORT = 7
+TRANSACTION_ID_SIZE = 16
+
+# kind, flags, digest, data length
+RECORD_HEADER = struct.Struct(">BB16sI")
+# magic, segment, offset and entry count the checkpoint covers
+CHECKPOINT_HEADER = struct.Struct(">8sIQQ")
+# digest, pending, flags, segment, offset, length
+CHECKPOINT_ENTRY = struct.Struct(">16sBBIQI")
+CHECKPOINT_MAGIC = b"DFSIDX01"
+# Version 2 is followed by the number of transaction entries and the entries
+CHECKPOINT_MAGIC_TRANSACTIONS = b"DFSIDX02"
+TRANSACTION_COUNT = struct.Struct(">Q")
+# transaction, digest, flags, segment, offset, length
+TRANSACTION_ENTRY = struct.Struct(">16s16sBIQI")
+
+
+# Chunks written by one upload, invisible to readers until the upload commits
+class Transaction:
+    def __init__(self):
+        self.chunks = {}
+        self.updated_at = time.time()
+
+
+# Chunks are appended to large segment files and located through an in-memory
+# index of digest -> (segment, offset, length, flags). The index is checkpointed
+# to disk so a restart only replays the log written after the last checkpoint.
+# With a codec, chunks are stored compressed and flags tells how to decode them.
+class SegmentStore:
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, compaction_threshold=0.5, codec=None):
+        self.directory = directory
+        self.codec = codec
+        self.segment_dir = os.path.join(directory, "segments")
+        self.checkpoint_path = os.path.join(directory, "index.checkpoint")
+        self.segment_size = segment_size
+        self.compaction_threshold = compaction_threshold
+        self.index = {}
+        self.pending = {}
+        self.transactions = {}
+        self.live_bytes = defaultdict(int)
+        self.maps = {}
+        self.lock = threading.RLock()
+        self.compaction_lock = threading.Lock()
+        self.dirty = False
+        # Position up to which the log is known to be on disk, advanced by sync()
+        self.sync_lock = threading.Lock()
+        self.synced = (0, 0)
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self._load()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.segment_dir, f"{segment:010d}.seg")
+
+    def _segments(self):
+        return sorted(int(name.split(".")[0]) for name in os.listdir(self.segment_dir) if name.endswith(".seg"))
+
+    def _load(self):
+        start_segment, start_offset = self._load_checkpoint()
+        segments = self._segments()
+        for segment in segments:
+            if segment >= start_segment:
+                self._replay(segment, start_offset if segment == start_segment else 0)
+        for digest, (segment, offset, length, flags) in self.index.items():
+            self.live_bytes[segment] += RECORD_HEADER.size + length
+        for digest, entry in self.pending.items():
+            self.live_bytes[entry[0]] += RECORD_HEADER.size + entry[2]
+        for transaction in self.transactions.values():
+            for segment, offset, length, flags in transaction.chunks.values():
+                self.live_bytes[segment] += RECORD_HEADER.size + TRANSACTION_ID_SIZE + length
+        self.active_segment = max(segments) if segments else max(start_segment, 1)
+        self.active = open(self._segment_path(self.active_segment), "ab")
+        self.active_size = self.active.tell()
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return 0, 0
+        now = time.time()
+        with open(self.checkpoint_path, "rb") as f:
+            data = f.read()
+        magic, segment, offset, count = CHECKPOINT_HEADER.unpack_from(data, 0)
+        if magic not in (CHECKPOINT_MAGIC, CHECKPOINT_MAGIC_TRANSACTIONS):
+            raise ValueError(f"Invalid index checkpoint {self.checkpoint_path}")
+        end = CHECKPOINT_HEADER.size + count * CHECKPOINT_ENTRY.size
+        for entry in CHECKPOINT_ENTRY.iter_unpack(memoryview(data)[CHECKPOINT_HEADER.size:end]):
+            digest, pending, flags, entry_segment, entry_offset, length = entry
+            if pending:
+                self.pending[digest] = (entry_segment, entry_offset, length, flags, now)
+            else:
+                self.index[digest] = (entry_segment, entry_offset, length, flags)
+        if magic == CHECKPOINT_MAGIC_TRANSACTIONS:
+            start = end + TRANSACTION_COUNT.size
+            count, = TRANSACTION_COUNT.unpack_from(data, end)
+            for entry in TRANSACTION_ENTRY.iter_unpack(memoryview(data)[start:start + count * TRANSACTION_ENTRY.size]):
+                transaction_id, digest, flags, entry_segment, entry_offset, length = entry
+                self.transaction(transaction_id).chunks[digest] = (entry_segment, entry_offset, length, flags)
+        return segment, offset
+
+    def _replay(self, segment, offset):
+        now = time.time()
+        path = self._segment_path(segment)
+        with open(path, "rb") as f:
+            data = f.read()
+        while offset + RECORD_HEADER.size <= len(data):
+            kind, flags, digest, length = RECORD_HEADER.unpack_from(data, offset)
+            data_offset = offset + RECORD_HEADER.size
+            if data_offset + length > len(data):
+                break
+            if kind == PENDING:
+                self.pending[digest] = (segment, data_offset, length, flags, now)
+            elif kind == COMMITTED:
+                self.index[digest] = (segment, data_offset, length, flags)
+            elif kind == COMMIT:
+                if digest in self.pending:
+                    self.index[digest] = self.pending.pop(digest)[:4]
+            elif kind == DELETE:
+                self.index.pop(digest, None)
+            elif kind == TRANSACTION_PENDING:
+                transaction_id = bytes(data[data_offset:data_offset + TRANSACTION_ID_SIZE])
+                entry = (segment, data_offset + TRANSACTION_ID_SIZE, length - TRANSACTION_ID_SIZE, flags)
+                self.transaction(transaction_id).chunks[digest] = entry
+            elif kind == TRANSACTION_COMMIT:
+                if digest in self.transactions:
+                    self._commit(digest)
+            elif kind == TRANSACTION_ABORT:
+                self.transactions.pop(digest, None)
+            offset = data_offset + length
+        if offset < len(data):
+            # Drop a record torn by a crash in the middle of a write
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+
+    def _append(self, kind, digest, data=b"", flags=0):
+        if self.active_size >= self.segment_size:
+            self._roll()
+        self.active.write(RECORD_HEADER.pack(kind, flags, digest, len(data)))
+        self.active.write(data)
+        data_offset = self.active_size + RECORD_HEADER.size
+        self.active_size = data_offset + len(data)
+        self.dirty = True
+        return self.active_segment, data_offset
+
+    def _roll(self, skip=0):
+        # skip leaves segment numbers free for the output of a compaction
+        self.active.flush()
+        os.fsync(self.active.fileno())
+        self.active.close()
+        self.active_segment += 1 + skip
+        self.active = open(self._segment_path(self.active_segment), "ab")
+        self.active_size = 0
+
+    def _view(self, segment, end):
+        view = self.maps.get(segment)
+        if view is None or len(view) < end:
+            if view is not None:
+                view.close()
+            with open(self._segment_path(segment), "rb") as f:
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = view
+        return view
+
+    def _read(self, entry):
+        segment, offset, length = entry[:3]
+        return self._view(segment, offset + length)[offset:offset + length]
+
+    def transaction(self, transaction_id):
+        transaction = self.transactions.get(transaction_id)
+        if transaction is None:
+            transaction = self.transactions[transaction_id] = Transaction()
+        return transaction
+
+    def put_pending(self, chunks, transaction_id=None):
+        # Chunks are compressed before taking the lock, so concurrent uploads compress in parallel
+        if transaction_id is not None:
+            return self._put_transaction(chunks, transaction_id)
+        encoded = []
+        data_by_digest = {}
+        for chunk_hash, data in chunks:
+            digest = bytes.fromhex(chunk_hash)
+            if digest in self.index or digest in self.pending:
+                encoded.append((digest, 0, None))
+                data_by_digest[digest] = data
+            else:
+                encoded.append((digest, *self._encode(data)))
+        with self.lock:
+            now = time.time()
+            for digest, flags, payload in encoded:
+                if digest in self.index:
+                    continue
+                if digest in self.pending:
+                    # Another upload is writing the same chunk, keep it alive for this one too
+                    self.pending[digest] = self.pending[digest][:4] + (now,)
+                    continue
+                if payload is None:
+                    # Deleted or expired since the check above
+                    flags, payload = self._encode(data_by_digest[digest])
+                segment, offset = self._append(PENDING, digest, payload, flags)
+                self.pending[digest] = (segment, offset, len(payload), flags, now)
+                self.live_bytes[segment] += RECORD_HEADER.size + len(payload)
+            self.active.flush()
+
+    def _put_transaction(self, chunks, transaction_id):
+        # Every transaction writes its own copy of the chunks it is sent, so uploads sharing a
+        # chunk never depend on each other. That includes chunks committed here: the leader
+        # reports a chunk missing while its deletion is in progress, and the delete may reach this
+        # server after the check. Copies of chunks still committed when the upload commits become
+        # dead records.
+        encoded = [(bytes.fromhex(chunk_hash), *self._encode(data)) for chunk_hash, data in chunks]
+        with self.lock:
+            transaction = self.transaction(transaction_id)
+            transaction.updated_at = time.time()
+            for digest, flags, payload in encoded:
+                if digest in transaction.chunks:
+                    continue
+                segment, offset = self._append(TRANSACTION_PENDING, digest, transaction_id + payload, flags)
+                transaction.chunks[digest] = (segment, offset + TRANSACTION_ID_SIZE, len(payload), flags)
+                self.live_bytes[segment] += RECORD_HEADER.size + TRANSACTION_ID_SIZE + len(payload)
+            self.active.flush()
+
+    def _commit(self, transaction_id):
+        # Returns the copies of chunks that were committed by another upload in the meantime
+        duplicates = []
+        for digest, entry in self.transactions.pop(transaction_id).chunks.items():
+            if digest in self.index:
+                duplicates.append(entry)
+            else:
+                self.index[digest] = entry
+        return duplicates
+
+    def commit_transaction(self, transaction_id):
+        # One commit record makes all chunks of the upload readable, it is on disk when this returns.
+        # Returns the number of chunks committed, None for an unknown or expired transaction.
+        with self.lock:
+            transaction = self.transactions.get(transaction_id)
+            if transaction is None:
+                return None
+            count = len(transaction.chunks)
+            self._append(TRANSACTION_COMMIT, transaction_id)
+            for segment, offset, length, flags in self._commit(transaction_id):
+                self.live_bytes[segment] -= RECORD_HEADER.size + TRANSACTION_ID_SIZE + length
+        self.sync()
+        return count
+
+    def abort_transaction(self, transaction_id):
+        with self.lock:
+            transaction = self.transactions.pop(transaction_id, None)
+            if transaction is None:
+                return 0
+            self._append(TRANSACTION_ABORT, transaction_id)
+            for segment, offset, length, flags in transaction.chunks.values():
+                self.live_bytes[segment] -= RECORD_HEADER.size + TRANSACTION_ID_SIZE + length
+            self.active.flush()
+            return len(transaction.chunks)
+
+    def sync(self):
+        # Group commit: a single fsync covers every record written before it started, so
+        # callers whose records an earlier or concurrent fsync covered return right away
+        with self.lock:
+            target = (self.active_segment, self.active_size)
+        with self.sync_lock:
+            if self.synced >= target:
+                return
+            with self.lock:
+                self.active.flush()
+                position = (self.active_segment, self.active_size)
+                # Writers continue during the fsync, a duplicate descriptor survives a segment roll
+                fd = os.dup(self.active.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.synced = position
+
+    def pending_count(self):
+        return len(self.pending) + sum(len(transaction.chunks) for transaction in list(self.transactions.values()))
+
+    def put_committed(self, chunks):
+        # Stores chunks copied from another server, they are readable right away.
+        # Returns the number of chunks that were not stored here yet.
+        encoded = [(bytes.fromhex(chunk_hash), *self._encode(data)) for chunk_hash, data in chunks]
+        stored = 0
+        with self.lock:
+            for digest, flags, payload in encoded:
+                if digest in self.index:
+                    continue
+                if digest in self.pending:
+                    # Same data as the pending copy, commit that one instead of writing another
+                    self._append(COMMIT, digest)
+                    self.index[digest] = self.pending.pop(digest)[:4]
+                else:
+                    segment, offset = self._append(COMMITTED, digest, payload, flags)
+                    self.index[digest] = (segment, offset, len(payload), flags)
+                    self.live_bytes[segment] += RECORD_HEADER.size + len(payload)
+                stored += 1
+            self.active.flush()
+        return stored
+
+    def missing(self, chunk_hashes):
+        with self.lock:
+            return [chunk_hash for chunk_hash in chunk_hashes if bytes.fromhex(chunk_hash) not in self.index]
+
+    def _encode(self, data):
+        if self.codec is None:
+            return 0, data
+        return self.codec.compress(data)
+
+    def finalize(self, chunk_hashes):
+        with self.lock:
+            for chunk_hash in chunk_hashes:
+                digest = bytes.fromhex(chunk_hash)
+                entry = self.pending.pop(digest, None)
+                if entry is None:
+                    continue
+                self._append(COMMIT, digest)
+                self.index[digest] = entry[:4]
+        self.sync()
+
+    def delete(self, chunk_hashes):
+        with self.lock:
+            for chunk_hash in chunk_hashes:
+                digest = bytes.fromhex(chunk_hash)
+                entry = self.index.pop(digest, None)
+                if entry is None:
+                    continue
+                self._append(DELETE, digest)
+                self.live_bytes[entry[0]] -= RECORD_HEADER.size + entry[2]
+            self.active.flush()
+
+    def get(self, chunk_hash):
+        encoded = self.get_encoded(chunk_hash)
+        if encoded is None:
+            return None
+        flags, payload = encoded
+        if flags == 0:
+            return payload
+        return self.codec.decompress(flags, payload)
+
+    def get_encoded(self, chunk_hash):
+        # Returns the chunk as stored, (flags, payload)
+        with self.lock:
+            entry = self.index.get(bytes.fromhex(chunk_hash))
+            if entry is None:
+                return None
+            return entry[3], self._read(entry)
+
+    def __len__(self):
+        return len(self.index)
+
+    def expire_pending(self, max_age):
+        # Drops pending chunks and aborts transactions of uploads that did not finish in time
+        with self.lock:
+            cutoff = time.time() - max_age
+            expired = [digest for digest, entry in self.pending.items() if entry[4] < cutoff]
+            for digest in expired:
+                segment, offset, length = self.pending.pop(digest)[:3]
+                self.live_bytes[segment] -= RECORD_HEADER.size + length
+            expired_transactions = [
+                transaction_id for transaction_id, transaction in self.transactions.items() if transaction.updated_at < cutoff
+            ]
+            for transaction_id in expired_transactions:
+                self.abort_transaction(transaction_id)
+            return len(expired), len(expired_transactions)
+
+    def compact(self):
+        # Live records are copied without the lock into segments numbered right before the one
+        # writers continue in, so a replay applies the copies before any later change. The lock
+        # is only taken to pick the records and to point the index at the copies.
+        with self.compaction_lock:
+            with self.lock:
+                candidates = []
+                for segment in self._segments():
+                    if segment == self.active_segment:
+                        continue
+                    size = os.path.getsize(self._segment_path(segment))
+                    if size == 0 or self.live_bytes[segment] / size < self.compaction_threshold:
+                        candidates.append(segment)
+                if not candidates:
+                    return 0
+                records = self._live_records(set(candidates))
+                if records:
+                    size = sum(
+                        RECORD_HEADER.size + (TRANSACTION_ID_SIZE if kind == TRANSACTION_PENDING else 0) + entry[2]
+                        for kind, digest, transaction_id, entry in records
+                    )
+                    first = self.active_segment + 1
+                    self._roll(skip=-(-size // self.segment_size))
+            if records:
+                moved = self._copy_records(records, first)
+                with self.lock:
+                    self._redirect(moved)
+            # The copies must be covered by a checkpoint before the old segments disappear
+            self.checkpoint()
+            with self.lock:
+                for segment in candidates:
+                    view = self.maps.pop(segment, None)
+                    if view is not None:
+                        view.close()
+                    self.live_bytes.pop(segment, None)
+                    os.remove(self._segment_path(segment))
+        return len(candidates)
+
+    def _live_records(self, segments):
+        # (kind, digest, transaction, entry) of every record in the segments that is still in use
+        records = [(COMMITTED, digest, None, entry) for digest, entry in self.index.items() if entry[0] in segments]
+        records += [(PENDING, digest, None, entry[:4]) for digest, entry in self.pending.items() if entry[0] in segments]
+        for transaction_id, transaction in self.transactions.items():
+            records += [
+                (TRANSACTION_PENDING, digest, transaction_id, entry)
+                for digest, entry in transaction.chunks.items() if entry[0] in segments
+            ]
+        # Read the old segments in file order
+        records.sort(key=lambda record: record[3][:2])
+        return records
+
+    def _copy_records(self, records, segment):
+        # Old segments are never written again, they are read through views of their own.
+        # Returns (kind, digest, transaction, old entry, new entry, record size) per copy.
+        moved = []
+        views = {}
+        out = None
+        out_size = 0
+        try:
+            for kind, digest, transaction_id, entry in records:
+                if out is None or out_size >= self.segment_size:
+                    if out is not None:
+                        out.flush()
+                        os.fsync(out.fileno())
+                        out.close()
+                        segment += 1
+                    out = open(self._segment_path(segment), "ab")
+                    out_size = 0
+                view = views.get(entry[0])
+                if view is None:
+                    with open(self._segment_path(entry[0]), "rb") as f:
+                        view = views[entry[0]] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                prefix = transaction_id if kind == TRANSACTION_PENDING else b""
+                out.write(RECORD_HEADER.pack(kind, entry[3], digest, len(prefix) + entry[2]))
+                out.write(prefix)
+                out.write(view[entry[1]:entry[1] + entry[2]])
+                offset = out_size + RECORD_HEADER.size + len(prefix)
+                out_size = offset + entry[2]
+                moved.append((kind, digest, transaction_id, entry, (segment, offset, entry[2], entry[3]), RECORD_HEADER.size + len(prefix) + entry[2]))
+            out.flush()
+            os.fsync(out.fileno())
+        finally:
+            if out is not None:
+                out.close()
+            for view in views.values():
+                view.close()
+        return moved
+
+    def _redirect(self, moved):
+        # A record may have been committed, finalized, deleted or aborted while it was copied.
+        # Whatever now points at the old copy points at the new one, copies of records no longer
+        # in use stay dead.
+        for kind, digest, transaction_id, old, new, size in moved:
+            pending = self.pending.get(digest)
+            transaction = self.transactions.get(transaction_id)
+            if self.index.get(digest) == old:
+                self.index[digest] = new
+            elif pending is not None and pending[:4] == old:
+                self.pending[digest] = new + pending[4:]
+            elif transaction is not None and transaction.chunks.get(digest) == old:
+                transaction.chunks[digest] = new
+            else:
+                continue
+            self.live_bytes[new[0]] += size
+
+    def checkpoint(self):
+        with self.lock:
+            self.active.flush()
+            os.fsync(self.active.fileno())
+            position = (self.active_segment, self.active_size)
+            index = list(self.index.items())
+            pending = list(self.pending.items())
+            transactions = [
+                (transaction_id, digest, entry)
+                for transaction_id, transaction in self.transactions.items()
+                for digest, entry in transaction.chunks.items()
+            ]
+            self.dirty = False
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC_TRANSACTIONS, position[0], position[1], len(index) + len(pending)))
+            for digest, (segment, offset, length, flags) in index:
+                f.write(CHECKPOINT_ENTRY.pack(digest, 0, flags, segment, offset, length))
+            for digest, (segment, offset, length, flags, timestamp) in pending:
+                f.write(CHECKPOINT_ENTRY.pack(digest, 1, flags, segment, offset, length))
+            f.write(TRANSACTION_COUNT.pack(len(transactions)))
+            for transaction_id, digest, (segment, offset, length, flags) in transactions:
+                f.write(TRANSACTION_ENTRY.pack(transaction_id, digest, flags, segment, offset, length))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def import_files(self, directory):
+        # Move chunks kept as one file per chunk by older versions into the segments
+        imported = 0
+        with self.lock:
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    digest = bytes.fromhex(name)
+                except ValueError:
+                    continue
+                if len(digest) != 16 or not os.path.isfile(path):
+                    continue
+                with open(path, "rb") as f:
+                    data = f.read()
+                if digest not in self.index:
+                    segment, offset = self._append(COMMITTED, digest, data)
+                    self.index[digest] = (segment, offset, len(data), 0)
+                    self.live_bytes[segment] += RECORD_HEADER.size + len(data)
+                imported += 1
+            self.active.flush()
+        if imported:
+            self.checkpoint()
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if len(name) == 32 and not name.startswith("pending_") and os.path.isfile(path):
+                    os.remove(path)
+        # Pending files of older versions can no longer be finalized
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.startswith("pending_") and os.path.isfile(path):
+                os.remove(path)
+        return imported
+
+    def close(self):
+        self.checkpoint()
+        with self.lock:
+            for view in self.maps.values():
+                view.close()
+            self.maps.clear()
+            self.active.close()
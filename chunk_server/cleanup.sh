@@ -1,2 +0,0 @@
-#!/bin/sh
-find /tmp/chunks -name 'pending_*' -mmin +10 -type f -delete
@@ -0,0 +1,150 @@
+import hashlib
+import os
+
+from app.storage import SegmentStore, RECORD_HEADER
+
+
+def make_chunks(count, size=1000, seed=0):
+    chunks = []
+    for i in range(count):
+        data = hashlib.sha256(f"{seed}-{i}".encode()).digest() * (size // 32)
+        chunks.append((hashlib.md5(data).hexdigest(), data))
+    return chunks
+
+
+def crash(store):
+    # Drops the store without the checkpoint close() writes, the log is only flushed
+    store.active.flush()
+    for view in store.maps.values():
+        view.close()
+    store.active.close()
+
+
+def test_replay_after_checkpoint(tmp_path):
+    store = SegmentStore(str(tmp_path), segment_size=4096)
+    before = make_chunks(10, seed=1)
+    store.put_committed(before)
+    store.checkpoint()
+    after = make_chunks(10, seed=2)
+    store.put_committed(after)
+    store.delete([chunk_hash for chunk_hash, data in before[:3]])
+    transaction_id = os.urandom(16)
+    committed = make_chunks(3, seed=3)
+    store.put_pending(committed, transaction_id)
+    store.commit_transaction(transaction_id)
+    crash(store)
+
+    # A record torn by the crash is dropped
+    with open(store._segment_path(store.active_segment), "ab") as f:
+        f.write(RECORD_HEADER.pack(2, 0, b"\0" * 16, 1000) + b"torn")
+
+    store = SegmentStore(str(tmp_path), segment_size=4096)
+    for chunk_hash, data in before[:3]:
+        assert store.get(chunk_hash) is None
+    for chunk_hash, data in before[3:] + after + committed:
+        assert store.get(chunk_hash) == data
+    assert len(store) == 20
+    store.put_committed(make_chunks(1, seed=4))
+    store.close()
+    assert len(SegmentStore(str(tmp_path), segment_size=4096)) == 21
+
+
+def test_delete_then_compact(tmp_path):
+    store = SegmentStore(str(tmp_path), segment_size=4096)
+    chunks = make_chunks(40)
+    store.put_committed(chunks)
+    segments = store._segments()
+    deleted = [chunk_hash for i, (chunk_hash, data) in enumerate(chunks) if i % 4]
+    store.delete(deleted)
+
+    assert store.compact() > 0
+    assert not set(segments[:-1]) & set(store._segments())
+    for chunk_hash, data in chunks[::4]:
+        assert store.get(chunk_hash) == data
+
+    # Neither a crash nor a clean restart brings the deleted chunks back
+    crash(store)
+    store = SegmentStore(str(tmp_path), segment_size=4096)
+    assert len(store) == 10
+    for chunk_hash in deleted:
+        assert store.get(chunk_hash) is None
+    for chunk_hash, data in chunks[::4]:
+        assert store.get(chunk_hash) == data
+
+
+def test_compact_keeps_changes_made_while_copying(tmp_path):
+    store = SegmentStore(str(tmp_path), segment_size=4096)
+    transaction_id = os.urandom(16)
+    uploaded = make_chunks(1, seed=6)
+    store.put_pending(uploaded, transaction_id)
+    chunks = make_chunks(40)
+    store.put_committed(chunks)
+    store.delete([chunk_hash for i, (chunk_hash, data) in enumerate(chunks) if i % 4])
+    copy_records = store._copy_records
+
+    def copy_while_changing(records, segment):
+        moved = copy_records(records, segment)
+        store.delete([chunks[0][0]])
+        store.put_committed(make_chunks(1, seed=5))
+        store.commit_transaction(transaction_id)
+        return moved
+
+    store._copy_records = copy_while_changing
+    assert store.compact() > 0
+    assert store.get(chunks[0][0]) is None
+    for chunk_hash, data in chunks[4::4] + make_chunks(1, seed=5) + uploaded:
+        assert store.get(chunk_hash) == data
+    crash(store)
+
+    store = SegmentStore(str(tmp_path), segment_size=4096)
+    assert store.get(chunks[0][0]) is None
+    for chunk_hash, data in chunks[4::4] + make_chunks(1, seed=5) + uploaded:
+        assert store.get(chunk_hash) == data
+    assert len(store) == 11
+
+
+def test_uncommitted_transaction_rolls_back(tmp_path):
+    store = SegmentStore(str(tmp_path), segment_size=4096)
+    existing = make_chunks(2, seed=1)
+    store.put_committed(existing)
+    aborted, unfinished, expired = os.urandom(16), os.urandom(16), os.urandom(16)
+    store.put_pending(make_chunks(3, seed=2), aborted)
+    store.abort_transaction(aborted)
+    store.put_pending(make_chunks(3, seed=3), unfinished)
+    store.put_pending(make_chunks(3, seed=4), expired)
+    for chunk_hash, data in make_chunks(3, seed=3):
+        assert store.get(chunk_hash) is None
+    crash(store)
+
+    store = SegmentStore(str(tmp_path), segment_size=4096)
+    assert len(store) == 2
+    for seed in (2, 3, 4):
+        for chunk_hash, data in make_chunks(3, seed=seed):
+            assert store.get(chunk_hash) is None
+    assert store.commit_transaction(aborted) is None
+    assert store.expire_pending(-1) == (0, 2)
+    assert store.commit_transaction(unfinished) is None
+    store.close()
+
+    store = SegmentStore(str(tmp_path), segment_size=4096)
+    assert len(store) == 2
+    assert store.pending_count() == 0
+
+
+def test_transaction_keeps_chunk_deleted_before_commit(tmp_path):
+    # An upload told a chunk is missing while its deletion is in progress sends it although this
+    # server still holds it, and the delete request arrives before the upload commits
+    store = SegmentStore(str(tmp_path), segment_size=4096)
+    chunks = make_chunks(2)
+    store.put_committed(chunks)
+    transaction_id = os.urandom(16)
+    store.put_pending(chunks[:1], transaction_id)
+    store.delete([chunk_hash for chunk_hash, data in chunks])
+    assert store.commit_transaction(transaction_id) == 1
+    assert store.get(chunks[0][0]) == chunks[0][1]
+    assert store.get(chunks[1][0]) is None
+    crash(store)
+
+    store = SegmentStore(str(tmp_path), segment_size=4096)
+    assert store.get(chunks[0][0]) == chunks[0][1]
+    assert len(store) == 1
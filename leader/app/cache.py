@@ -0,0 +1,150 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from app import crud, schemas
+from app.models import get_chunk_offsets, get_chunk_hash_positions
+
+METADATA_CACHE_ENTRIES = int(os.getenv("METADATA_CACHE_ENTRIES", 10000))
+METADATA_CACHE_BYTES = int(os.getenv("METADATA_CACHE_BYTES", 256 * 1024 * 1024))
+
+
+class CachedNameMapping:
+    def __init__(self, id, body, size, chunk_lengths=None):
+        self.id = id
+        # Packed chunk digests, served as is by the binary metadata endpoint
+        self.body = body
+        self.size = size
+        # Start offset of every chunk for variable-size chunks, used to resolve byte ranges
+        self.offsets = get_chunk_offsets(chunk_lengths) if chunk_lengths is not None else None
+        self.nbytes = len(body) + (self.offsets.itemsize * len(self.offsets) if self.offsets is not None else 0)
+        # Serialized JSON response, built on the first JSON read so binary readers don't pay for it
+        self.json = None
+
+
+# Keeps the chunk lists of hot files so repeated reads skip the database.
+# Bounded by entry count and by total bytes.
+class MetadataCache:
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "db_queries": 0,
+            "evictions": 0,
+            "invalidations": 0,
+            "hit_seconds": 0.0,
+            "miss_seconds": 0.0,
+        }
+
+    def get(self, full_path):
+        with self.lock:
+            entry = self.entries.get(full_path)
+            if entry is not None:
+                self.entries.move_to_end(full_path)
+            return entry
+
+    def put(self, full_path, entry, generation):
+        with self.lock:
+            # Skip entries read before a concurrent invalidation, they may already be stale
+            if generation != self.generation or entry.nbytes > self.max_bytes:
+                return
+            previous = self.entries.pop(full_path, None)
+            if previous is not None:
+                self.size -= previous.nbytes
+            self.entries[full_path] = entry
+            self.size += entry.nbytes
+            self._evict()
+
+    def set_json(self, full_path, entry, body):
+        with self.lock:
+            if entry.json is not None:
+                return
+            entry.json = body
+            entry.nbytes += len(body)
+            if self.entries.get(full_path) is entry:
+                self.size += len(body)
+                self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            evicted_path, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+            self.stats["evictions"] += 1
+
+    def invalidate(self, *full_paths):
+        with self.lock:
+            self.generation += 1
+            for full_path in full_paths:
+                entry = self.entries.pop(full_path, None)
+                if entry is not None:
+                    self.size -= entry.nbytes
+                    self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.stats["invalidations"] += len(self.entries)
+            self.entries.clear()
+            self.size = 0
+
+    def record(self, hit, seconds):
+        with self.lock:
+            if hit:
+                self.stats["hits"] += 1
+                self.stats["hit_seconds"] += seconds
+            else:
+                self.stats["misses"] += 1
+                self.stats["db_queries"] += 1
+                self.stats["miss_seconds"] += seconds
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            entries = len(self.entries)
+            size = self.size
+        lookups = stats["hits"] + stats["misses"]
+        return {
+            **stats,
+            "hit_ratio": stats["hits"] / lookups if lookups else 0.0,
+            "avg_hit_ms": stats["hit_seconds"] * 1000 / stats["hits"] if stats["hits"] else 0.0,
+            "avg_miss_ms": stats["miss_seconds"] * 1000 / stats["misses"] if stats["misses"] else 0.0,
+            "entries": entries,
+            "bytes": size,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+        }
+
+
+metadata_cache = MetadataCache(METADATA_CACHE_ENTRIES, METADATA_CACHE_BYTES)
+
+
+async def get_cached_name_mapping(db, full_path):
+    started = time.perf_counter()
+    entry = metadata_cache.get(full_path)
+    if entry is not None:
+        metadata_cache.record(True, time.perf_counter() - started)
+        return entry
+    generation = metadata_cache.generation
+    db_name_mapping = await crud.get_name_mapping(db=db, name=full_path)
+    if db_name_mapping is not None:
+        entry = CachedNameMapping(
+            db_name_mapping.id, db_name_mapping.chunk_digests, db_name_mapping.size, db_name_mapping.chunk_lengths
+        )
+        metadata_cache.put(full_path, entry, generation)
+    metadata_cache.record(False, time.perf_counter() - started)
+    return entry
+
+
+def get_name_mapping_json(full_path, entry):
+    if entry.json is None:
+        body = schemas.NameMapping(
+            id=entry.id, full_path=full_path, chunk_hashes=get_chunk_hash_positions(entry.body), size=entry.size
+        ).model_dump_json().encode("utf-8")
+        metadata_cache.set_json(full_path, entry, body)
+    return entry.json
@@ -1,57 +1,205 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import IntegrityError
 import hashlib
-from app import crud, models
-from app.db import get_db
-import requests
+import json
+import os
+import time
+from app import crud, models, schemas
+from app.db import get_db, SessionLocal
+from app.controllers.rebalance import schedule_rebalance
+from app.controllers.replication import FOLLOWER, PRIMARY_URL, REPLICATION_POLL_WAIT, REPLICATION_RETRY_INTERVAL, mark_synced
+from app.http_client import get_client
+from app.metrics import Gauge
+import httpx
 import asyncio
 
 router = APIRouter()
 
 @router.post("/register_chunk_server/")
-def register_chunk_server(url: str, db: Session = Depends(get_db)):
+async def register_chunk_server(url: str, db: AsyncSession = Depends(get_db)):
     for server in chunk_servers:
         if server.url == url:
             return {"message": "Chunk server already registered", "url": url, "position": server.position}
 
     position = str(int(hashlib.md5(url.encode('utf-8')).hexdigest(), 16))
-    chunk_server = models.ChunkServer(url=url, position=position, fail_count=0)
-    chunk_servers.append(chunk_server)
-    chunk_servers.sort(key=lambda x: x.position)
-    crud.create_chunk_server(db, chunk_server)
+    try:
+        await crud.create_chunk_server(db, url, position)
+    except IntegrityError:
+        # Registered concurrently by another request
+        await db.rollback()
+        return {"message": "Chunk server already registered", "url": url, "position": position}
+    previous_servers = list(chunk_servers)
+    chunk_servers.append(models.ChunkServer(url=url, position=position, fail_count=0))
+    chunk_servers.sort(key=lambda x: int(x.position))
+    bump_topology_version()
+    await schedule_rebalance(previous_servers, chunk_servers)
 
     return {"message": "Chunk server registered successfully", "url": url, "position": position}
 
+def bump_topology_version(version=None):
+    # Called whenever the list returned by /chunk_servers/ changes, followers pass the primary's version
+    global topology_version, topology_changed, topology_body
+    topology_version = topology_version + 1 if version is None else version
+    topology_body = None
+    changed, topology_changed = topology_changed, asyncio.Event()
+    changed.set()
+
+def get_topology_body():
+    global topology_body
+    if topology_body is None:
+        topology_body = json.dumps(
+            [{"url": server.url, "position": server.position, "fail_count": server.fail_count} for server in chunk_servers]
+        ).encode("utf-8")
+    return topology_body
+
+def topology_response(status_code=200):
+    version = topology_version
+    headers = {"ETag": f'"{version}"', "X-Topology-Version": str(version)}
+    if status_code == 304:
+        return Response(status_code=304, headers=headers)
+    return Response(content=get_topology_body(), media_type="application/json", headers=headers)
+
 @router.get("/chunk_servers/")
-def get_chunk_servers():
-    return [{"url": server.url, "position": server.position, "fail_count": server.fail_count} for server in chunk_servers]
+async def get_chunk_servers(
+    wait: float = Query(0, description="Seconds to wait for a topology change when the client version is current"),
+    if_none_match: str = Header(None)
+):
+    # Clients that send the ETag of their cached topology get 304 until it changes.
+    # With wait > 0 the request is held open until the next change (long polling).
+    if if_none_match != f'"{topology_version}"':
+        return topology_response()
+    if wait > 0:
+        try:
+            await asyncio.wait_for(topology_changed.wait(), timeout=min(wait, MAX_TOPOLOGY_WAIT))
+            return topology_response()
+        except asyncio.TimeoutError:
+            pass
+    return topology_response(304)
+
+@router.post("/heartbeat/")
+async def heartbeat(stats: schemas.ChunkServerHeartbeat):
+    # Chunk servers in heartbeat mode push liveness and load instead of being polled
+    server = next((server for server in chunk_servers if server.url == stats.url), None)
+    if server is None:
+        raise HTTPException(status_code=404, detail="Chunk server not registered")
+    server_stats[server.url] = {**stats.model_dump(), "received_at": time.time()}
+    if server.fail_count != 0:
+        server.fail_count = 0
+        bump_topology_version()
+        await save_health_changes({server.url: 0}, [])
+    return {"status": "ok"}
+
+@router.get("/chunk_servers/stats")
+def get_chunk_server_stats():
+    now = time.time()
+    return [
+        {
+            "url": server.url,
+            "fail_count": server.fail_count,
+            **{key: value for key, value in server_stats.get(server.url, {}).items() if key != "received_at"},
+            "heartbeat_age": now - server_stats[server.url]["received_at"] if server.url in server_stats else None,
+        }
+        for server in chunk_servers
+    ]
+
+async def save_health_changes(fail_counts, removed_urls):
+    async with SessionLocal() as db:
+        await crud.update_chunk_servers_health(db, fail_counts, removed_urls)
+
+async def check_server(client, server):
+    received_at = server_stats.get(server.url, {}).get("received_at")
+    if received_at is not None and time.time() - received_at < HEARTBEAT_TIMEOUT:
+        return True
+    try:
+        response = await client.get(f"{server.url}/health_check", timeout=HEALTH_CHECK_TIMEOUT)
+        return response.status_code == 200
+    except httpx.HTTPError:
+        return False
 
 async def health_check():
+    # Checks every server concurrently and only writes to the database when a server's state changed
+    client = get_client()
     while True:
-        for server in chunk_servers:
-            try:
-                response = requests.get(f"{server.url}/health_check", timeout=1)
-                if response.status_code == 200:
-                    server.fail_count = 0
-                else:
-                    server.fail_count += 1
-            except requests.exceptions.RequestException:
-                server.fail_count += 1
-
-            db = next(get_db())
-            crud.update_chunk_server_fail_count(db, server.url, server.fail_count)
-
-            if server.fail_count >= 5:
+        try:
+            servers = list(chunk_servers)
+            results = await asyncio.gather(*(check_server(client, server) for server in servers))
+            fail_counts = {}
+            removed = []
+            previous_servers = list(chunk_servers)
+            for server, healthy in zip(servers, results):
+                fail_count = 0 if healthy else server.fail_count + 1
+                if fail_count != server.fail_count:
+                    server.fail_count = fail_count
+                    fail_counts[server.url] = fail_count
+                if fail_count >= MAX_FAIL_COUNT:
+                    removed.append(server)
+
+            for server in removed:
                 chunk_servers.remove(server)
-                crud.delete_chunk_server(db, server.url)
+                server_stats.pop(server.url, None)
+                fail_counts.pop(server.url, None)
                 print(f"Removed chunk server: {server.url} due to failed health checks.")
-        
-        await asyncio.sleep(10)
+
+            if fail_counts or removed:
+                bump_topology_version()
+                await save_health_changes(fail_counts, [server.url for server in removed])
+            if removed:
+                await schedule_rebalance(previous_servers, chunk_servers)
+        except Exception as e:
+            print(f"Error during health check: {e}")
+
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+async def mirror_topology():
+    # Followers copy the primary's list, only the primary registers and health checks the servers.
+    # Keeping the primary's version lets clients switch between leaders without refetching.
+    global chunk_servers
+    client = get_client()
+    version = None
+    while True:
+        try:
+            sent_at = time.time()
+            headers = {"If-None-Match": f'"{version}"'} if version is not None else {}
+            response = await client.get(
+                f"{PRIMARY_URL}/chunk_servers/", params={"wait": REPLICATION_POLL_WAIT}, headers=headers,
+                timeout=REPLICATION_POLL_WAIT + 10
+            )
+            if response.status_code == 200:
+                chunk_servers = [models.ChunkServer(**server) for server in response.json()]
+                version = int(response.headers["X-Topology-Version"])
+                bump_topology_version(version)
+            elif response.status_code != 304:
+                response.raise_for_status()
+            mark_synced("topology", sent_at)
+        except Exception as e:
+            print(f"Error mirroring chunk servers from {PRIMARY_URL}: {e}")
+            await asyncio.sleep(REPLICATION_RETRY_INTERVAL)
+
+MAX_TOPOLOGY_WAIT = 60  # Seconds
+HEALTH_CHECK_INTERVAL = 10  # Seconds
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", 1))  # Seconds
+# A heartbeat younger than this counts as a passed health check
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", 30))  # Seconds
+MAX_FAIL_COUNT = 5
+
+server_stats = {}
 
 chunk_servers = []
+# Starts from the clock so versions keep increasing across leader restarts
+topology_version = int(time.time() * 1000)
+topology_body = None
+topology_changed = asyncio.Event()
+
+Gauge("chunk_servers", "Registered chunk servers", function=lambda: len(chunk_servers))
+Gauge("chunk_servers_failing", "Chunk servers that failed their last health check", function=lambda: sum(server.fail_count > 0 for server in chunk_servers))
+
 @router.on_event("startup")
 async def startup_event():
-    db = next(get_db())
     global chunk_servers
-    chunk_servers = crud.get_chunk_servers(db)
+    if FOLLOWER:
+        asyncio.create_task(mirror_topology())
+        return
+    async with SessionLocal() as db:
+        chunk_servers = sorted(await crud.get_chunk_servers(db), key=lambda x: int(x.position))
     asyncio.create_task(health_check())
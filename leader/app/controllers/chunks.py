@@ -0,0 +1,34 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import crud, models
+from app.db import get_db
+import time
+
+router = APIRouter()
+
+# Checked chunks are leased as long as a temporary name mapping lives. Deleting another file
+# meanwhile does not remove existing ones before the upload references them, and the copies of
+# missing ones are collected if the upload never finishes.
+PIN_TTL = 600  # Seconds
+
+@router.post("/chunks/missing/")
+async def find_missing_chunks(request: Request, db: AsyncSession = Depends(get_db)):
+    # Takes packed 16-byte digests and returns the packed digests of the chunks no file references
+    # yet, including those being deleted. Uploads write their own copy of those.
+    chunk_digests = await request.body()
+    if len(chunk_digests) % models.DIGEST_SIZE:
+        raise HTTPException(status_code=400, detail="Chunk digests must be a multiple of 16 bytes")
+    digests = list(dict.fromkeys(models.split_chunk_digests(chunk_digests)))
+    existing = await crud.lease_chunks(db, digests, time.time() + PIN_TTL)
+    missing = b"".join(digest for digest in digests if digest not in existing)
+    return Response(content=missing, media_type="application/octet-stream", headers={"X-Existing-Count": str(len(existing))})
+
+@router.post("/chunks/deleted/")
+async def confirm_chunk_deletes(request: Request, db: AsyncSession = Depends(get_db)):
+    # Takes the packed digests of orphaned chunks the chunk servers deleted, which lifts their tombstones
+    chunk_digests = await request.body()
+    if len(chunk_digests) % models.DIGEST_SIZE:
+        raise HTTPException(status_code=400, detail="Chunk digests must be a multiple of 16 bytes")
+    digests = list(dict.fromkeys(models.split_chunk_digests(chunk_digests)))
+    await crud.confirm_chunk_deletes(db, digests, time.time())
+    return {"message": f"Confirmed the deletion of {len(digests)} chunks"}
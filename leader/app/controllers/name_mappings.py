@@ -1,11 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException, Path, Query
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Path, Query, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 from typing import List, Dict
-from app import crud, schemas
+from app import crud, models, schemas
 from app.db import get_db
+from app.cache import metadata_cache, get_cached_name_mapping, get_name_mapping_json
+from app.controllers.replication import notify_log_appended
 from datetime import datetime, timedelta
 import asyncio
+import bisect
+import struct
+import time
 
 
 router = APIRouter()
@@ -13,83 +18,205 @@ router = APIRouter()
 
 temporary_name_mappings = {}
 
-@router.post("/temp_namemappings/")
-def create_temp_name_mapping(name_mapping: schemas.NameMappingCreate):
-    temporary_name_mappings[name_mapping.full_path] = {
-        "name_mapping": name_mapping,
+async def check_not_deleting(db, chunk_digests):
+    # The upload commits its chunks on the servers after this, a delete request for one of them
+    # that is still in flight could remove the copy it wrote. It waits for the deletion instead.
+    deleting = await crud.get_deleting_chunks(db, models.split_chunk_digests(chunk_digests), time.time())
+    if deleting:
+        raise HTTPException(
+            status_code=409, detail=f"{len(deleting)} chunks are being deleted, retry once the deletion finished",
+            headers={"Retry-After": "1"}
+        )
+
+async def add_temp_name_mapping(db, full_path, chunk_digests, size, chunk_lengths=None):
+    await check_not_deleting(db, chunk_digests)
+    temporary_name_mappings[full_path] = {
+        "chunk_digests": chunk_digests,
+        "chunk_lengths": chunk_lengths,
+        "size": size,
         "timestamp": datetime.now()
     }
+
+@router.post("/temp_namemappings/")
+async def create_temp_name_mapping(name_mapping: schemas.NameMappingCreate, db: AsyncSession = Depends(get_db)):
+    chunk_digests = models.pack_chunk_hashes(chunk_hash for chunk_hash, position in name_mapping.chunk_hashes)
+    await add_temp_name_mapping(db, name_mapping.full_path, chunk_digests, name_mapping.size)
     return name_mapping
 
-@router.post("/finalize_namemappings/")
-def finalize_name_mapping(full_path: str = Query(..., description="The full path of the name mapping"),
-                          db: Session = Depends(get_db)):
+@router.post("/temp_namemappings_binary/")
+async def create_temp_name_mapping_binary(
+    request: Request,
+    full_path: str = Query(..., description="The full path of the name mapping"),
+    size: int = Query(..., description="The file size in bytes"),
+    lengths: bool = Query(False, description="The digests are followed by the length of every chunk"),
+    db: AsyncSession = Depends(get_db)
+):
+    # The body is the packed 16-byte MD5 digests of the chunks in file order. Files split into
+    # variable-size chunks append a big-endian 32-bit length per chunk.
+    body = await request.body()
+    if not lengths:
+        if len(body) % models.DIGEST_SIZE:
+            raise HTTPException(status_code=400, detail="Chunk digests must be a multiple of 16 bytes")
+        await add_temp_name_mapping(db, full_path, body, size)
+        return {"full_path": full_path, "size": size, "chunk_count": len(body) // models.DIGEST_SIZE}
+
+    chunk_count, invalid = divmod(len(body), models.DIGEST_SIZE + models.LENGTH_SIZE)
+    chunk_digests = body[:chunk_count * models.DIGEST_SIZE]
+    chunk_lengths = body[chunk_count * models.DIGEST_SIZE:]
+    if invalid or sum(struct.unpack(f">{chunk_count}I", chunk_lengths)) != size:
+        raise HTTPException(status_code=400, detail="Chunk lengths do not add up to the file size")
+    await add_temp_name_mapping(db, full_path, chunk_digests, size, chunk_lengths)
+    return {"full_path": full_path, "size": size, "chunk_count": chunk_count}
+
+@router.post("/finalize_namemappings/", response_model=schemas.NameMapping)
+async def finalize_name_mapping(full_path: str = Query(..., description="The full path of the name mapping"),
+                          db: AsyncSession = Depends(get_db)):
     if full_path not in temporary_name_mappings:
         raise HTTPException(status_code=404, detail="Temporary name mapping not found")
 
-    name_mapping_data = temporary_name_mappings.pop(full_path)
-    name_mapping = name_mapping_data["name_mapping"]
+    name_mapping = temporary_name_mappings.pop(full_path)
     try:
-        db_name_mapping = crud.create_name_mapping(db=db, name_mapping=name_mapping)
+        db_name_mapping = await crud.create_name_mapping(
+            db=db, full_path=full_path, chunk_digests=name_mapping["chunk_digests"], size=name_mapping["size"],
+            chunk_lengths=name_mapping["chunk_lengths"]
+        )
+        metadata_cache.invalidate(full_path)
+        notify_log_appended()
         return db_name_mapping
     except IntegrityError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=400, detail="Name already taken")
     
 
 @router.post("/namemappings/", response_model=schemas.NameMapping)
-def create_name_mapping(name_mapping: schemas.NameMappingCreate, db: Session = Depends(get_db)):
+async def create_name_mapping(name_mapping: schemas.NameMappingCreate, db: AsyncSession = Depends(get_db)):
+    chunk_digests = models.pack_chunk_hashes(chunk_hash for chunk_hash, position in name_mapping.chunk_hashes)
+    await check_not_deleting(db, chunk_digests)
     try:
-        db_name_mapping = crud.create_name_mapping(db=db, name_mapping=name_mapping)
+        db_name_mapping = await crud.create_name_mapping(
+            db=db, full_path=name_mapping.full_path, chunk_digests=chunk_digests, size=name_mapping.size
+        )
+        metadata_cache.invalidate(name_mapping.full_path)
+        notify_log_appended()
         return db_name_mapping
     except IntegrityError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=400, detail="Name already taken")
 
 @router.get("/namemappings/{full_path:path}", response_model=schemas.NameMapping)
-def get_name_mapping(
+async def get_name_mapping(
     full_path: str = Path(..., description="The full path of the name mapping"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    db_name_mapping = crud.get_name_mapping(db=db, name=full_path)
-    if db_name_mapping is None:
+    cached = await get_cached_name_mapping(db, full_path)
+    if cached is None:
         raise HTTPException(status_code=404, detail="Name not found")
-    return db_name_mapping
+    return Response(content=get_name_mapping_json(full_path, cached), media_type="application/json")
 
-@router.put("/namemappings/")
-def rename_name_mapping(
+@router.get("/namemappings_binary/{full_path:path}")
+async def get_name_mapping_binary(
+    full_path: str = Path(..., description="The full path of the name mapping"),
+    offset: int = Query(None, description="First byte of the requested range, negative values count from the end"),
+    length: int = Query(None, ge=0, description="Number of bytes in the requested range, to the end if omitted"),
+    chunk_size: int = Query(1024, ge=1, description="Size of every chunk except the last one, for files without stored chunk lengths"),
+    db: AsyncSession = Depends(get_db)
+):
+    # Packed 16-byte chunk digests in file order, ring positions are left to the client.
+    # With offset or length only the chunks covering that byte range are returned.
+    cached = await get_cached_name_mapping(db, full_path)
+    if cached is None:
+        raise HTTPException(status_code=404, detail="Name not found")
+    chunk_count = len(cached.body) // models.DIGEST_SIZE
+    headers = {"X-File-Size": str(cached.size), "X-Chunk-Count": str(chunk_count)}
+    if offset is None and length is None:
+        return Response(content=cached.body, media_type="application/octet-stream", headers=headers)
+
+    start = offset or 0
+    if start < 0:
+        start = max(cached.size + start, 0)
+    if start >= cached.size and cached.size > 0:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"X-File-Size": str(cached.size)})
+    end = cached.size if length is None else min(start + length, cached.size)
+    if cached.offsets is None:
+        first_chunk = start // chunk_size
+        last_chunk = min(-(-end // chunk_size), chunk_count)
+        first_offset = first_chunk * chunk_size
+    elif chunk_count:
+        first_chunk = bisect.bisect_right(cached.offsets, start) - 1
+        last_chunk = bisect.bisect_left(cached.offsets, end)
+        first_offset = cached.offsets[first_chunk]
+    else:
+        first_chunk = last_chunk = first_offset = 0
+    headers.update({
+        "X-Range-Start": str(start),
+        "X-Range-End": str(end),
+        "X-First-Chunk": str(first_chunk),
+        "X-First-Chunk-Offset": str(first_offset),
+    })
+    body = cached.body[first_chunk * models.DIGEST_SIZE:max(first_chunk, last_chunk) * models.DIGEST_SIZE]
+    return Response(content=body, media_type="application/octet-stream", headers=headers)
+
+@router.put("/namemappings/", response_model=schemas.NameMapping)
+async def rename_name_mapping(
     old_path: str = Query(..., description="The current full path of the name mapping"),
     new_path: str = Query(..., description="The new full path of the name mapping"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        db_name_mapping = crud.rename_name_mapping(db=db, old_name=old_path, new_name=new_path)
+        db_name_mapping = await crud.rename_name_mapping(db=db, old_name=old_path, new_name=new_path)
+        metadata_cache.invalidate(old_path, new_path)
         if db_name_mapping is None:
             raise HTTPException(status_code=404, detail="Name not found")
+        notify_log_appended()
         return db_name_mapping
     except IntegrityError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=400, detail="New name already taken")
 
 @router.delete("/namemappings/{full_path:path}")
-def delete_name_mapping(
+async def delete_name_mapping(
+    full_path: str = Path(..., description="The full path of the name mapping"),
+    db: AsyncSession = Depends(get_db)
+):
+    orphans = await crud.delete_name_mapping(db=db, name=full_path)
+    metadata_cache.invalidate(full_path)
+    if orphans is None:
+        raise HTTPException(status_code=404, detail="Name not found")
+    notify_log_appended()
+    return {"message": "Name deleted successfully", "orphaned_chunks": [digest.hex() for digest in orphans]}
+
+@router.delete("/namemappings_binary/{full_path:path}")
+async def delete_name_mapping_binary(
     full_path: str = Path(..., description="The full path of the name mapping"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    success = crud.delete_name_mapping(db=db, name=full_path)
-    if not success:
+    # Returns the packed digests of the chunks no file references anymore, the caller removes
+    # them from the chunk servers
+    orphans = await crud.delete_name_mapping(db=db, name=full_path)
+    metadata_cache.invalidate(full_path)
+    if orphans is None:
         raise HTTPException(status_code=404, detail="Name not found")
-    return {"message": "Name deleted successfully"}
+    notify_log_appended()
+    return Response(content=b"".join(orphans), media_type="application/octet-stream", headers={"X-Orphaned-Count": str(len(orphans))})
+
+@router.get("/metadata_cache/stats")
+def get_metadata_cache_stats():
+    return metadata_cache.get_stats()
 
-@router.get("/listfiles/", response_model=List[str])
-def list_files_in_folder(
+@router.get("/listfiles/", response_model=schemas.FileListing)
+async def list_files_in_folder(
     folder_path: str = Query(..., description="The path of the folder to list files from"),
-    db: Session = Depends(get_db)
+    recursive: bool = Query(True, description="List every file under the folder, not only its direct children"),
+    cursor: str = Query(None, description="next_cursor of the previous page"),
+    limit: int = Query(1000, ge=1, le=10000, description="Maximum number of files per page"),
+    db: AsyncSession = Depends(get_db)
 ):
-    files = crud.list_files_in_folder(db=db, folder_path=folder_path)
-    if not files:
+    files, next_cursor = await crud.list_files_in_folder(
+        db=db, folder_path=folder_path, recursive=recursive, cursor=cursor, limit=limit
+    )
+    if not files and cursor is None:
         raise HTTPException(status_code=404, detail="No files found in the specified folder")
-    return [file.full_path for file in files]
+    return {"files": [{"full_path": file.full_path, "size": file.size} for file in files], "next_cursor": next_cursor}
 
 
 async def clean_old_temp_mappings():
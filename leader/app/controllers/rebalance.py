@@ -0,0 +1,224 @@
+from fastapi import APIRouter
+from app import crud, models
+from app.db import SessionLocal
+from app.hash_ring import HashRing
+from app.http_client import get_client
+from app.controllers.replication import FOLLOWER
+from app.controllers.chunks import PIN_TTL
+import asyncio
+import bisect
+import httpx
+import json
+import os
+import time
+
+router = APIRouter()
+
+# Chunks read from the database per step, progress is saved after every step
+REBALANCE_BATCH_SIZE = int(os.getenv("REBALANCE_BATCH_SIZE", 1000))
+# Upper bound on the chunks moved per second, so rebalancing does not starve client traffic
+REBALANCE_RATE = float(os.getenv("REBALANCE_RATE", 2000))
+REBALANCE_TIMEOUT = float(os.getenv("REBALANCE_TIMEOUT", 60))  # Seconds
+REBALANCE_RETRY_INTERVAL = 30  # Seconds
+RING_SIZE = 1 << 128
+
+# Set when there is a running job to work on, including a new one superseding the current
+rebalance_wakeup = asyncio.Event()
+# Jobs are created one at a time so each one chains onto the previous
+schedule_lock = asyncio.Lock()
+
+def ring_members(servers):
+    return [{"url": server.url, "position": server.position} for server in servers]
+
+def build_ring(members):
+    # Placement only depends on membership, servers failing health checks are still targets
+    return HashRing([{**member, "fail_count": 0} for member in members])
+
+def affected_ranges(source_rings, target_ring):
+    # Splits the ring at every point of every ring and returns the merged [start, end) ranges
+    # whose replica set differs between the target and any of the sources
+    bounds = sorted({0}.union(*(ring.positions for ring in source_rings), target_ring.positions))
+    ranges = []
+    for i, start in enumerate(bounds):
+        end = bounds[i + 1] if i + 1 < len(bounds) else RING_SIZE
+        target = [server['url'] for server in target_ring.place_position(start)]
+        if any([server['url'] for server in ring.place_position(start)] != target for ring in source_rings):
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+    return ranges
+
+def in_ranges(ranges, starts, position):
+    i = bisect.bisect(starts, position) - 1
+    return i >= 0 and position < ranges[i][1]
+
+async def schedule_rebalance(previous_servers, servers):
+    # Called after every membership change with the chunk servers before and after it
+    async with schedule_lock:
+        previous_ring, target_ring = ring_members(previous_servers), ring_members(servers)
+        async with SessionLocal() as db:
+            job = await crud.create_rebalance_job(db, previous_ring, target_ring)
+    print(f"Scheduled rebalance job {job.id} for {len(target_ring)} chunk servers.")
+    rebalance_wakeup.set()
+
+async def replicate(client, target_url, sources, chunk_hashes):
+    response = await client.post(
+        f"{target_url}/replicate_chunks/", json={"chunks": chunk_hashes, "sources": sources}, timeout=REBALANCE_TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json()
+
+async def delete_stale(client, url, chunk_hashes):
+    # Copies on servers outside the replica set are only an optimization, a failed delete is harmless
+    try:
+        response = await client.post(f"{url}/delete_chunks/", json={"chunks": chunk_hashes}, timeout=REBALANCE_TIMEOUT)
+        return len(chunk_hashes) if response.status_code == 200 else 0
+    except httpx.HTTPError:
+        return 0
+
+async def move_chunks(client, chunk_hashes, source_rings, target_ring, members):
+    # Every target pulls the chunks it lacks from the other replicas, old and new. Once all
+    # targets hold a chunk it is deleted from the servers that are no longer its replicas.
+    copies = {}
+    stale = {}
+    for chunk_hash in chunk_hashes:
+        position = models.chunk_position(chunk_hash)
+        targets = [server['url'] for server in target_ring.place_position(position)]
+        sources = []
+        for ring in source_rings:
+            sources += [server['url'] for server in ring.place_position(position)]
+        sources = [url for url in dict.fromkeys(sources + targets) if url in members]
+        for target in targets:
+            copies.setdefault((target, tuple(url for url in sources if url != target)), []).append(chunk_hash)
+        stale[chunk_hash] = [url for url in sources if url not in targets]
+
+    # Request errors propagate, the batch is retried from the last saved cursor
+    keys = list(copies)
+    results = await asyncio.gather(*(replicate(client, target, list(sources), copies[target, sources]) for target, sources in keys))
+    failed = set()
+    copied = 0
+    for result in results:
+        copied += result["copied"]
+        failed.update(result["missing"])
+
+    deletes = {}
+    for chunk_hash, urls in stale.items():
+        if chunk_hash not in failed:
+            for url in urls:
+                deletes.setdefault(url, []).append(chunk_hash)
+    deleted = sum(await asyncio.gather(*(delete_stale(client, url, hashes) for url, hashes in deletes.items())))
+    return copied, deleted, len(failed)
+
+async def rebalance(client):
+    # Works through the running job until it is done or superseded by a newer one
+    async with SessionLocal() as db:
+        job = await crud.get_latest_rebalance_job(db, "running")
+    if job is None:
+        return
+    target_members = json.loads(job.target_ring)
+    members = {member["url"] for member in target_members}
+    source_rings = [build_ring(ring) for ring in json.loads(job.source_rings)]
+    target_ring = build_ring(target_members)
+    ranges = affected_ranges(source_rings, target_ring)
+    starts = [start for start, end in ranges]
+    progress = {"scanned": job.scanned, "copied": job.copied, "deleted": job.deleted, "failed": job.failed}
+    cursor = job.cursor
+    rescan_at = job.rescan_at
+    print(f"Rebalance job {job.id}: {len(ranges)} affected ring ranges.")
+    if ranges and rescan_at is not None:
+        await wait_for_rescan(job.id, rescan_at)
+
+    while ranges:
+        if rebalance_wakeup.is_set():
+            # A newer membership change superseded this job
+            return
+        started = time.monotonic()
+        async with SessionLocal() as db:
+            digests = await crud.get_chunk_digests_after(db, cursor, REBALANCE_BATCH_SIZE)
+        if not digests:
+            if rescan_at is not None:
+                break
+            # Uploads in flight finish within PIN_TTL, after that every chunk placed by the old
+            # ring is written and a second scan moves the ones the first one missed
+            rescan_at = time.time() + PIN_TTL
+            cursor = None
+            async with SessionLocal() as db:
+                await crud.update_rebalance_job(db, job.id, cursor=None, rescan_at=rescan_at)
+            print(f"Rebalance job {job.id}: first scan done, rescanning at {time.ctime(rescan_at)}: {progress}")
+            await wait_for_rescan(job.id, rescan_at)
+            continue
+        chunk_hashes = [digest.hex() for digest in digests]
+        affected = [chunk_hash for chunk_hash in chunk_hashes if in_ranges(ranges, starts, models.chunk_position(chunk_hash))]
+        if affected:
+            copied, deleted, failed = await move_chunks(client, affected, source_rings, target_ring, members)
+            progress["copied"] += copied
+            progress["deleted"] += deleted
+            progress["failed"] += failed
+        progress["scanned"] += len(digests)
+        cursor = digests[-1]
+        async with SessionLocal() as db:
+            await crud.update_rebalance_job(db, job.id, cursor=cursor, **progress)
+        delay = len(affected) / REBALANCE_RATE - (time.monotonic() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async with SessionLocal() as db:
+        await crud.update_rebalance_job(db, job.id, status="done")
+    print(f"Rebalance job {job.id} done: {progress}")
+
+async def wait_for_rescan(job_id, rescan_at):
+    # Returns early when a newer membership change supersedes the job
+    try:
+        await asyncio.wait_for(rebalance_wakeup.wait(), timeout=max(rescan_at - time.time(), 0))
+    except asyncio.TimeoutError:
+        print(f"Rebalance job {job_id}: starting the second scan.")
+
+async def run_rebalancer():
+    client = get_client()
+    while True:
+        await rebalance_wakeup.wait()
+        rebalance_wakeup.clear()
+        try:
+            await rebalance(client)
+        except Exception as e:
+            print(f"Error during rebalance: {e}")
+            await asyncio.sleep(REBALANCE_RETRY_INTERVAL)
+            rebalance_wakeup.set()
+
+@router.get("/rebalance/status")
+async def get_rebalance_status():
+    async with SessionLocal() as db:
+        job = await crud.get_latest_rebalance_job(db)
+        chunk_count = await crud.count_chunk_refs(db)
+    if job is None:
+        return {"status": "idle", "chunk_count": chunk_count}
+    # Digests are uniformly distributed, so the cursor tells how far the scan got. Each of the
+    # two scans is half of the job.
+    scan_progress = int.from_bytes(job.cursor[:8], "big") / 2 ** 64 if job.cursor else 0.0
+    progress = 1.0 if job.status == "done" else (scan_progress + (job.rescan_at is not None)) / 2
+    return {
+        "job": job.id,
+        "status": job.status,
+        "progress": progress,
+        "scanned": job.scanned,
+        "copied": job.copied,
+        "deleted": job.deleted,
+        "failed": job.failed,
+        "rescan_at": job.rescan_at,
+        "chunk_count": chunk_count,
+        "servers": [member["url"] for member in json.loads(job.target_ring)],
+        "started_at": job.created_at,
+        "updated_at": job.updated_at,
+    }
+
+@router.on_event("startup")
+async def startup_event():
+    # Only the primary moves chunks
+    if FOLLOWER:
+        return
+    # A job interrupted by a restart resumes after its last saved cursor
+    async with SessionLocal() as db:
+        if await crud.get_latest_rebalance_job(db, "running") is not None:
+            rebalance_wakeup.set()
+    asyncio.create_task(run_rebalancer())
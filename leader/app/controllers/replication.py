@@ -0,0 +1,257 @@
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import JSONResponse
+from app import crud
+from app.db import SessionLocal
+from app.cache import metadata_cache
+from app.http_client import get_client
+from app.metrics import Gauge
+import asyncio
+import base64
+import os
+import time
+
+router = APIRouter()
+
+# A follower keeps a copy of the name mappings and the chunk server list of the primary and
+# serves the metadata reads from it. Writes are only accepted by the primary.
+LEADER_ROLE = os.getenv("LEADER_ROLE", "primary")
+FOLLOWER = LEADER_ROLE == "follower"
+PRIMARY_URL = os.getenv("PRIMARY_URL")
+# Followers further behind the primary than this answer metadata reads with 503
+MAX_REPLICATION_LAG = float(os.getenv("MAX_REPLICATION_LAG", 5))  # Seconds
+# How long a caught up follower waits for new log entries per request. The lag of an idle
+# follower reaches twice this, so it must stay well below MAX_REPLICATION_LAG.
+REPLICATION_POLL_WAIT = float(os.getenv("REPLICATION_POLL_WAIT", 2))  # Seconds
+REPLICATION_BATCH_SIZE = int(os.getenv("REPLICATION_BATCH_SIZE", 1000))
+# Log entries kept on the primary, a follower further behind reloads the whole snapshot
+REPLICATION_LOG_RETENTION = int(os.getenv("REPLICATION_LOG_RETENTION", 100000))
+REPLICATION_TRIM_INTERVAL = 60  # Seconds
+REPLICATION_RETRY_INTERVAL = 2  # Seconds
+MAX_REPLICATION_WAIT = 60  # Seconds
+LAG_HEADER = "X-Replication-Lag"
+
+# Set when a name mapping change was committed, wakes the waiting log requests
+log_appended = asyncio.Event()
+# Send time of the last request after which the follower was known to be caught up, per stream
+synced_at = {"log": None, "topology": None}
+log_position = 0
+
+def notify_log_appended():
+    global log_appended
+    appended, log_appended = log_appended, asyncio.Event()
+    appended.set()
+
+def mark_synced(stream, sent_at):
+    synced_at[stream] = sent_at
+
+def replication_lag(stream):
+    # Upper bound on how far behind the primary the follower is, infinite before the first sync
+    if synced_at[stream] is None:
+        return float("inf")
+    return max(time.time() - synced_at[stream], 0.0)
+
+def replicated_stream(path):
+    if path == "/chunk_servers/":
+        return "topology"
+    if path.startswith(("/namemappings", "/listfiles/", "/file/")):
+        return "log"
+    return None
+
+def encode_bytes(value):
+    return base64.b64encode(value).decode("ascii") if value is not None else None
+
+def decode_bytes(value):
+    return base64.b64decode(value) if value is not None else None
+
+def encode_entry(entry):
+    return {
+        "id": entry.id,
+        "operation": entry.operation,
+        "full_path": entry.full_path,
+        "new_path": entry.new_path,
+        "file_id": entry.file_id,
+        "chunk_digests": encode_bytes(entry.chunk_digests),
+        "chunk_lengths": encode_bytes(entry.chunk_lengths),
+        "size": entry.size,
+    }
+
+def encode_file(file):
+    # Snapshot rows are sent as put entries
+    return {
+        "id": None,
+        "operation": "put",
+        "full_path": file.full_path,
+        "new_path": None,
+        "file_id": file.id,
+        "chunk_digests": encode_bytes(file.chunk_digests),
+        "chunk_lengths": encode_bytes(file.chunk_lengths),
+        "size": file.size,
+    }
+
+def decode_entry(entry):
+    return {**entry, "chunk_digests": decode_bytes(entry["chunk_digests"]), "chunk_lengths": decode_bytes(entry["chunk_lengths"])}
+
+@router.get("/replication/log")
+async def get_replication_log(
+    after: int = Query(0, ge=0, description="Id of the last entry the follower applied"),
+    limit: int = Query(1000, ge=1, le=10000, description="Maximum number of entries"),
+    wait: float = Query(0, description="Seconds to wait for new entries when the follower is caught up")
+):
+    # Entries are returned in commit order (see crud.add_replication_entry) together with the
+    # newest id, a follower that applied up to latest is caught up with every change committed
+    # before its request
+    deadline = time.monotonic() + min(wait, MAX_REPLICATION_WAIT)
+    while True:
+        appended = log_appended
+        async with SessionLocal() as db:
+            oldest, latest = await crud.get_replication_bounds(db)
+            latest = latest or 0
+            # Entries the follower still needs were trimmed, or the log belongs to another database
+            if after > latest or (oldest is not None and after < oldest - 1):
+                raise HTTPException(status_code=410, detail="Log position no longer available, load a snapshot")
+            entries = await crud.get_replication_entries(db, after, limit) if after < latest else []
+        remaining = deadline - time.monotonic()
+        if entries or remaining <= 0:
+            break
+        try:
+            await asyncio.wait_for(appended.wait(), timeout=remaining)
+        except asyncio.TimeoutError:
+            pass
+    return {
+        "entries": [encode_entry(entry) for entry in entries],
+        "latest": latest,
+    }
+
+@router.get("/replication/snapshot")
+async def get_replication_snapshot(
+    after: int = Query(0, ge=0, description="next of the previous page"),
+    limit: int = Query(1000, ge=1, le=10000, description="Maximum number of files per page")
+):
+    # Every name mapping in pages. The log is replayed from the position of the first page,
+    # entries are idempotent, so changes made while the pages are read are applied again safely.
+    async with SessionLocal() as db:
+        oldest, latest = await crud.get_replication_bounds(db)
+        files = await crud.get_name_mappings_after(db, after, limit)
+    return {
+        "position": latest or 0,
+        "files": [encode_file(file) for file in files],
+        "next": files[-1].id if len(files) == limit else None,
+    }
+
+@router.get("/replication/status")
+async def get_replication_status():
+    if FOLLOWER:
+        return {
+            "role": LEADER_ROLE,
+            "primary": PRIMARY_URL,
+            "position": log_position,
+            # None until the first sync, JSON has no infinity
+            "lag": synced_at["log"] and replication_lag("log"),
+            "topology_lag": synced_at["topology"] and replication_lag("topology"),
+            "max_lag": MAX_REPLICATION_LAG,
+        }
+    async with SessionLocal() as db:
+        oldest, latest = await crud.get_replication_bounds(db)
+    return {"role": LEADER_ROLE, "oldest": oldest, "latest": latest or 0}
+
+async def follower_only_reads(request: Request, call_next):
+    # Installed on followers. Writes are refused, and metadata reads are refused while the copy
+    # is further behind than MAX_REPLICATION_LAG, so clients retry them on the primary.
+    if request.method not in ("GET", "HEAD"):
+        return JSONResponse(status_code=403, content={"detail": "Read-only follower, send writes to the primary"})
+    stream = replicated_stream(request.url.path)
+    if stream is None:
+        return await call_next(request)
+    lag = replication_lag(stream)
+    if lag > MAX_REPLICATION_LAG:
+        return JSONResponse(status_code=503, content={"detail": "Follower is behind the primary"}, headers={LAG_HEADER: f"{lag:.3f}"})
+    response = await call_next(request)
+    response.headers[LAG_HEADER] = f"{lag:.3f}"
+    return response
+
+async def apply_entries(entries):
+    async with SessionLocal() as db:
+        await crud.apply_replication_entries(db, entries)
+    metadata_cache.invalidate(*(path for entry in entries for path in (entry["full_path"], entry["new_path"]) if path))
+
+async def load_snapshot(client):
+    # Replaces the local name mappings with the primary's, returns the log position to resume from
+    mark_synced("log", None)
+    async with SessionLocal() as db:
+        await crud.clear_name_mappings(db)
+    metadata_cache.clear()
+    position = None
+    after = 0
+    count = 0
+    while True:
+        response = await client.get(
+            f"{PRIMARY_URL}/replication/snapshot", params={"after": after, "limit": REPLICATION_BATCH_SIZE}
+        )
+        response.raise_for_status()
+        page = response.json()
+        if position is None:
+            position = page["position"]
+        if page["files"]:
+            await apply_entries([decode_entry(file) for file in page["files"]])
+            count += len(page["files"])
+        if page["next"] is None:
+            break
+        after = page["next"]
+    print(f"Loaded {count} name mappings from {PRIMARY_URL} at log position {position}.")
+    return position
+
+async def pull_log(client, position):
+    # Applies the next batch of entries, returns the new position or None when a snapshot is needed
+    sent_at = time.time()
+    response = await client.get(
+        f"{PRIMARY_URL}/replication/log",
+        params={"after": position, "limit": REPLICATION_BATCH_SIZE, "wait": REPLICATION_POLL_WAIT},
+        timeout=REPLICATION_POLL_WAIT + 10
+    )
+    if response.status_code == 410:
+        print(f"Replication log position {position} is no longer available, reloading the snapshot.")
+        return None
+    response.raise_for_status()
+    body = response.json()
+    entries = [decode_entry(entry) for entry in body["entries"]]
+    if entries:
+        await apply_entries(entries)
+        position = entries[-1]["id"]
+    if position >= body["latest"]:
+        mark_synced("log", sent_at)
+    return position
+
+async def follow_primary():
+    global log_position
+    client = get_client()
+    position = None
+    while True:
+        try:
+            if position is None:
+                position = await load_snapshot(client)
+            position = await pull_log(client, position)
+            log_position = position or 0
+        except Exception as e:
+            print(f"Error replicating from {PRIMARY_URL}: {e}")
+            await asyncio.sleep(REPLICATION_RETRY_INTERVAL)
+
+async def trim_log():
+    while True:
+        await asyncio.sleep(REPLICATION_TRIM_INTERVAL)
+        try:
+            async with SessionLocal() as db:
+                await crud.trim_replication_log(db, REPLICATION_LOG_RETENTION)
+        except Exception as e:
+            print(f"Error trimming the replication log: {e}")
+
+if FOLLOWER:
+    Gauge("replication_lag_seconds", "Upper bound on how far the name mappings lag behind the primary", function=lambda: replication_lag("log"))
+
+@router.on_event("startup")
+async def startup_event():
+    if FOLLOWER:
+        if not PRIMARY_URL:
+            raise RuntimeError("PRIMARY_URL must be set when LEADER_ROLE is follower")
+        asyncio.create_task(follow_primary())
+    else:
+        asyncio.create_task(trim_log())
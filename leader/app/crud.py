@@ -1,58 +1,322 @@
-from sqlalchemy.orm import Session
-from . import models, schemas
-
-def get_chunk_servers(db: Session):
-    return db.query(models.ChunkServer).all()
-
-def create_chunk_server(db: Session, chunk_server: models.ChunkServer):
-    db.add(chunk_server)
-    db.commit()
-    db.refresh(chunk_server)
-    return chunk_server
-
-def update_chunk_server_fail_count(db: Session, url: str, fail_count: int):
-    chunk_server = db.query(models.ChunkServer).filter(models.ChunkServer.url == url).first()
-    if chunk_server:
-        chunk_server.fail_count = fail_count
-        db.commit()
-    return chunk_server
-
-def delete_chunk_server(db: Session, url: str):
-    chunk_server = db.query(models.ChunkServer).filter(models.ChunkServer.url == url).first()
-    if chunk_server:
-        db.delete(chunk_server)
-        db.commit()
-    return chunk_server
-
-def get_name_mapping(db: Session, name: str):
-    return db.query(models.NameMapping).filter(models.NameMapping.full_path == name).first()
-
-def create_name_mapping(db: Session, name_mapping: schemas.NameMappingCreate):
-    db_name_mapping = models.NameMapping(
-        full_path=name_mapping.full_path,
-        chunk_hashes=name_mapping.chunk_hashes,
-        size=name_mapping.size
+import os
+import json
+import time
+from sqlalchemy import select, insert, update, delete, func, text, case, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models
+
+REF_BATCH_SIZE = 1000
+# Chunks handed out for deletion keep a tombstone until the deletion is confirmed, uploads of them
+# must not commit before, or a late delete request would remove their copy. Unconfirmed
+# tombstones are handed out again after this time. It must be longer than the HTTP timeout of the
+# user services, so no delete request for the chunk can still be in flight.
+DELETE_FENCE_TTL = float(os.getenv("DELETE_FENCE_TTL", 300))  # Seconds
+# Postgres advisory lock serializing the replication log writers
+REPLICATION_LOCK_KEY = 0x4446534C4F47
+
+async def get_chunk_servers(db: AsyncSession):
+    return (await db.scalars(select(models.ChunkServer))).all()
+
+async def create_chunk_server(db: AsyncSession, url: str, position: str):
+    await db.execute(insert(models.ChunkServer).values(url=url, position=position, fail_count=0))
+    await db.commit()
+
+async def update_chunk_servers_health(db: AsyncSession, fail_counts: dict, removed_urls: list):
+    # Applies one health sweep in a single transaction
+    if fail_counts:
+        await db.execute(update(models.ChunkServer), [{"url": url, "fail_count": fail_count} for url, fail_count in fail_counts.items()])
+    if removed_urls:
+        await db.execute(delete(models.ChunkServer).where(models.ChunkServer.url.in_(removed_urls)))
+    await db.commit()
+
+async def get_name_mapping(db: AsyncSession, name: str):
+    return await db.scalar(select(models.NameMapping).where(models.NameMapping.full_path == name))
+
+async def create_name_mapping(db: AsyncSession, full_path: str, chunk_digests: bytes, size: int, chunk_lengths: bytes = None):
+    # The mapping and its chunk references are written in one transaction
+    db_name_mapping = await db.scalar(
+        insert(models.NameMapping)
+        .values(
+            full_path=full_path,
+            chunk_digests=chunk_digests,
+            chunk_lengths=chunk_lengths,
+            size=size,
+            parent=models.get_parent_path(full_path)
+        )
+        .returning(models.NameMapping)
     )
-    db.add(db_name_mapping)
-    db.commit()
-    db.refresh(db_name_mapping)
+    await add_chunk_refs(db, chunk_digests)
+    await add_replication_entry(db, "put", full_path, name_mapping=db_name_mapping)
+    await db.commit()
     return db_name_mapping
 
-def rename_name_mapping(db: Session, old_name: str, new_name: str):
-    db_name_mapping = db.query(models.NameMapping).filter(models.NameMapping.full_path == old_name).first()
-    if db_name_mapping:
-        db_name_mapping.full_path = new_name
-        db.commit()
-        db.refresh(db_name_mapping)
+async def rename_name_mapping(db: AsyncSession, old_name: str, new_name: str):
+    db_name_mapping = await db.scalar(
+        update(models.NameMapping)
+        .where(models.NameMapping.full_path == old_name)
+        .values(full_path=new_name, parent=models.get_parent_path(new_name))
+        .returning(models.NameMapping)
+    )
+    if db_name_mapping is not None:
+        await add_replication_entry(db, "rename", old_name, new_path=new_name, name_mapping=db_name_mapping)
+    await db.commit()
     return db_name_mapping
 
-def delete_name_mapping(db: Session, name: str):
-    db_name_mapping = db.query(models.NameMapping).filter(models.NameMapping.full_path == name).first()
-    if db_name_mapping:
-        db.delete(db_name_mapping)
-        db.commit()
-        return True
-    return False
+async def delete_name_mapping(db: AsyncSession, name: str):
+    # Returns the digests of the chunks no file references anymore, or None if the name does not exist.
+    # They are tombstoned until the caller confirms their deletion, see confirm_chunk_deletes.
+    # Pinned chunks are about to be referenced by an upload, they are kept with a refcount of zero.
+    chunk_digests = await db.scalar(
+        delete(models.NameMapping).where(models.NameMapping.full_path == name).returning(models.NameMapping.chunk_digests)
+    )
+    if chunk_digests is None:
+        await db.rollback()
+        return None
+    digests = sorted(set(models.split_chunk_digests(chunk_digests)))
+    for i in range(0, len(digests), REF_BATCH_SIZE):
+        await db.execute(
+            update(models.ChunkRef)
+            .where(models.ChunkRef.digest.in_(digests[i:i + REF_BATCH_SIZE]))
+            .values(refcount=models.ChunkRef.refcount - 1)
+        )
+    now = time.time()
+    orphans = await mark_deleting(db, digests, now)
+    # Also collect chunks left at zero earlier whose upload never referenced them, and chunks whose
+    # deletion was never confirmed
+    unreferenced = await db.scalars(
+        select(models.ChunkRef.digest)
+        .where(models.ChunkRef.refcount <= 0, unpinned(now), not_deleting(now))
+        .limit(REF_BATCH_SIZE)
+    )
+    orphans += await mark_deleting(db, unreferenced.all(), now)
+    await add_replication_entry(db, "delete", name)
+    await db.commit()
+    return orphans
+
+def increment_chunk_refs_statement(dialect_name):
+    statement = (postgresql.insert if dialect_name == "postgresql" else sqlite.insert)(models.ChunkRef)
+    return statement.on_conflict_do_update(
+        index_elements=[models.ChunkRef.digest],
+        set_={"refcount": models.ChunkRef.refcount + statement.excluded.refcount}
+    )
+
+async def add_chunk_refs(db: AsyncSession, chunk_digests: bytes):
+    # A file holds one reference per distinct chunk. Rows are sorted so concurrent
+    # transactions lock them in the same order.
+    digests = sorted(set(models.split_chunk_digests(chunk_digests)))
+    statement = increment_chunk_refs_statement(db.bind.dialect.name)
+    for i in range(0, len(digests), REF_BATCH_SIZE):
+        await db.execute(statement, [{"digest": digest, "refcount": 1} for digest in digests[i:i + REF_BATCH_SIZE]])
+
+def unpinned(now):
+    return or_(models.ChunkRef.pinned_until.is_(None), models.ChunkRef.pinned_until < now)
+
+def not_deleting(now):
+    return or_(models.ChunkRef.deleting_since.is_(None), models.ChunkRef.deleting_since < now - DELETE_FENCE_TTL)
+
+async def mark_deleting(db: AsyncSession, digests, now):
+    # Tombstones the unreferenced chunks among digests and returns them. The pin is checked by the
+    # UPDATE itself, see lease_chunks. Chunks already being deleted are left out.
+    marked = []
+    for i in range(0, len(digests), REF_BATCH_SIZE):
+        marked += await db.scalars(
+            update(models.ChunkRef)
+            .where(
+                models.ChunkRef.digest.in_(digests[i:i + REF_BATCH_SIZE]),
+                models.ChunkRef.refcount <= 0, unpinned(now), not_deleting(now)
+            )
+            .values(deleting_since=now)
+            .returning(models.ChunkRef.digest)
+            .execution_options(synchronize_session=False)
+        )
+    return marked
+
+async def confirm_chunk_deletes(db: AsyncSession, digests, now):
+    # Called once the chunk servers deleted the chunks. Rows nobody uses are removed, chunks an
+    # upload leased in the meantime keep their row without the tombstone.
+    digests = sorted(digests)
+    for i in range(0, len(digests), REF_BATCH_SIZE):
+        batch = digests[i:i + REF_BATCH_SIZE]
+        await db.execute(
+            delete(models.ChunkRef)
+            .where(
+                models.ChunkRef.digest.in_(batch), models.ChunkRef.deleting_since.is_not(None),
+                models.ChunkRef.refcount <= 0, unpinned(now)
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await db.execute(
+            update(models.ChunkRef)
+            .where(models.ChunkRef.digest.in_(batch), models.ChunkRef.deleting_since.is_not(None))
+            .values(deleting_since=None)
+            .execution_options(synchronize_session=False)
+        )
+    await db.commit()
+
+async def get_deleting_chunks(db: AsyncSession, digests, now):
+    # Chunks whose deletion from the chunk servers may still be in progress
+    digests = sorted(set(digests))
+    deleting = []
+    for i in range(0, len(digests), REF_BATCH_SIZE):
+        deleting += await db.scalars(
+            select(models.ChunkRef.digest)
+            .where(models.ChunkRef.digest.in_(digests[i:i + REF_BATCH_SIZE]), ~not_deleting(now))
+        )
+    return deleting
+
+async def lease_chunks(db: AsyncSession, digests, pinned_until: float):
+    # Leases every chunk until pinned_until and returns the ones a file references. Missing chunks
+    # get a row with a refcount of zero, so the copies of an upload that never finishes are
+    # collected like any other unreferenced chunk once the lease ends. Checking and leasing is one
+    # statement, so a concurrent delete either tombstones a row first, and the chunk is reported
+    # missing, or waits for the lease and keeps the row. Leases only ever get extended.
+    digests = sorted(digests)
+    insert_statement = postgresql.insert if db.bind.dialect.name == "postgresql" else sqlite.insert
+    existing = set()
+    for i in range(0, len(digests), REF_BATCH_SIZE):
+        statement = insert_statement(models.ChunkRef).values(
+            [{"digest": digest, "refcount": 0, "pinned_until": pinned_until} for digest in digests[i:i + REF_BATCH_SIZE]]
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[models.ChunkRef.digest],
+            set_={"pinned_until": case(
+                (models.ChunkRef.pinned_until > statement.excluded.pinned_until, models.ChunkRef.pinned_until),
+                else_=statement.excluded.pinned_until
+            )}
+        )
+        rows = await db.execute(statement.returning(models.ChunkRef.digest, models.ChunkRef.refcount))
+        existing.update(digest for digest, refcount in rows if refcount > 0)
+    await db.commit()
+    return existing
+
+def escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+async def list_files_in_folder(db: AsyncSession, folder_path: str, recursive: bool = True, cursor: str = None, limit: int = 1000):
+    # Selects only names and sizes, one page at a time in path order. Recursive listings match
+    # every path under the prefix, otherwise only the files directly inside the folder.
+    path = models.NameMapping.full_path
+    if db.bind.dialect.name == "postgresql":
+        path = path.collate("C")
+    query = select(models.NameMapping.full_path, models.NameMapping.size)
+    if recursive:
+        query = query.where(path.like(escape_like(folder_path) + "%", escape="\\"))
+    else:
+        folder = folder_path.rstrip("/") or folder_path[:1]
+        query = query.where(models.NameMapping.parent == folder)
+    if cursor is not None:
+        query = query.where(path > cursor)
+    rows = (await db.execute(query.order_by(path).limit(limit + 1))).all()
+    next_cursor = rows[limit - 1].full_path if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+async def get_chunk_digests_after(db: AsyncSession, cursor: bytes = None, limit: int = REF_BATCH_SIZE):
+    # Every chunk referenced by a file or leased by an upload, in digest order. An upload leases its
+    # chunks before writing them, see RebalanceJob.rescan_at.
+    query = select(models.ChunkRef.digest)
+    if cursor is not None:
+        query = query.where(models.ChunkRef.digest > cursor)
+    return (await db.scalars(query.order_by(models.ChunkRef.digest).limit(limit))).all()
+
+async def count_chunk_refs(db: AsyncSession):
+    return await db.scalar(select(func.count()).select_from(models.ChunkRef))
+
+async def get_latest_rebalance_job(db: AsyncSession, status: str = None):
+    query = select(models.RebalanceJob)
+    if status is not None:
+        query = query.where(models.RebalanceJob.status == status)
+    return await db.scalar(query.order_by(models.RebalanceJob.id.desc()).limit(1))
+
+async def create_rebalance_job(db: AsyncSession, previous_ring: list, target_ring: list):
+    # The new job starts from the membership the latest job moved chunks to. Running jobs are
+    # superseded: their chunks may still be placed by their sources or targets, so those all
+    # become sources of the new job, which rescans every chunk.
+    latest = await get_latest_rebalance_job(db)
+    source_rings = [previous_ring if latest is None else json.loads(latest.target_ring)]
+    running = (await db.scalars(select(models.RebalanceJob).where(models.RebalanceJob.status == "running"))).all()
+    for job in running:
+        source_rings += json.loads(job.source_rings) + [json.loads(job.target_ring)]
+        job.status = "superseded"
+    # Drop duplicate memberships, placement only depends on the set of servers
+    unique_rings = {json.dumps(sorted(ring, key=lambda server: server["url"])): ring for ring in source_rings}
+    now = time.time()
+    job = models.RebalanceJob(
+        source_rings=json.dumps(list(unique_rings.values())), target_ring=json.dumps(target_ring),
+        status="running", scanned=0, copied=0, deleted=0, failed=0, created_at=now, updated_at=now
+    )
+    db.add(job)
+    await db.commit()
+    return job
+
+async def update_rebalance_job(db: AsyncSession, job_id: int, **values):
+    # Progress is only saved while the job is still running, a superseded job stays superseded
+    await db.execute(
+        update(models.RebalanceJob)
+        .where(models.RebalanceJob.id == job_id, models.RebalanceJob.status == "running")
+        .values(updated_at=time.time(), **values)
+    )
+    await db.commit()
+
+async def add_replication_entry(db: AsyncSession, operation: str, full_path: str, new_path: str = None, name_mapping=None):
+    # Written last in the transaction of the change it describes, right before the commit.
+    # Followers read the log by id, so ids must follow commit order. Postgres hands out ids at
+    # insert, so the entry is inserted under a transaction-level lock released by the commit.
+    # SQLite already runs one write transaction at a time.
+    if db.bind.dialect.name == "postgresql":
+        await db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": REPLICATION_LOCK_KEY})
+    values = {"operation": operation, "full_path": full_path, "new_path": new_path, "created_at": time.time()}
+    if name_mapping is not None:
+        values.update(
+            file_id=name_mapping.id,
+            chunk_digests=name_mapping.chunk_digests,
+            chunk_lengths=name_mapping.chunk_lengths,
+            size=name_mapping.size
+        )
+    await db.execute(insert(models.ReplicationEntry).values(**values))
+
+async def get_replication_entries(db: AsyncSession, after: int, limit: int):
+    query = select(models.ReplicationEntry).where(models.ReplicationEntry.id > after)
+    return (await db.scalars(query.order_by(models.ReplicationEntry.id).limit(limit))).all()
+
+async def get_replication_bounds(db: AsyncSession):
+    # Ids of the oldest and newest retained entries, (None, None) for an empty log
+    return (await db.execute(select(func.min(models.ReplicationEntry.id), func.max(models.ReplicationEntry.id)))).one()
+
+async def trim_replication_log(db: AsyncSession, keep: int):
+    # Keeps the newest entries, followers further behind load a snapshot instead
+    latest = await db.scalar(select(func.max(models.ReplicationEntry.id)))
+    if latest is not None and latest > keep:
+        await db.execute(delete(models.ReplicationEntry).where(models.ReplicationEntry.id <= latest - keep))
+        await db.commit()
+
+async def get_name_mappings_after(db: AsyncSession, after: int, limit: int):
+    # Every name mapping in id order, one page at a time
+    query = select(models.NameMapping).where(models.NameMapping.id > after)
+    return (await db.scalars(query.order_by(models.NameMapping.id).limit(limit))).all()
+
+async def clear_name_mappings(db: AsyncSession):
+    await db.execute(delete(models.NameMapping))
+    await db.commit()
 
-def list_files_in_folder(db: Session, folder_path: str):
-    return db.query(models.NameMapping).filter(models.NameMapping.full_path.like(f"{folder_path}%")).all()
+async def apply_replication_entries(db: AsyncSession, entries: list):
+    # Applies a batch of the primary's log on a follower in one transaction. The chunk
+    # references are left out, followers only serve reads.
+    table = models.NameMapping.__table__
+    for entry in entries:
+        paths = [entry["full_path"]] + ([entry["new_path"]] if entry["new_path"] else [])
+        condition = table.c.full_path.in_(paths)
+        if entry["file_id"] is not None:
+            condition = condition | (table.c.id == entry["file_id"])
+        await db.execute(delete(table).where(condition))
+        if entry["operation"] != "delete":
+            full_path = entry["new_path"] or entry["full_path"]
+            await db.execute(insert(table).values(
+                id=entry["file_id"],
+                full_path=full_path,
+                chunk_digests=entry["chunk_digests"],
+                chunk_lengths=entry["chunk_lengths"],
+                size=entry["size"],
+                parent=models.get_parent_path(full_path)
+            ))
+    await db.commit()
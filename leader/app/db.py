@@ -1,36 +1,159 @@
+import os
 import time
-from sqlalchemy import create_engine, event
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+import asyncio
+from collections import Counter
+from sqlalchemy import event, inspect, select, update, bindparam, text, table, column, Integer, JSON, LargeBinary
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.exc import OperationalError
-from .models import Base
+from sqlalchemy.pool import StaticPool
+from .models import Base, NameMapping, ChunkRef, RebalanceJob, get_parent_path, pack_chunk_hashes, split_chunk_digests
+from .crud import increment_chunk_refs_statement
+from .metrics import Histogram, current_trace
 
-SQLALCHEMY_DATABASE_URL = "postgresql://user:password@db:5432/mydatabase"
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://user:password@db:5432/mydatabase")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # Seconds
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # Seconds
+
+def get_async_url(url):
+    # Plain URLs from the environment are mapped onto the async drivers
+    if url.startswith("postgresql://"):
+        return "postgresql+asyncpg://" + url[len("postgresql://"):]
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://"):]
+    return url
+
+def create_engine(url):
+    url = get_async_url(url)
+    if url.startswith("sqlite"):
+        # SQLite stand-in for local testing, an in-memory database must share one connection
+        if ":memory:" in url or url.endswith("://"):
+            return create_async_engine(url, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        return create_async_engine(url, connect_args={"check_same_thread": False})
+    return create_async_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
 
 engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+db_query_latency = Histogram("db_query_duration_seconds", "Time per database statement", ("operation",))
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started"] = time.perf_counter()
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def record_query_time(conn, cursor, statement, parameters, context, executemany):
+    # Runs in the greenlet of the awaiting task, so the time is added to its trace
+    elapsed = time.perf_counter() - conn.info.pop("query_started", time.perf_counter())
+    db_query_latency.observe(elapsed, operation=statement.lstrip().split(None, 1)[0].upper())
+    trace = current_trace.get()
+    if trace is not None:
+        trace.spans.append(("db", elapsed))
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+def migrate_schema(conn):
+    # create_all only creates missing tables, columns and indexes added later are applied here
+    inspector = inspect(conn)
+    columns = add_missing_columns(conn, inspector, NameMapping.__table__)
+    add_missing_columns(conn, inspector, ChunkRef.__table__)
+    add_missing_columns(conn, inspector, RebalanceJob.__table__)
+    if "chunk_hashes" in columns:
+        migrate_chunk_hashes(conn, "chunk_digests" in columns)
+    for index in NameMapping.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+    table = NameMapping.__table__
+    while rows := conn.execute(select(table.c.id, table.c.full_path).where(table.c.parent.is_(None)).limit(1000)).all():
+        conn.execute(
+            update(table).where(table.c.id == bindparam("row_id")).values(parent=bindparam("row_parent")),
+            [{"row_id": row_id, "row_parent": get_parent_path(full_path)} for row_id, full_path in rows]
+        )
+    backfill_chunk_refs(conn)
+
+def add_missing_columns(conn, inspector, model_table):
+    # Adds nullable columns of the model the table lacks, returns the columns it had
+    columns = {column["name"] for column in inspector.get_columns(model_table.name)}
+    for new_column in model_table.columns:
+        if new_column.name not in columns and new_column.nullable:
+            column_type = new_column.type.compile(dialect=conn.dialect)
+            conn.execute(text(f"ALTER TABLE {model_table.name} ADD COLUMN {new_column.name} {column_type}"))
+    return columns
+
+def migrate_chunk_hashes(conn, has_digests):
+    # Converts the JSON (hash, position) lists of older versions to packed digests in batches,
+    # then drops the JSON column
+    if not has_digests:
+        binary_type = LargeBinary().compile(dialect=conn.dialect)
+        conn.execute(text(f"ALTER TABLE name_mappings ADD COLUMN chunk_digests {binary_type}"))
+    legacy = table(
+        "name_mappings",
+        column("id", Integer),
+        column("chunk_hashes", JSONB().with_variant(JSON(), "sqlite")),
+        column("chunk_digests", LargeBinary)
+    )
+    while rows := conn.execute(select(legacy.c.id, legacy.c.chunk_hashes).where(legacy.c.chunk_digests.is_(None)).limit(1000)).all():
+        conn.execute(
+            update(legacy).where(legacy.c.id == bindparam("row_id")).values(chunk_digests=bindparam("row_digests")),
+            [
+                {"row_id": row_id, "row_digests": pack_chunk_hashes(chunk_hash for chunk_hash, position in chunk_hashes)}
+                for row_id, chunk_hashes in rows
+            ]
+        )
+    conn.execute(text("ALTER TABLE name_mappings DROP COLUMN chunk_hashes"))
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("ALTER TABLE name_mappings ALTER COLUMN chunk_digests SET NOT NULL"))
+    print("Migrated name mappings to packed chunk digests.")
+
+def backfill_chunk_refs(conn):
+    # Counts the references of existing files when the chunk_refs table is new
+    if conn.execute(select(ChunkRef.digest).limit(1)).first() is not None:
+        return
+    table = NameMapping.__table__
+    statement = increment_chunk_refs_statement(conn.dialect.name)
+    last_id = None
+    while True:
+        query = select(table.c.id, table.c.chunk_digests).order_by(table.c.id).limit(500)
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+        rows = conn.execute(query).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        refs = Counter()
+        for row_id, chunk_digests in rows:
+            refs.update(set(split_chunk_digests(chunk_digests)))
+        if refs:
+            conn.execute(statement, [{"digest": digest, "refcount": refcount} for digest, refcount in refs.items()])
 
 max_retries = 60
 retry_interval = 1
 
-for i in range(max_retries):
-    try:
-        # Create all tables
-        Base.metadata.create_all(bind=engine)
-        print("Database connected and tables created.")
-        break
-    except OperationalError as e:
-        print(f"Database connection failed: {e}")
-        if i < max_retries - 1:
-            print(f"Retrying in {retry_interval} seconds...")
-            time.sleep(retry_interval)
-        else:
-            print("Max retries reached. Exiting.")
-            raise
+async def init_db():
+    for i in range(max_retries):
+        try:
+            # Create all tables
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.run_sync(migrate_schema)
+            print("Database connected and tables created.")
+            return
+        except (OperationalError, OSError) as e:
+            print(f"Database connection failed: {e}")
+            if i < max_retries - 1:
+                print(f"Retrying in {retry_interval} seconds...")
+                await asyncio.sleep(retry_interval)
+            else:
+                print("Max retries reached. Exiting.")
+                raise
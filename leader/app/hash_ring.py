@@ -0,0 +1,66 @@
+import os
+import bisect
+import hashlib
+
+# Same placement as the user service, the rebalancer moves chunks to where users look for them
+REPLICAS = int(os.getenv("REPLICAS", 3))
+# Extra ring points per server. The leader and every user instance must use the same value,
+# otherwise they disagree on chunk placement. 1 keeps only the position assigned by the leader.
+HASH_RING_VNODES = int(os.getenv("HASH_RING_VNODES", 1))
+
+
+def chunk_position(chunk_hash):
+    return int.from_bytes(hashlib.md5(chunk_hash.encode('utf-8')).digest(), "big")
+
+
+def vnode_position(url, vnode):
+    return int.from_bytes(hashlib.md5(f"{url}#{vnode}".encode('utf-8')).digest(), "big")
+
+
+# Built once per topology snapshot. Positions are parsed and sorted up front and the
+# replica list of every arc of the ring is precomputed, so placing a chunk is one bisect.
+class HashRing:
+    def __init__(self, chunk_servers, vnodes=HASH_RING_VNODES, replicas=REPLICAS):
+        self.chunk_servers = chunk_servers
+        points = []
+        for server in chunk_servers:
+            points.append((int(server['position']), server['url'], server))
+            for vnode in range(1, vnodes):
+                points.append((vnode_position(server['url'], vnode), server['url'], server))
+        points.sort(key=lambda point: (point[0], point[1]))
+        self.positions = [position for position, url, server in points]
+        self.replica_sets = [self._walk(points, i, replicas) for i in range(len(points))]
+
+    @staticmethod
+    def _walk(points, start, replicas):
+        servers = []
+        seen = set()
+        for i in range(len(points)):
+            position, url, server = points[(start + i) % len(points)]
+            if url in seen:
+                continue
+            seen.add(url)
+            if server['fail_count'] == 0:
+                servers.append(server)
+            if len(servers) == replicas:
+                break
+        return servers
+
+    def __len__(self):
+        return len(self.chunk_servers)
+
+    def place_position(self, position):
+        if not self.positions:
+            return []
+        return self.replica_sets[bisect.bisect(self.positions, position) % len(self.positions)]
+
+    def place(self, chunk_hash):
+        return self.place_position(chunk_position(chunk_hash))
+
+    def place_many(self, chunk_hashes):
+        if not self.positions:
+            return [[] for chunk_hash in chunk_hashes]
+        positions = self.positions
+        replica_sets = self.replica_sets
+        count = len(positions)
+        return [replica_sets[bisect.bisect(positions, chunk_position(chunk_hash)) % count] for chunk_hash in chunk_hashes]
@@ -0,0 +1,35 @@
+import os
+import httpx
+from app.metrics import TRACE_HEADER, trace_id
+
+# One keep-alive connection pool per process for the calls to the chunk servers
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 256))
+HTTP_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_KEEPALIVE_CONNECTIONS", 64))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30))  # Seconds
+# Default for a single request, calls with their own limits pass a timeout
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 60))  # Seconds
+
+client = None
+
+async def add_trace_header(request):
+    # Requests made while handling a request carry its trace ID
+    current = trace_id()
+    if current is not None:
+        request.headers[TRACE_HEADER] = current
+
+def get_client():
+    global client
+    if client is None:
+        limits = httpx.Limits(
+            max_connections=HTTP_POOL_SIZE,
+            max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_TIMEOUT
+        )
+        client = httpx.AsyncClient(limits=limits, timeout=HTTP_TIMEOUT, event_hooks={"request": [add_trace_header]})
+    return client
+
+async def close_client():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
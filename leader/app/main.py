@@ -1,12 +1,32 @@
 from fastapi import FastAPI
 import uvicorn
-from app.controllers import chunk_server, name_mappings, file_operations
+from app.controllers import chunk_server, chunks, name_mappings, file_operations, rebalance, replication
+from app.db import init_db, engine
+from app.http_client import close_client
+from app import metrics
 
 app = FastAPI()
+app.middleware("http")(metrics.trace_requests)
+if replication.FOLLOWER:
+    app.middleware("http")(replication.follower_only_reads)
+
+# Registered before the routers so the tables exist when their startup handlers run
+@app.on_event("startup")
+async def startup_event():
+    await init_db()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_client()
+    await engine.dispose()
 
 app.include_router(chunk_server.router)
+app.include_router(chunks.router)
 app.include_router(name_mappings.router)
 app.include_router(file_operations.router)
+app.include_router(rebalance.router)
+app.include_router(replication.router)
+app.include_router(metrics.router)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
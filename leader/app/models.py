@@ -1,6 +1,10 @@
-from sqlalchemy import Column, Integer, String, ARRAY
+import sys
+import array
+import hashlib
+import itertools
+import posixpath
+from sqlalchemy import Column, Integer, String, LargeBinary, Float, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import JSONB
 
 Base = declarative_base()
 
@@ -8,12 +12,114 @@ class NameMapping(Base):
     __tablename__ = 'name_mappings'
     id = Column(Integer, primary_key=True, index=True)
     full_path = Column(String, unique=True, index=True)
-    chunk_hashes = Column(JSONB, nullable=False)
+    # MD5 digests of the chunks in file order, 16 bytes each. Ring positions are derived from
+    # the hashes, so they are not stored.
+    chunk_digests = Column(LargeBinary, nullable=False)
+    # Big-endian 32-bit length of every chunk, NULL when the file was split at a fixed chunk size
+    chunk_lengths = Column(LargeBinary)
     size = Column(Integer, nullable=False)
+    # Folder the file lives in, used to list the direct children of a folder
+    parent = Column(String)
+
+    @property
+    def chunk_hashes(self):
+        return get_chunk_hash_positions(self.chunk_digests)
+
+# Listings order and page by full_path in byte order ("C" collation), which lets these indexes
+# serve prefix matches, direct-children lookups and cursor pagination without sorting
+Index("ix_name_mappings_full_path_c", NameMapping.full_path.collate("C")).ddl_if(dialect="postgresql")
+Index("ix_name_mappings_parent_full_path_c", NameMapping.parent, NameMapping.full_path.collate("C")).ddl_if(dialect="postgresql")
+Index("ix_name_mappings_parent_full_path", NameMapping.parent, NameMapping.full_path).ddl_if(dialect="sqlite")
+
+def get_parent_path(full_path):
+    return posixpath.dirname(full_path)
+
+DIGEST_SIZE = 16
+LENGTH_SIZE = 4
+
+def pack_chunk_hashes(chunk_hashes):
+    return b"".join(bytes.fromhex(chunk_hash) for chunk_hash in chunk_hashes)
+
+def split_chunk_digests(chunk_digests):
+    return [chunk_digests[i:i + DIGEST_SIZE] for i in range(0, len(chunk_digests), DIGEST_SIZE)]
+
+def unpack_chunk_digests(chunk_digests):
+    return [digest.hex() for digest in split_chunk_digests(chunk_digests)]
+
+def get_chunk_offsets(chunk_lengths):
+    # Start offset of every chunk
+    lengths = array.array("I", chunk_lengths)
+    if sys.byteorder == "little":
+        lengths.byteswap()
+    return array.array("Q", itertools.accumulate(lengths, initial=0))[:-1]
+
+def chunk_position(chunk_hash):
+    return int.from_bytes(hashlib.md5(chunk_hash.encode('utf-8')).digest(), "big")
+
+def get_chunk_hash_positions(chunk_digests):
+    # (hash, ring position) pairs, the chunk list format of the JSON endpoints
+    return [(chunk_hash, chunk_position(chunk_hash)) for chunk_hash in unpack_chunk_digests(chunk_digests)]
+
+class ChunkRef(Base):
+    __tablename__ = "chunk_refs"
+
+    digest = Column(LargeBinary, primary_key=True)
+    # Number of files referencing the chunk. Rows at zero are chunks kept for an upload in progress.
+    refcount = Column(Integer, nullable=False)
+    # Uploads that checked the chunk lease it until this time, it is not deleted before
+    pinned_until = Column(Float)
+    # Set when the chunk was handed out for deletion from the chunk servers, cleared once the
+    # deletion is confirmed. Uploads of the chunk wait for it, see crud.DELETE_FENCE_TTL.
+    deleting_since = Column(Float)
+
+Index(
+    "ix_chunk_refs_unreferenced", ChunkRef.digest,
+    postgresql_where=ChunkRef.refcount <= 0, sqlite_where=ChunkRef.refcount <= 0
+)
 
 class ChunkServer(Base):
     __tablename__ = "chunk_servers"
 
     url = Column(String, primary_key=True)
     position = Column(String)
-    fail_count = Column(Integer, default=0)
\ No newline at end of file
+    fail_count = Column(Integer, default=0)
+
+
+class RebalanceJob(Base):
+    __tablename__ = "rebalance_jobs"
+
+    id = Column(Integer, primary_key=True)
+    # JSON lists of {"url", "position"}: the memberships chunks may still be placed by,
+    # and the membership they are moved to
+    source_rings = Column(Text, nullable=False)
+    target_ring = Column(Text, nullable=False)
+    # "running", "done" or "superseded" by a later membership change
+    status = Column(String, nullable=False)
+    # Last chunk digest processed, the job resumes after it
+    cursor = Column(LargeBinary)
+    # Start of the second scan, set once the first one is done. Uploads in flight during the
+    # membership change place chunks by the old ring and may write them after the first scan.
+    rescan_at = Column(Float)
+    scanned = Column(Integer, nullable=False, default=0)
+    copied = Column(Integer, nullable=False, default=0)
+    deleted = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    created_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+
+class ReplicationEntry(Base):
+    __tablename__ = "replication_log"
+
+    # Followers replay the entries in id order
+    id = Column(Integer, primary_key=True)
+    # "put", "rename" or "delete". Entries carry the resulting mapping, so replaying one twice,
+    # or over a snapshot taken after it, leaves the same state.
+    operation = Column(String, nullable=False)
+    full_path = Column(String, nullable=False)
+    # Target of a rename
+    new_path = Column(String)
+    file_id = Column(Integer)
+    chunk_digests = Column(LargeBinary)
+    chunk_lengths = Column(LargeBinary)
+    size = Column(Integer)
+    created_at = Column(Float, nullable=False)
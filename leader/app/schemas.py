@@ -1,4 +1,4 @@
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from pydantic import BaseModel
 
 class NameMappingBase(BaseModel):
@@ -15,3 +15,19 @@ class NameMapping(NameMappingBase):
 
     class Config:
         orm_mode = True
+
+class ChunkServerHeartbeat(BaseModel):
+    url: str
+    chunk_count: int
+    pending_count: int = 0
+    free_disk: int
+    request_rate: float
+    compression_ratio: float = 1.0
+
+class FileEntry(BaseModel):
+    full_path: str
+    size: int
+
+class FileListing(BaseModel):
+    files: List[FileEntry]
+    next_cursor: Optional[str] = None
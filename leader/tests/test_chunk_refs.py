@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import time
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from app import crud, models
+
+
+def digest(name):
+    return hashlib.md5(name.encode()).digest()
+
+
+def run(tmp_path, test):
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/leader.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
+        try:
+            await test(async_sessionmaker(engine, expire_on_commit=False))
+        finally:
+            await engine.dispose()
+    asyncio.run(main())
+
+
+async def refcount(sessions, chunk):
+    async with sessions() as db:
+        return await db.scalar(select(models.ChunkRef.refcount).where(models.ChunkRef.digest == chunk))
+
+
+def test_upload_waits_for_the_deletion_of_its_chunks(tmp_path):
+    # A file's last chunk is handed out for deletion while another upload of it checks which chunks
+    # are missing. The upload must not commit until the chunk servers confirmed the deletion.
+    x = digest("x")
+
+    async def test(sessions):
+        async with sessions() as db:
+            await crud.create_name_mapping(db, "a", x, 1)
+        async with sessions() as db:
+            assert await crud.delete_name_mapping(db, "a") == [x]
+
+        async with sessions() as db:
+            assert await crud.lease_chunks(db, [x], time.time() + 600) == set()
+        async with sessions() as db:
+            assert await crud.get_deleting_chunks(db, [x], time.time()) == [x]
+        # A second delete does not hand the chunk out again while its deletion is in progress
+        async with sessions() as db:
+            await crud.create_name_mapping(db, "b", digest("y"), 1)
+        async with sessions() as db:
+            assert await crud.delete_name_mapping(db, "b") == [digest("y")]
+
+        async with sessions() as db:
+            await crud.confirm_chunk_deletes(db, [x, digest("y")], time.time())
+        async with sessions() as db:
+            assert await crud.get_deleting_chunks(db, [x], time.time()) == []
+        # The upload's lease keeps the row, the other one is gone
+        assert await refcount(sessions, x) == 0
+        assert await refcount(sessions, digest("y")) is None
+
+        async with sessions() as db:
+            await crud.create_name_mapping(db, "c", x, 1)
+        assert await refcount(sessions, x) == 1
+        async with sessions() as db:
+            assert await crud.lease_chunks(db, [x], time.time() + 600) == {x}
+
+    run(tmp_path, test)
+
+
+def test_unconfirmed_deletion_is_handed_out_again(tmp_path, monkeypatch):
+    x = digest("x")
+
+    async def test(sessions):
+        async with sessions() as db:
+            await crud.create_name_mapping(db, "a", x, 1)
+            await crud.create_name_mapping(db, "b", digest("y"), 1)
+        async with sessions() as db:
+            assert await crud.delete_name_mapping(db, "a") == [x]
+        monkeypatch.setattr(crud, "DELETE_FENCE_TTL", 0)
+        async with sessions() as db:
+            assert await crud.get_deleting_chunks(db, [x], time.time()) == []
+        async with sessions() as db:
+            assert sorted(await crud.delete_name_mapping(db, "b")) == sorted([x, digest("y")])
+
+    run(tmp_path, test)
+
+
+def test_chunks_of_a_failed_upload_are_collected(tmp_path):
+    # The upload wrote its missing chunks and failed before its name mapping was finalized
+    x = digest("x")
+
+    async def test(sessions):
+        async with sessions() as db:
+            assert await crud.lease_chunks(db, [x, digest("z")], time.time() + 600) == set()
+        async with sessions() as db:
+            await crud.create_name_mapping(db, "a", digest("y"), 1)
+        async with sessions() as db:
+            assert await crud.delete_name_mapping(db, "a") == [digest("y")]
+
+        # Once the lease of x ended, the next delete returns it
+        async with sessions() as db:
+            await db.execute(update(models.ChunkRef).where(models.ChunkRef.digest == x).values(pinned_until=time.time() - 1))
+            await db.commit()
+        async with sessions() as db:
+            await crud.create_name_mapping(db, "b", digest("w"), 1)
+        async with sessions() as db:
+            assert sorted(await crud.delete_name_mapping(db, "b")) == sorted([digest("w"), x])
+        assert await refcount(sessions, digest("z")) == 0
+
+    run(tmp_path, test)
@@ -1,36 +1,136 @@
-from fastapi import APIRouter, HTTPException, Query
-import requests
+from fastapi import APIRouter, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from collections import deque
 import os
-import aiohttp
-from app.utils.chunk_utils import get_chunk_server_positions, fetch_chunk_with_retries, delete_chunks_from_servers
+import asyncio
+from app.utils.chunk_utils import CHUNK_SIZE, fetch_chunks, delete_chunks_from_servers
+from app.utils.leader_utils import get_topology, get_chunk_list, get_chunk_range, delete_file_mapping, confirm_chunk_deletes, range_not_satisfiable
+from app.utils.chunk_cache import chunk_cache
+from app.utils.http_client import get_session
+from app.utils import compression
+from app.utils.replica_latency import latency_tracker
+from app.utils.metrics import Counter, span
 
 router = APIRouter()
 
+# Streaming reads keep up to this many chunks in flight ahead of the client, fetched in groups
+READ_PREFETCH_WINDOW = int(os.getenv("READ_PREFETCH_WINDOW", 2048))
+READ_STREAM_GROUP_SIZE = int(os.getenv("READ_STREAM_GROUP_SIZE", 128))
+
+bytes_served = Counter("bytes_served_total", "File bytes returned to clients")
+
+# parse_range result for a range that selects no bytes
+UNSATISFIABLE = object()
+
+def parse_range(range_header):
+    # Returns (offset, length) for a single "bytes=" range, None for anything else,
+    # in which case the header is ignored and the whole file is returned.
+    # An empty suffix range ("bytes=-0") selects no bytes, UNSATISFIABLE is returned for it.
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            if int(last) == 0:
+                return UNSATISFIABLE
+            return -int(last), None
+        if not last:
+            return int(first), None
+        if int(last) < int(first):
+            return None
+        return int(first), int(last) - int(first) + 1
+    except ValueError:
+        return None
+
+async def read_chunks(session, chunk_hashes):
+    # Serve what we can from the chunk cache, fetch the rest in batches grouped by server
+    # and reassemble them in file order
+    ring = (await get_topology()).ring
+    with span("fetch_chunks"):
+        chunks = await chunk_cache.get_many(chunk_hashes, lambda missing: fetch_chunks(session, ring, missing))
+    return b"".join(chunks[chunk_hash] for chunk_hash in chunk_hashes)
+
+async def stream_chunks(chunk_hashes, skip, length):
+    # Emits the file in order while later groups are already being fetched. At most
+    # READ_PREFETCH_WINDOW chunks are held at a time, whatever the size of the file.
+    group_size = READ_STREAM_GROUP_SIZE
+    window = max(1, READ_PREFETCH_WINDOW // group_size)
+    pending = deque()
+    next_group = 0
+    session = get_session()
+    try:
+        while pending or next_group < len(chunk_hashes):
+            while next_group < len(chunk_hashes) and len(pending) < window:
+                group = chunk_hashes[next_group:next_group + group_size]
+                pending.append(asyncio.ensure_future(read_chunks(session, group)))
+                next_group += group_size
+            # Only the first group starts before the requested offset
+            data = (await pending.popleft())[skip:skip + length]
+            skip = 0
+            length -= len(data)
+            bytes_served.inc(len(data))
+            yield data
+    finally:
+        for task in pending:
+            task.cancel()
+
 @router.get("/readfile/")
 async def read_file_by_name(
     full_path: str = Query(..., description="The full path of the file to read"),
-    save_as: str = Query(None, description="The name of the file to save the text as")
+    save_as: str = Query(None, description="The name of the file to save the text as"),
+    offset: int = Query(None, description="First byte to read, negative values count from the end of the file"),
+    length: int = Query(None, ge=0, description="Number of bytes to read, to the end of the file if omitted"),
+    stream: bool = Query(False, description="Stream the raw bytes as they arrive instead of returning JSON"),
+    range_header: str = Header(None, alias="Range")
 ):
-    # Get chunk information from the leader
-    response = requests.get(f"{os.getenv('LEADER_URL')}/namemappings/{full_path}")
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail="Error fetching file info")
+    if offset is None and length is None and range_header:
+        parsed = parse_range(range_header)
+        if parsed is UNSATISFIABLE:
+            # The 416 carries the file size, like those of the leader
+            chunk_range = await get_chunk_range(get_session(), full_path, 0, 0, CHUNK_SIZE)
+            raise range_not_satisfiable(chunk_range.file_size)
+        offset, length = parsed or (None, None)
+    ranged = offset is not None or length is not None
 
-    file_info = response.json()
-    chunk_hashes = file_info['chunk_hashes']
+    if stream:
+        if save_as:
+            raise HTTPException(status_code=400, detail="save_as is not supported for streaming reads")
+        session = get_session()
+        chunk_range = await get_chunk_range(session, full_path, offset or 0, length, CHUNK_SIZE)
+        size = chunk_range.end - chunk_range.start
+        skip = chunk_range.start - chunk_range.first_offset
+        headers = {"Accept-Ranges": "bytes", "Content-Length": str(size)}
+        if ranged and size:
+            headers["Content-Range"] = f"bytes {chunk_range.start}-{chunk_range.end - 1}/{chunk_range.file_size}"
+        return StreamingResponse(
+            stream_chunks(chunk_range.chunk_hashes, skip, size),
+            status_code=206 if "Content-Range" in headers else 200,
+            media_type="application/octet-stream",
+            headers=headers
+        )
 
-    # Get the list of chunk servers
-    chunk_servers = requests.get(f"{os.getenv('LEADER_URL')}/chunk_servers/").json()
+    if ranged:
+        # Only the chunks covering the range are looked up and fetched, the response holds the exact bytes
+        session = get_session()
+        chunk_range = await get_chunk_range(session, full_path, offset, length, CHUNK_SIZE)
+        data = await read_chunks(session, chunk_range.chunk_hashes)
+        skip = chunk_range.start - chunk_range.first_offset
+        data = data[skip:skip + chunk_range.end - chunk_range.start]
+        bytes_served.inc(len(data))
+        headers = {"Accept-Ranges": "bytes"}
+        if data:
+            headers["Content-Range"] = f"bytes {chunk_range.start}-{chunk_range.end - 1}/{chunk_range.file_size}"
+        return Response(content=data, status_code=206 if data else 200, media_type="application/octet-stream", headers=headers)
 
-    # Organize chunks by server
-    file_data = bytearray()
-    async with aiohttp.ClientSession() as session:
-        for chunk_hash, position in chunk_hashes:
-            servers = get_chunk_server_positions(chunk_hash, chunk_servers)
-            chunk_data = await fetch_chunk_with_retries(session, servers, chunk_hash)
-            file_data.extend(chunk_data)
+    session = get_session()
+    # Get the packed chunk list from the leader
+    chunk_hashes, file_size = await get_chunk_list(session, full_path)
+    file_data = await read_chunks(session, chunk_hashes)
 
-    file_text = file_data.decode('utf-8')
+    bytes_served.inc(len(file_data))
+    with span("decode"):
+        file_text = file_data.decode('utf-8')
 
     if save_as:
         # Save to file
@@ -41,26 +141,32 @@ async def read_file_by_name(
     
     return {"file_data": file_text}
 
+@router.get("/chunk_cache/stats")
+async def get_chunk_cache_stats():
+    return chunk_cache.get_stats()
+
+@router.get("/stats/compression")
+async def get_compression_stats():
+    return compression.get_stats()
+
+@router.get("/stats/reads")
+async def get_read_stats():
+    return latency_tracker.get_stats()
+
 @router.delete("/namemappings/{full_path:path}")
 async def delete_name_mapping(full_path: str):
-    # Get chunk information from the leader
-    response = requests.get(f"{os.getenv('LEADER_URL')}/namemappings/{full_path}")
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail="Error fetching file info")
-
-    file_info = response.json()
-    chunk_hashes = file_info['chunk_hashes']
-
-    # Get the list of chunk servers
-    chunk_servers = requests.get(f"{os.getenv('LEADER_URL')}/chunk_servers/").json()
-
-    # Delete chunks from the servers
-    async with aiohttp.ClientSession() as session:
-        await delete_chunks_from_servers(session, chunk_servers, chunk_hashes)
-
-    # Delete the name mapping from the leader
-    response = requests.delete(f"{os.getenv('LEADER_URL')}/namemappings/{full_path}")
-    if response.status_code == 200:
-        return {"message": "Name and associated chunks deleted successfully"}
-    else:
-        raise HTTPException(status_code=response.status_code, detail="Error deleting name mapping")
+    session = get_session()
+    # Delete the name mapping on the leader, which returns the chunks no other file references
+    orphaned_chunks = await delete_file_mapping(session, full_path)
+
+    # Get the cached chunk server topology
+    ring = (await get_topology()).ring
+
+    # Only unreferenced chunks are deleted from the servers. The leader keeps them as tombstones
+    # until the deletion is confirmed, a failed deletion is handed out again later.
+    with span("delete_chunks"):
+        await delete_chunks_from_servers(session, ring, orphaned_chunks)
+        if orphaned_chunks:
+            await confirm_chunk_deletes(session, orphaned_chunks)
+
+    return {"message": "Name and associated chunks deleted successfully"}
@@ -1,101 +1,112 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Query
+from fastapi import APIRouter, HTTPException, Query, Request
 from collections import defaultdict
 from typing import List, Dict
 import os
-import aiohttp
-from aiohttp import FormData
-from app.utils.chunk_utils import hash_chunk, get_chunk_server_positions, delete_chunks_from_servers
-from app.utils.leader_utils import get_leader_chunk_servers
-import requests
-import hashlib
+from app.utils.chunk_utils import CHUNK_SIZE, finalize_chunks_on_servers, abort_transactions_on_servers
+from app.utils.leader_utils import get_topology, read_from_leader
+from app.utils.upload_utils import MultipartUpload, stream_chunks_to_servers
+from app.utils.chunkers import create_chunker
+from app.utils.http_client import get_session
+from app.utils.metrics import Counter, span
 import asyncio
+import time
 
 router = APIRouter()
 
-CHUNK_SIZE = 1024
 MAX_CHUNKS_PER_REQUEST = 2000
+# Longest wait for the deletion of chunks the upload wrote again, the leader hands them out for
+# deletion again after DELETE_FENCE_TTL
+DELETE_WAIT = float(os.getenv("DELETE_WAIT", 300))  # Seconds
 
-@router.post("/uploadfile/")
-async def upload_file(file: UploadFile = File(...), name: str = Form(...), path: str = Form(...)):
-    file_location = f"/tmp/{file.filename}"
-    with open(file_location, "wb") as f:
-        f.write(file.file.read())
+bytes_uploaded = Counter("bytes_uploaded_total", "File bytes received from clients")
 
-    file_size = os.path.getsize(file_location)
+UPLOAD_FORM = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "file": {"type": "string", "format": "binary"},
+                        "name": {"type": "string"},
+                        "path": {"type": "string"},
+                    },
+                    "required": ["file", "name", "path"],
+                }
+            }
+        },
+    }
+}
 
-    # Get the list of chunk servers from the leader
-    chunk_servers = get_leader_chunk_servers()
+@router.post("/uploadfile/", openapi_extra=UPLOAD_FORM)
+async def upload_file(request: Request):
+    # Get the cached chunk server topology, refreshed in the background when the leader reports a change
+    ring = (await get_topology()).ring
 
-    chunk_hashes = []
-    chunk_positions = []
-    server_chunks = defaultdict(list)
-    
-    with open(file_location, 'rb') as f:
-        while chunk := f.read(CHUNK_SIZE):
-            chunk_hash = hash_chunk(chunk)
-            position = str(int(hashlib.md5(chunk_hash.encode('utf-8')).hexdigest(), 16))
-            chunk_hashes.append(chunk_hash)
-            chunk_positions.append((chunk_hash, position))
+    # Stream the request body to the chunk servers in pending mode while it is being received
+    session = get_session()
+    upload = MultipartUpload(request)
+    with span("upload_chunks"):
+        chunk_digests, chunk_lengths, file_size, server_hashes, transactions = await stream_chunks_to_servers(
+            session, upload.blocks(), ring, create_chunker(CHUNK_SIZE), MAX_CHUNKS_PER_REQUEST
+        )
+    name, path = upload.fields.get("name"), upload.fields.get("path")
+    if not upload.has_file or name is None or path is None:
+        asyncio.create_task(abort_transactions_on_servers(session, transactions))
+        raise HTTPException(status_code=422, detail="The form needs a file, a name and a path")
+    bytes_uploaded.inc(file_size)
 
-            servers = get_chunk_server_positions(chunk_hash, chunk_servers)
-            for server in servers:
-                server_chunks[server['url']].append((chunk, chunk_hash))
+    # Notify the leader about the new file and its packed chunk list as temporary.
+    # Variable-size chunks are followed by their lengths.
+    params = {"full_path": os.path.join(path, name), "size": file_size}
+    if chunk_lengths is not None:
+        params["lengths"] = "true"
+    # The leader answers 409 while some of the chunks are being deleted. The upload waits for the
+    # deletion, so its own copies are committed after the delete requests.
+    with span("leader_temp_mapping"):
+        deadline = time.monotonic() + DELETE_WAIT
+        while True:
+            async with session.post(
+                f"{os.getenv('LEADER_URL')}/temp_namemappings_binary/",
+                params=params,
+                data=chunk_digests + (chunk_lengths or b""),
+                headers={"Content-Type": "application/octet-stream"}
+            ) as response:
+                if response.status == 200:
+                    break
+                if response.status != 409 or time.monotonic() >= deadline:
+                    asyncio.create_task(abort_transactions_on_servers(session, transactions))
+                    raise HTTPException(status_code=response.status, detail="Error creating temporary name mapping")
+                retry_after = float(response.headers.get("Retry-After", 1))
+            await asyncio.sleep(retry_after)
 
-    async with aiohttp.ClientSession() as session:
-        for server_url, chunks in server_chunks.items():
-            for i in range(0, len(chunks), MAX_CHUNKS_PER_REQUEST):
-                batch_chunks = chunks[i:i + MAX_CHUNKS_PER_REQUEST]
-                url = f"{server_url}/store_chunks_pending/"
-                data = [
-                    {"data": chunk.decode('utf-8'), "chunk_hash": chunk_hash} for chunk, chunk_hash in batch_chunks
-                ]
-                async with session.post(url, json=data) as response:
-                    if response.status != 200:
-                        raise Exception(f"Failed to store chunks on server {server_url}, status code: {response.status}")
-
-
-    # Notify the leader about the new file and its chunks as temporary
-    name_mapping = {"full_path": os.path.join(path, name), "chunk_hashes": chunk_positions, "size": file_size}
-    response = requests.post(f"{os.getenv('LEADER_URL')}/temp_namemappings/", json=name_mapping)
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail="Error creating temporary name mapping")
-
-    # Finalize chunks on the servers
-    successfully_finalized_chunks = []
-    try:
-        async with aiohttp.ClientSession() as session:
-            for chunk_hash, position in chunk_positions:
-                servers = get_chunk_server_positions(chunk_hash, chunk_servers)
-                for server in servers:
-                    url = f"{server['url']}/finalize_chunks/"
-                    async with session.post(url, json={"chunks": [chunk_hash]}) as response:
-                        if response.status == 200:
-                                successfully_finalized_chunks.append((server['url'], chunk_hash))
-                        else:
-                            raise Exception(f"Failed to finalize chunk on server {server['url']}")
-    except Exception as e:
-    # Rollback finalized chunks if any finalization fails
-        async def rollback():
-            async with aiohttp.ClientSession() as session:
-                await delete_chunks_from_servers(session, chunk_servers, successfully_finalized_chunks)
-                
-        asyncio.create_task(rollback())
-        raise HTTPException(status_code=500, detail=str(e))
-    
+    # Finalize chunks on the servers, one commit per server for servers holding the upload as a transaction
+    with span("finalize_chunks"):
+        finalized_servers, failed_servers = await finalize_chunks_on_servers(session, server_hashes, transactions)
+    if failed_servers:
+        # Only the upload's own pending copies are dropped. Chunks are never deleted by hash here,
+        # another upload of the same content may reference them. Copies already committed are
+        # leased on the leader with a reference count of zero since /chunks/missing/, a delete
+        # returns them for deletion once the lease ends.
+        asyncio.create_task(abort_transactions_on_servers(
+            session, {url: transaction for url, transaction in transactions.items() if url not in finalized_servers}
+        ))
+        raise HTTPException(status_code=500, detail="; ".join(failed_servers.values()))
 
     # Finalize name mapping on the leader
-    response = requests.post(f"{os.getenv('LEADER_URL')}/finalize_namemappings/", params={"full_path": os.path.join(path, name)})
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail="Error finalizing name mapping")
+    with span("leader_finalize"):
+        async with session.post(f"{os.getenv('LEADER_URL')}/finalize_namemappings/", params={"full_path": os.path.join(path, name)}) as response:
+            if response.status != 200:
+                raise HTTPException(status_code=response.status, detail="Error finalizing name mapping")
 
-    os.remove(file_location)  # Cleanup the temporary file
     return {"message": "File uploaded and processed successfully"}
 
 @router.get("/filesize/")
 async def get_file_size(full_path: str = Query(..., description="The full path of the file to get the size of")):
     # Get the file size from the leader
-    response = requests.get(f"{os.getenv('LEADER_URL')}/file/{full_path}/size")
-    if response.status_code == 200:
-        return {"file_size": str(response.json()) + " bytes"}
-    else:
-        raise HTTPException(status_code=response.status_code, detail="Error fetching file size")
+    async with read_from_leader(get_session(), f"/file/{full_path}/size") as response:
+        if response.status == 200:
+            return {"file_size": str(await response.json()) + " bytes"}
+        else:
+            raise HTTPException(status_code=response.status, detail="Error fetching file size")
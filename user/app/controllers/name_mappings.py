@@ -1,17 +1,18 @@
 from fastapi import APIRouter, HTTPException, Query
-import requests
 import os
+from app.utils.http_client import get_session
+from app.utils.leader_utils import read_from_leader
 from typing import List, Dict
 
 router = APIRouter()
 
 @router.get("/namemappings/{full_path:path}", response_model=Dict)
 async def get_name_mapping(full_path: str):
-    response = requests.get(f"{os.getenv('LEADER_URL')}/namemappings/{full_path}")
-    if response.status_code == 200:
-        return response.json()
-    else:
-        raise HTTPException(status_code=response.status_code, detail="Error getting name mapping")
+    async with read_from_leader(get_session(), f"/namemappings/{full_path}") as response:
+        if response.status == 200:
+            return await response.json()
+        else:
+            raise HTTPException(status_code=response.status, detail="Error getting name mapping")
 
 @router.put("/namemappings/")
 async def rename_name_mapping(
@@ -19,17 +20,24 @@ async def rename_name_mapping(
     new_path: str = Query(..., description="The new full path of the name mapping")
 ):
     params = {'old_path': old_path, 'new_path': new_path}
-    response = requests.put(f"{os.getenv('LEADER_URL')}/namemappings/", params=params)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        raise HTTPException(status_code=response.status, detail="Error renaming name mapping")
+    async with get_session().put(f"{os.getenv('LEADER_URL')}/namemappings/", params=params) as response:
+        if response.status == 200:
+            return await response.json()
+        else:
+            raise HTTPException(status_code=response.status, detail="Error renaming name mapping")
 
 @router.get("/listfiles/")
-async def list_files_in_folder(folder_path: str = Query(..., description="The path of the folder to list files from")):
-    params = {'folder_path': folder_path}
-    response = requests.get(f"{os.getenv('LEADER_URL')}/listfiles/", params=params)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        raise HTTPException(status_code=response.status, detail="Error listing files")
+async def list_files_in_folder(
+    folder_path: str = Query(..., description="The path of the folder to list files from"),
+    recursive: bool = Query(True, description="List every file under the folder, not only its direct children"),
+    cursor: str = Query(None, description="next_cursor of the previous page"),
+    limit: int = Query(1000, description="Maximum number of files per page")
+):
+    params = {'folder_path': folder_path, 'recursive': str(recursive).lower(), 'limit': limit}
+    if cursor is not None:
+        params['cursor'] = cursor
+    async with read_from_leader(get_session(), "/listfiles/", params=params) as response:
+        if response.status == 200:
+            return await response.json()
+        else:
+            raise HTTPException(status_code=response.status, detail="Error listing files")
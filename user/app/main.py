@@ -1,13 +1,27 @@
 from fastapi import FastAPI
 import os
+import asyncio
 import uvicorn
 from app.controllers import file_operations, name_mappings, chunk_operations
+from app.utils.leader_utils import watch_topology
+from app.utils.http_client import close_session
+from app.utils import metrics
 
 app = FastAPI()
+app.middleware("http")(metrics.trace_requests)
 
 app.include_router(file_operations.router)
 app.include_router(name_mappings.router)
 app.include_router(chunk_operations.router)
+app.include_router(metrics.router)
+
+@app.on_event("startup")
+async def startup_event():
+    asyncio.create_task(watch_topology())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_session()
 
 # Run the user FastAPI app on the specified port
 if __name__ == "__main__":
@@ -0,0 +1,318 @@
+import os
+import shutil
+import struct
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+CHUNK_CACHE_BYTES = int(os.getenv("CHUNK_CACHE_BYTES", 256 * 1024 * 1024))
+# Optional second tier on local disk, chunks evicted from memory are kept there
+CHUNK_CACHE_DISK_DIR = os.getenv("CHUNK_CACHE_DISK_DIR")
+CHUNK_CACHE_DISK_BYTES = int(os.getenv("CHUNK_CACHE_DISK_BYTES", 4 * 1024 * 1024 * 1024))
+CHUNK_CACHE_DISK_SEGMENT_BYTES = int(os.getenv("CHUNK_CACHE_DISK_SEGMENT_BYTES", 64 * 1024 * 1024))
+# Evicted chunks waiting to be written to disk, further evictions are dropped while it is full
+DISK_WRITE_BUFFER_BYTES = 64 * 1024 * 1024
+
+# digest, data length
+RECORD_HEADER = struct.Struct(">16sI")
+
+# Result of a shared fetch whose request was cancelled
+ABANDONED = object()
+
+
+def _consume_exception(future):
+    if not future.cancelled():
+        future.exception()
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# Chunks are immutable and named by the MD5 of their content, so cached data never needs
+# invalidation. Concurrent readers of the same missing chunk share a single fetch.
+# The disk tier appends evicted chunks to segment files and finds them through an in-memory
+# index of hash -> (segment, offset, length). Whole segments are dropped oldest first. Disk
+# I/O runs in worker threads, the index is only touched on the event loop.
+class ChunkCache:
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0, disk_segment_bytes=CHUNK_CACHE_DISK_SEGMENT_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        # Dropping the oldest segment frees at most an eighth of the tier
+        self.disk_segment_bytes = max(min(disk_segment_bytes, disk_max_bytes // 8), 1)
+        self.disk_entries = {}
+        # segment -> [size, hashes written to it], oldest first
+        self.segments = OrderedDict()
+        self.disk_size = 0
+        self.disk_pending = OrderedDict()
+        self.disk_pending_size = 0
+        self.disk_writer = None
+        self.inflight = {}
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "disk_hits": 0,
+            "disk_evictions": 0,
+            "disk_dropped": 0,
+            "shared_fetches": 0,
+        }
+        if disk_dir:
+            self._load_disk()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.disk_dir, f"{segment:010d}.seg")
+
+    def _load_disk(self):
+        # Runs once at startup, before the event loop serves requests
+        os.makedirs(self.disk_dir, exist_ok=True)
+        for name in sorted(os.listdir(self.disk_dir)):
+            path = os.path.join(self.disk_dir, name)
+            if len(name) == 2 and os.path.isdir(path):
+                # One file per chunk directory of older versions
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            if not name.endswith(".seg"):
+                continue
+            segment = int(name[:-len(".seg")])
+            hashes = []
+            offset = 0
+            with open(path, "r+b") as f:
+                file_size = os.fstat(f.fileno()).st_size
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    digest, length = RECORD_HEADER.unpack(header)
+                    end = offset + RECORD_HEADER.size + length
+                    if end > file_size:
+                        break
+                    self.disk_entries[digest.hex()] = (segment, offset, length)
+                    hashes.append(digest.hex())
+                    offset = end
+                    f.seek(offset)
+                # A record cut short by a crash is dropped
+                f.truncate(offset)
+            self.segments[segment] = [offset, hashes]
+            self.disk_size += offset
+        _remove_files(self._drop_segments())
+
+    def get(self, chunk_hash):
+        # Memory only, get_many looks up the disk tier
+        data = self.entries.get(chunk_hash)
+        if data is not None:
+            self.entries.move_to_end(chunk_hash)
+        else:
+            data = self.disk_pending.get(chunk_hash)
+            if data is None:
+                return None
+            self._put_memory(chunk_hash, data)
+        self.stats["hits"] += 1
+        return data
+
+    def put(self, chunk_hash, data):
+        if chunk_hash not in self.entries:
+            self._put_memory(chunk_hash, data)
+
+    def _put_memory(self, chunk_hash, data):
+        if len(data) > self.max_bytes:
+            return
+        self.entries[chunk_hash] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            evicted_hash, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.stats["evictions"] += 1
+            if self.disk_dir:
+                self._queue_disk_write(evicted_hash, evicted)
+
+    def _queue_disk_write(self, chunk_hash, data):
+        if chunk_hash in self.disk_entries or chunk_hash in self.disk_pending:
+            return
+        if self.disk_pending_size + len(data) > DISK_WRITE_BUFFER_BYTES:
+            self.stats["disk_dropped"] += 1
+            return
+        self.disk_pending[chunk_hash] = data
+        self.disk_pending_size += len(data)
+        if self.disk_writer is None:
+            self.disk_writer = asyncio.get_running_loop().create_task(self._flush_disk())
+
+    async def _flush_disk(self):
+        try:
+            while self.disk_pending:
+                if not self.segments or next(reversed(self.segments.values()))[0] >= self.disk_segment_bytes:
+                    segment = next(reversed(self.segments)) + 1 if self.segments else 0
+                    self.segments[segment] = [0, []]
+                segment = next(reversed(self.segments))
+                room = self.disk_segment_bytes - self.segments[segment][0]
+                batch = []
+                for chunk_hash, data in self.disk_pending.items():
+                    batch.append((chunk_hash, data))
+                    room -= RECORD_HEADER.size + len(data)
+                    if room <= 0:
+                        break
+                try:
+                    written = await asyncio.to_thread(self._append_segment, segment, batch)
+                except OSError as e:
+                    print(f"Error writing {len(batch)} chunks to the disk cache: {e}")
+                    written = []
+                for chunk_hash, data in batch:
+                    if self.disk_pending.pop(chunk_hash, None) is not None:
+                        self.disk_pending_size -= len(data)
+                for chunk_hash, offset, length in written:
+                    self.disk_entries[chunk_hash] = (segment, offset, length)
+                    self.segments[segment][1].append(chunk_hash)
+                if written:
+                    end = written[-1][1] + RECORD_HEADER.size + written[-1][2]
+                    self.disk_size += end - self.segments[segment][0]
+                    self.segments[segment][0] = end
+                removed = self._drop_segments()
+                if removed:
+                    await asyncio.to_thread(_remove_files, removed)
+        finally:
+            self.disk_writer = None
+
+    def _append_segment(self, segment, batch):
+        written = []
+        with open(self._segment_path(segment), "ab") as f:
+            offset = f.tell()
+            for chunk_hash, data in batch:
+                f.write(RECORD_HEADER.pack(bytes.fromhex(chunk_hash), len(data)))
+                f.write(data)
+                written.append((chunk_hash, offset, len(data)))
+                offset += RECORD_HEADER.size + len(data)
+        return written
+
+    def _drop_segments(self):
+        # Unindexes the oldest segments until the tier fits, returns the files to remove. The
+        # segment being written to is kept.
+        removed = []
+        while self.disk_size > self.disk_max_bytes and len(self.segments) > 1:
+            segment, (size, hashes) = self.segments.popitem(last=False)
+            self.disk_size -= size
+            for chunk_hash in hashes:
+                location = self.disk_entries.get(chunk_hash)
+                if location is not None and location[0] == segment:
+                    del self.disk_entries[chunk_hash]
+                    self.stats["disk_evictions"] += 1
+            removed.append(self._segment_path(segment))
+        return removed
+
+    async def _read_disk(self, chunk_hashes):
+        locations = {chunk_hash: self.disk_entries[chunk_hash] for chunk_hash in chunk_hashes if chunk_hash in self.disk_entries}
+        if not locations:
+            return {}
+        chunks = await asyncio.to_thread(self._read_segments, locations)
+        for chunk_hash, location in locations.items():
+            if chunk_hash in chunks:
+                self.stats["disk_hits"] += 1
+            elif self.disk_entries.get(chunk_hash) == location:
+                # Corrupt, or its segment was dropped while it was read
+                del self.disk_entries[chunk_hash]
+        return chunks
+
+    def _read_segments(self, locations):
+        chunks = {}
+        by_segment = {}
+        for chunk_hash, (segment, offset, length) in locations.items():
+            by_segment.setdefault(segment, []).append((chunk_hash, offset, length))
+        for segment, records in by_segment.items():
+            try:
+                fd = os.open(self._segment_path(segment), os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                for chunk_hash, offset, length in records:
+                    record = os.pread(fd, RECORD_HEADER.size + length, offset)
+                    data = record[RECORD_HEADER.size:]
+                    if record[:16] == bytes.fromhex(chunk_hash) and hashlib.md5(data).hexdigest() == chunk_hash:
+                        chunks[chunk_hash] = data
+            except OSError as e:
+                print(f"Error reading segment {segment} of the disk cache: {e}")
+            finally:
+                os.close(fd)
+        return chunks
+
+    async def get_many(self, chunk_hashes, fetch):
+        # fetch(missing_hashes) must return a dict of hash -> data for the chunks it found
+        found = {}
+        missing = []
+        waiting = {}
+        for chunk_hash in dict.fromkeys(chunk_hashes):
+            data = self.get(chunk_hash)
+            if data is not None:
+                found[chunk_hash] = data
+            elif chunk_hash in self.inflight:
+                waiting[chunk_hash] = self.inflight[chunk_hash]
+                self.stats["misses"] += 1
+                self.stats["shared_fetches"] += 1
+            else:
+                missing.append(chunk_hash)
+
+        if missing:
+            loop = asyncio.get_running_loop()
+            futures = {chunk_hash: loop.create_future() for chunk_hash in missing}
+            self.inflight.update(futures)
+            try:
+                fetched = await self._read_disk(missing)
+                remote = [chunk_hash for chunk_hash in missing if chunk_hash not in fetched]
+                self.stats["misses"] += len(remote)
+                if remote:
+                    fetched.update(await fetch(remote))
+                for chunk_hash, future in futures.items():
+                    data = fetched.get(chunk_hash)
+                    if data is not None:
+                        self.put(chunk_hash, data)
+                        found[chunk_hash] = data
+                    future.set_result(data)
+            except BaseException as e:
+                for future in futures.values():
+                    if future.done():
+                        continue
+                    if isinstance(e, asyncio.CancelledError):
+                        # Only this request was cancelled, the requests waiting for it fetch the chunks themselves
+                        future.set_result(ABANDONED)
+                    else:
+                        future.set_exception(e)
+                        future.add_done_callback(_consume_exception)
+                raise
+            finally:
+                for chunk_hash in missing:
+                    self.inflight.pop(chunk_hash, None)
+
+        retry = []
+        for chunk_hash, future in waiting.items():
+            # Shielded, a cancelled waiter must not cancel the fetch other requests share
+            data = await asyncio.shield(future)
+            if data is ABANDONED:
+                retry.append(chunk_hash)
+            elif data is not None:
+                found[chunk_hash] = data
+        if retry:
+            found.update(await self.get_many(retry, fetch))
+        return found
+
+    def get_stats(self):
+        lookups = self.stats["hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": (self.stats["hits"] + self.stats["disk_hits"]) / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "disk_entries": len(self.disk_entries),
+            "disk_segments": len(self.segments),
+            "disk_bytes": self.disk_size,
+            "disk_pending_bytes": self.disk_pending_size,
+            "disk_max_bytes": self.disk_max_bytes if self.disk_dir else 0,
+        }
+
+
+chunk_cache = ChunkCache(CHUNK_CACHE_BYTES, CHUNK_CACHE_DISK_DIR, CHUNK_CACHE_DISK_BYTES)
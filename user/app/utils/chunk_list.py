@@ -0,0 +1,30 @@
+DIGEST_SIZE = 16
+
+
+# Chunk list of a file as packed 16-byte MD5 digests, the format of the leader's binary
+# metadata endpoint. Hex hashes are only decoded for the entries that are accessed.
+class ChunkList:
+    def __init__(self, digests):
+        if len(digests) % DIGEST_SIZE:
+            raise ValueError("Chunk digests must be a multiple of 16 bytes")
+        self.digests = digests
+
+    def __len__(self):
+        return len(self.digests) // DIGEST_SIZE
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("ChunkList slices must be contiguous")
+            return ChunkList(self.digests[start * DIGEST_SIZE:max(start, stop) * DIGEST_SIZE])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ChunkList index out of range")
+        return self.digests[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE].hex()
+
+    def __iter__(self):
+        digests = self.digests
+        for offset in range(0, len(digests), DIGEST_SIZE):
+            yield digests[offset:offset + DIGEST_SIZE].hex()
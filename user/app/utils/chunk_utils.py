@@ -1,38 +1,245 @@
 import hashlib
-import bisect
+import os
+import time
+import zlib
+import struct
+import asyncio
+import aiohttp
+from collections import defaultdict
 from fastapi import HTTPException
+from app.utils.framing import decode_frames, decode_encoded_frames
+from app.utils.compression import parse_dictionaries, load_dictionaries, decode_chunks, record_received
+from app.utils.hash_ring import HashRing
+from app.utils.replica_latency import latency_tracker
+from app.utils.metrics import span
+
+CHUNK_SIZE = 1024
+READ_BATCH_SIZE = int(os.getenv("READ_BATCH_SIZE", 500))
+READ_CONCURRENCY = int(os.getenv("READ_CONCURRENCY", 8))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 5000))
+WRITE_CONCURRENCY = int(os.getenv("WRITE_CONCURRENCY", 8))
+# Limits for a single request to a chunk server when reading
+READ_TIMEOUT = float(os.getenv("READ_TIMEOUT", 10))  # Seconds
+READ_CONNECT_TIMEOUT = float(os.getenv("READ_CONNECT_TIMEOUT", 2))  # Seconds
+read_timeout = aiohttp.ClientTimeout(total=READ_TIMEOUT, connect=READ_CONNECT_TIMEOUT)
 
 def hash_chunk(chunk):
     return hashlib.md5(chunk).hexdigest()
 
 def get_chunk_server_positions(chunk_hash, chunk_servers):
-    position = int(hashlib.md5(chunk_hash.encode('utf-8')).hexdigest(), 16)
-    idx = bisect.bisect([int(server['position']) for server in chunk_servers], int(position))
-    servers = []
-    for i in range(len(chunk_servers)):
-        server = chunk_servers[(idx + i) % len(chunk_servers)]
-        if server['fail_count'] == 0:
-            servers.append(server)
-        if len(servers) == 3:
-            break
-    return servers
+    # Prefer passing a HashRing, building one per call is only meant for one-off lookups
+    ring = chunk_servers if isinstance(chunk_servers, HashRing) else HashRing(chunk_servers)
+    return ring.place(chunk_hash)
 
 async def fetch_chunk_with_retries(session, chunk_servers, chunk_hash):
-    for server in chunk_servers[:3]:
+    for server in latency_tracker.order(chunk_servers[:3]):
+        started = time.monotonic()
         try:
             url = f"{server['url']}/get_chunk"
-            async with session.get(url, params={"chunk_hash": chunk_hash}) as response:
+            async with session.get(url, params={"chunk_hash": chunk_hash}, timeout=read_timeout) as response:
                 if response.status == 200:
-                    return await response.read()
+                    data = await response.read()
+                    latency_tracker.record(server['url'], time.monotonic() - started)
+                    return data
         except Exception:
+            latency_tracker.record(server['url'], READ_TIMEOUT, ok=False)
             continue
     raise HTTPException(status_code=404, detail=f"Chunk {chunk_hash} not found on any server")
 
-async def delete_chunks_from_servers(session, chunk_servers, chunk_hashes):
-    for chunk_hash in chunk_hashes:
-        servers = get_chunk_server_positions(chunk_hash[0], chunk_servers)
+async def fetch_chunk_batch(session, server, chunk_hashes):
+    # Chunks are requested as stored on the server and decompressed here, servers that
+    # do not know the chunk encoding answer with plain frames. Failures are recorded as
+    # taking the whole timeout, abandoned requests with the time they ran.
+    started = time.monotonic()
+    failed = False
+    try:
+        url = f"{server['url']}/get_chunks/"
+        headers = {"X-Accept-Chunk-Encoding": "deflate"}
+        async with session.post(url, json={"chunks": chunk_hashes}, headers=headers, timeout=read_timeout) as response:
+            if response.status != 200:
+                failed = True
+                return {}
+            payload = await response.read()
+            encoding = response.headers.get("X-Chunk-Encoding")
+            dictionary_ids = parse_dictionaries(response.headers.get("X-Chunk-Dictionaries"))
+        if encoding == "deflate":
+            server_dictionaries = await load_dictionaries(session, server['url'], dictionary_ids)
+            frames = list(decode_encoded_frames(payload))
+            with span("decompress"):
+                chunks = await asyncio.to_thread(decode_chunks, frames, server_dictionaries)
+        else:
+            chunks = dict(decode_frames(payload))
+        record_received(chunks, len(payload))
+        return chunks
+    except (aiohttp.ClientError, asyncio.TimeoutError, HTTPException):
+        failed = True
+    except (zlib.error, ValueError, struct.error, KeyError) as e:
+        # A corrupt or truncated payload counts as a failed batch, the chunks are read from another replica
+        print(f"Invalid chunk data from {server['url']}: {e!r}")
+        failed = True
+    finally:
+        latency_tracker.record(server['url'], READ_TIMEOUT if failed else time.monotonic() - started, ok=not failed)
+    return {}
+
+async def fetch_chunk_batch_hedged(session, replicas, chunk_hashes):
+    # replicas maps every chunk to its replicas in preference order, the batch goes to the
+    # first one they share. If it is slower than usual for that server, each chunk is also
+    # requested from its next replica and whichever copy arrives first is used.
+    server = replicas[chunk_hashes[0]][0]
+    started = time.monotonic()
+    primary = asyncio.ensure_future(fetch_chunk_batch(session, server, chunk_hashes))
+    delay = latency_tracker.hedge_delay(server['url'], READ_TIMEOUT)
+    if delay is not None:
+        try:
+            await asyncio.wait({primary}, timeout=delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+    alternates = defaultdict(list)
+    servers_by_url = {}
+    # Without a delay (hedging disabled or too few samples yet) the batch is never hedged
+    if delay is not None and not primary.done() and latency_tracker.may_hedge():
+        for chunk_hash in chunk_hashes:
+            if len(replicas[chunk_hash]) > 1:
+                alternate = replicas[chunk_hash][1]
+                servers_by_url[alternate['url']] = alternate
+                alternates[alternate['url']].append(chunk_hash)
+    if not alternates:
+        chunks = await primary
+        elapsed = time.monotonic() - started
+        latency_tracker.record_fetch(elapsed, elapsed, False, False)
+        return chunks
+
+    pending = {primary} | {
+        asyncio.ensure_future(fetch_chunk_batch(session, servers_by_url[url], hashes)) for url, hashes in alternates.items()
+    }
+    chunks = {}
+    primary_elapsed = None
+    try:
+        while pending and len(chunks) < len(chunk_hashes):
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                chunks.update(task.result())
+                if task is primary:
+                    primary_elapsed = time.monotonic() - started
+    finally:
+        for task in pending:
+            task.cancel()
+    elapsed = time.monotonic() - started
+    latency_tracker.record_fetch(elapsed, primary_elapsed or elapsed, True, primary_elapsed is None)
+    return chunks
+
+async def fetch_chunks(session, ring, chunk_hashes):
+    # Group chunks by their preferred replica, missing ones are retried on the others
+    unique_hashes = list(dict.fromkeys(chunk_hashes))
+    # Chunks on the same arc of the ring share their replica list, order each list only once
+    ordered = {}
+    replicas = {}
+    for chunk_hash, servers in zip(unique_hashes, ring.place_many(unique_hashes)):
+        if id(servers) not in ordered:
+            ordered[id(servers)] = latency_tracker.order(servers)
+        replicas[chunk_hash] = ordered[id(servers)]
+    server_hashes = defaultdict(list)
+    for chunk_hash, servers in replicas.items():
+        if servers:
+            server_hashes[servers[0]['url']].append(chunk_hash)
+
+    semaphore = asyncio.Semaphore(READ_CONCURRENCY)
+
+    async def fetch_batch(batch):
+        async with semaphore:
+            return await fetch_chunk_batch_hedged(session, replicas, batch)
+
+    async def fetch_fallback(chunk_hash):
+        async with semaphore:
+            return chunk_hash, await fetch_chunk_with_retries(session, replicas[chunk_hash][1:], chunk_hash)
+
+    batches = [
+        fetch_batch(hashes[i:i + READ_BATCH_SIZE])
+        for url, hashes in server_hashes.items()
+        for i in range(0, len(hashes), READ_BATCH_SIZE)
+    ]
+    chunks = {}
+    for result in await asyncio.gather(*batches):
+        chunks.update(result)
+
+    missing = [chunk_hash for chunk_hash in replicas if chunk_hash not in chunks]
+    chunks.update(await asyncio.gather(*(fetch_fallback(chunk_hash) for chunk_hash in missing)))
+    return chunks
+
+def group_chunks_by_server(ring, chunk_hashes):
+    server_hashes = defaultdict(list)
+    unique_hashes = list(dict.fromkeys(chunk_hashes))
+    for chunk_hash, servers in zip(unique_hashes, ring.place_many(unique_hashes)):
         for server in servers:
-            url = f"{server['url']}/delete_chunks/"
-            async with session.post(url, json={"chunks": [chunk_hash[0]]}) as response:
-                if response.status != 200:
-                    raise HTTPException(status_code=response.status, detail=f"Failed to delete chunk {chunk_hash[0]} on server {server['url']}")
+            server_hashes[server['url']].append(chunk_hash)
+    return server_hashes
+
+async def post_chunk_batches(session, server_hashes, endpoint):
+    # Sends every server its hashes in large concurrent batches. Returns the hashes each server
+    # acknowledged and the error for each server that failed, so callers can act per server.
+    semaphore = asyncio.Semaphore(WRITE_CONCURRENCY)
+    succeeded = defaultdict(list)
+    failed = {}
+
+    async def post_batch(server_url, batch):
+        async with semaphore:
+            try:
+                async with session.post(f"{server_url}/{endpoint}/", json={"chunks": batch}) as response:
+                    if response.status != 200:
+                        raise Exception(f"status code: {response.status}")
+                succeeded[server_url].extend(batch)
+            except Exception as e:
+                failed[server_url] = f"Failed to {endpoint.replace('_', ' ')} on server {server_url}: {e}"
+
+    await asyncio.gather(*(
+        post_batch(server_url, hashes[i:i + WRITE_BATCH_SIZE])
+        for server_url, hashes in server_hashes.items()
+        for i in range(0, len(hashes), WRITE_BATCH_SIZE)
+    ))
+    return dict(succeeded), failed
+
+async def post_transaction(session, server_url, transaction, endpoint):
+    async with session.post(f"{server_url}/{endpoint}/", params={"transaction": transaction}) as response:
+        if response.status != 200:
+            raise Exception(f"status code: {response.status}")
+
+async def finalize_chunks_on_servers(session, server_hashes, transactions=None):
+    # Servers holding the upload as a transaction commit it with one request, the others
+    # finalize the chunks by hash. Returns the servers that finalized and the error of each server
+    # that failed. Their chunks are not returned: another upload may have committed the same chunks,
+    # so a rollback must not delete them by hash.
+    transactions = transactions or {}
+    finalized, failed = await post_chunk_batches(
+        session, {url: hashes for url, hashes in server_hashes.items() if url not in transactions}, "finalize_chunks"
+    )
+    succeeded = [url for url in finalized if url not in failed]
+
+    async def commit(server_url, transaction):
+        try:
+            await post_transaction(session, server_url, transaction, "commit_transaction")
+            succeeded.append(server_url)
+        except Exception as e:
+            failed[server_url] = f"Failed to commit transaction on server {server_url}: {e}"
+
+    await asyncio.gather(*(commit(server_url, transaction) for server_url, transaction in transactions.items()))
+    return succeeded, failed
+
+async def abort_transactions_on_servers(session, transactions):
+    # Best effort, servers drop transactions that are never committed after PENDING_TTL anyway
+    async def abort(server_url, transaction):
+        try:
+            await post_transaction(session, server_url, transaction, "abort_transaction")
+        except Exception as e:
+            print(f"Failed to abort transaction on server {server_url}: {e}")
+
+    await asyncio.gather(*(abort(server_url, transaction) for server_url, transaction in transactions.items()))
+
+async def delete_chunks_on_servers(session, server_hashes):
+    return await post_chunk_batches(session, server_hashes, "delete_chunks")
+
+async def delete_chunks_from_servers(session, ring, chunk_hashes):
+    server_hashes = group_chunks_by_server(ring, chunk_hashes)
+    succeeded, failed = await delete_chunks_on_servers(session, server_hashes)
+    if failed:
+        raise HTTPException(status_code=500, detail="; ".join(failed.values()))
@@ -0,0 +1,109 @@
+import os
+import hashlib
+
+# "fixed" splits at CHUNK_SIZE offsets, "gear" uses content-defined boundaries so that an
+# insertion only changes the chunks around it and later versions of a file share chunks
+CHUNKER = os.getenv("CHUNKER", "fixed")
+CDC_MIN_SIZE = int(os.getenv("CDC_MIN_SIZE", 256))
+CDC_AVG_SIZE = int(os.getenv("CDC_AVG_SIZE", 1024))
+CDC_MAX_SIZE = int(os.getenv("CDC_MAX_SIZE", 4096))
+
+# Derived from MD5 so every user instance cuts the same boundaries
+GEAR = [int.from_bytes(hashlib.md5(bytes([i])).digest()[:8], "big") for i in range(256)]
+HASH_MASK = (1 << 64) - 1
+
+
+def top_bits_mask(bits):
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+# Both chunkers take the upload as a stream of blocks: feed() returns the chunks completed
+# by a block and finish() the rest. Chunk lengths only need to be stored for variable chunks.
+class FixedChunker:
+    variable = False
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.remainder = b""
+
+    def feed(self, block):
+        data = self.remainder + block if self.remainder else block
+        usable = len(data) - len(data) % self.chunk_size
+        self.remainder = data[usable:]
+        return [data[offset:offset + self.chunk_size] for offset in range(0, usable, self.chunk_size)]
+
+    def finish(self):
+        chunks = [self.remainder] if self.remainder else []
+        self.remainder = b""
+        return chunks
+
+
+# FastCDC: a Gear rolling hash with normalized chunking. Below the average size a stricter
+# mask is used and above it a looser one, which keeps chunk sizes close to the average.
+# The first min_size bytes of a chunk are never hashed for a boundary.
+class GearChunker:
+    variable = True
+
+    def __init__(self, min_size, avg_size, max_size):
+        if not 0 < min_size <= avg_size <= max_size:
+            raise ValueError("CDC sizes must satisfy 0 < min <= avg <= max")
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = max(avg_size.bit_length() - 1, 2)
+        self.mask_small = top_bits_mask(bits + 2)
+        self.mask_large = top_bits_mask(bits - 2)
+        self.buffer = b""
+
+    def find_boundary(self, data, final):
+        # Returns the length of the first chunk of data, None if more data is needed to decide
+        length = len(data)
+        if length <= self.min_size:
+            return length if final and length else None
+        end = min(length, self.max_size)
+        normal = min(end, self.avg_size)
+        gear = GEAR
+        h = 0
+        mask = self.mask_small
+        for i in range(self.min_size, normal):
+            h = ((h << 1) + gear[data[i]]) & HASH_MASK
+            if not h & mask:
+                return i + 1
+        mask = self.mask_large
+        for i in range(max(normal, self.min_size), end):
+            h = ((h << 1) + gear[data[i]]) & HASH_MASK
+            if not h & mask:
+                return i + 1
+        if end == self.max_size or final:
+            return end
+        return None
+
+    def feed(self, block):
+        data = self.buffer + block if self.buffer else block
+        chunks = []
+        offset = 0
+        while (size := self.find_boundary(data[offset:offset + self.max_size], False)) is not None:
+            chunks.append(data[offset:offset + size])
+            offset += size
+        self.buffer = data[offset:]
+        return chunks
+
+    def finish(self):
+        chunks = []
+        data = self.buffer
+        offset = 0
+        while offset < len(data):
+            size = self.find_boundary(data[offset:offset + self.max_size], True)
+            chunks.append(data[offset:offset + size])
+            offset += size
+        self.buffer = b""
+        return chunks
+
+
+def create_chunker(chunk_size, kind=None):
+    kind = kind or CHUNKER
+    if kind == "fixed":
+        return FixedChunker(chunk_size)
+    if kind == "gear":
+        return GearChunker(CDC_MIN_SIZE, CDC_AVG_SIZE, CDC_MAX_SIZE)
+    raise ValueError(f"Unknown chunker: {kind}")
@@ -0,0 +1,84 @@
+import os
+import zlib
+import hashlib
+from fastapi import HTTPException
+
+# Compress upload batches on the wire, servers that do not accept it get them uncompressed
+TRANSFER_COMPRESSION = os.getenv("TRANSFER_COMPRESSION", "deflate") == "deflate"
+TRANSFER_COMPRESSION_LEVEL = int(os.getenv("TRANSFER_COMPRESSION_LEVEL", 1))
+
+# Must match the chunk servers: raw deflate streams, flags 1 for plain deflate and
+# FLAG_DICTIONARY + n - 1 for deflate with dictionary n of the sending server
+FLAG_RAW = 0
+FLAG_DEFLATE = 1
+FLAG_DICTIONARY = 2
+WINDOW_BITS = 13
+
+# Dictionaries are immutable and named by their MD5, so they are shared by every server that
+# trained the same one and never need invalidation
+dictionaries = {}
+stats = {
+    "chunks_received": 0,
+    "chunks_received_encoded": 0,
+    "bytes_received": 0,
+    "bytes_decoded": 0,
+}
+
+
+def parse_dictionaries(header):
+    # "1:md5,2:md5" -> {1: md5, 2: md5}
+    result = {}
+    for item in filter(None, (header or "").split(",")):
+        number, _, dictionary_id = item.partition(":")
+        result[int(number)] = dictionary_id
+    return result
+
+
+async def load_dictionaries(session, server_url, dictionary_ids):
+    # Returns {number: dictionary} for one server, fetching the dictionaries not seen yet
+    result = {}
+    for number, dictionary_id in dictionary_ids.items():
+        if dictionary_id not in dictionaries:
+            async with session.get(f"{server_url}/dictionaries/{number}") as response:
+                if response.status != 200:
+                    raise HTTPException(status_code=502, detail=f"Failed to get dictionary {number} from {server_url}")
+                dictionary = await response.read()
+            if hashlib.md5(dictionary).hexdigest() != dictionary_id:
+                raise HTTPException(status_code=502, detail=f"Dictionary {number} from {server_url} does not match")
+            dictionaries[dictionary_id] = dictionary
+        result[number] = dictionaries[dictionary_id]
+    return result
+
+
+def decompress_chunk(flags, payload, server_dictionaries):
+    if flags == FLAG_RAW:
+        return payload
+    if flags == FLAG_DEFLATE:
+        decompressor = zlib.decompressobj(-WINDOW_BITS)
+    else:
+        decompressor = zlib.decompressobj(-WINDOW_BITS, zdict=server_dictionaries[flags - FLAG_DICTIONARY + 1])
+    return decompressor.decompress(payload) + decompressor.flush()
+
+
+def decode_chunks(frames, server_dictionaries):
+    # frames are (chunk_hash, flags, payload), returns {chunk_hash: data}
+    chunks = {}
+    for chunk_hash, flags, payload in frames:
+        chunks[chunk_hash] = decompress_chunk(flags, payload, server_dictionaries)
+        stats["chunks_received_encoded"] += flags != FLAG_RAW
+    return chunks
+
+
+def record_received(chunks, received_bytes):
+    stats["chunks_received"] += len(chunks)
+    stats["bytes_received"] += received_bytes
+    stats["bytes_decoded"] += sum(map(len, chunks.values()))
+
+
+def get_stats():
+    return {
+        **stats,
+        "transfer_compression": TRANSFER_COMPRESSION,
+        "dictionaries": len(dictionaries),
+        "transfer_ratio": stats["bytes_decoded"] / stats["bytes_received"] if stats["bytes_received"] else 1.0,
+    }
@@ -0,0 +1,41 @@
+import os
+import aiohttp
+from app.utils.metrics import TRACE_HEADER, trace_id
+
+# One keep-alive connection pool per process, shared by every call to the leader and the chunk servers
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 256))
+HTTP_POOL_SIZE_PER_HOST = int(os.getenv("HTTP_POOL_SIZE_PER_HOST", 64))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30))  # Seconds
+# Defaults for a single request, calls with their own limits pass a timeout
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 60))  # Seconds
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))  # Seconds
+
+session = None
+
+
+async def add_trace_header(session, context, params):
+    # Requests made while handling a request carry its trace ID
+    current = trace_id()
+    if current is not None:
+        params.headers[TRACE_HEADER] = current
+
+
+def get_session():
+    # Created on first use, a session must be created inside the running event loop
+    global session
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE, limit_per_host=HTTP_POOL_SIZE_PER_HOST, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+        )
+        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(add_trace_header)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[trace_config])
+    return session
+
+
+async def close_session():
+    global session
+    if session is not None:
+        await session.close()
+        session = None
@@ -1,9 +1,183 @@
-import requests
 import os
+import asyncio
+import itertools
+import aiohttp
+from contextlib import asynccontextmanager
 from fastapi import HTTPException
+from app.utils.hash_ring import HashRing
+from app.utils.chunk_list import ChunkList
+from app.utils.http_client import get_session
+from app.utils.metrics import span
 
-def get_leader_chunk_servers():
-    response = requests.get(f"{os.getenv('LEADER_URL')}/chunk_servers/")
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail="Error getting chunk servers")
-    return response.json()
+TOPOLOGY_POLL_TIMEOUT = int(os.getenv("TOPOLOGY_POLL_TIMEOUT", 30))  # Seconds
+TOPOLOGY_RETRY_INTERVAL = 5  # Seconds
+# Pause of the watcher after a follower answered with an older topology than the cached one
+TOPOLOGY_STALE_INTERVAL = 1  # Seconds
+# Leader followers that serve the metadata reads, in turn. Writes always go to LEADER_URL.
+LEADER_READ_URLS = [url.strip() for url in os.getenv("LEADER_READ_URLS", "").split(",") if url.strip()]
+
+read_urls = itertools.cycle(LEADER_READ_URLS)
+
+
+@asynccontextmanager
+async def read_from_leader(session, path, **kwargs):
+    # GET from the next follower. The primary answers instead when the follower is unreachable,
+    # further behind than its staleness bound (503), or has not applied the file yet (404).
+    if LEADER_READ_URLS:
+        url = next(read_urls)
+        response = None
+        try:
+            response = await session.get(f"{url}{path}", **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Leader follower {url} unavailable, reading from the primary: {e}")
+        if response is not None:
+            if response.status not in (404, 503):
+                try:
+                    yield response
+                finally:
+                    response.release()
+                return
+            response.release()
+    async with session.get(f"{os.getenv('LEADER_URL')}{path}", **kwargs) as response:
+        yield response
+
+
+# A snapshot of the chunk servers together with the hash ring built from it
+class Topology:
+    def __init__(self, version, chunk_servers):
+        self.version = version
+        self.chunk_servers = chunk_servers
+        self.ring = HashRing(chunk_servers)
+
+
+topology = None
+topology_lock = None
+
+async def refresh_topology(session, wait=0):
+    # Sends the cached version as ETag, the leader answers 304 while nothing changed
+    global topology
+    headers = {}
+    if topology is not None and topology.version is not None:
+        headers["If-None-Match"] = f'"{topology.version}"'
+    timeout = aiohttp.ClientTimeout(total=wait + 10)
+    async with read_from_leader(session, "/chunk_servers/", params={"wait": wait}, headers=headers, timeout=timeout) as response:
+        if response.status == 304:
+            return topology
+        if response.status != 200:
+            raise HTTPException(status_code=response.status, detail="Error getting chunk servers")
+        version = response.headers.get("X-Topology-Version")
+        # A follower that is behind must not replace a newer ring
+        if not is_older(version, topology):
+            topology = Topology(version, await response.json())
+            return topology
+    # It answers at once, so the watcher waits a little before asking again
+    if wait > 0:
+        await asyncio.sleep(TOPOLOGY_STALE_INTERVAL)
+    return topology
+
+def is_older(version, current):
+    if version is None or current is None or current.version is None:
+        return False
+    return int(version) < int(current.version)
+
+async def get_topology():
+    global topology_lock
+    if topology is None:
+        with span("topology"):
+            if topology_lock is None:
+                topology_lock = asyncio.Lock()
+            async with topology_lock:
+                if topology is None:
+                    await refresh_topology(get_session())
+    return topology
+
+async def watch_topology():
+    # Long-polls the leader so the cached topology is replaced as soon as it changes
+    session = get_session()
+    while True:
+        try:
+            current = await refresh_topology(session, wait=TOPOLOGY_POLL_TIMEOUT)
+            if current.version is None:
+                # The leader does not version its topology, fall back to plain polling
+                await asyncio.sleep(TOPOLOGY_POLL_TIMEOUT)
+        except Exception as e:
+            print(f"Error refreshing chunk server topology: {e}")
+            await asyncio.sleep(TOPOLOGY_RETRY_INTERVAL)
+
+
+async def get_chunk_list(session, full_path):
+    # Returns the file's chunks as a lazily decoded ChunkList and its size in bytes
+    with span("leader_lookup"):
+        async with read_from_leader(session, f"/namemappings_binary/{full_path}") as response:
+            if response.status != 200:
+                raise HTTPException(status_code=response.status, detail="Error fetching file info")
+            return ChunkList(await response.read()), int(response.headers["X-File-Size"])
+
+
+# Chunks covering the bytes [start, end) of a file. The first one is chunk number first_chunk
+# and starts at byte first_offset.
+class ChunkRange:
+    def __init__(self, chunk_hashes, file_size, start, end, first_chunk, first_offset):
+        self.chunk_hashes = chunk_hashes
+        self.file_size = file_size
+        self.start = start
+        self.end = end
+        self.first_chunk = first_chunk
+        self.first_offset = first_offset
+
+
+def range_not_satisfiable(file_size):
+    return HTTPException(
+        status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{file_size}"}
+    )
+
+
+async def get_chunk_range(session, full_path, offset, length, chunk_size):
+    # The leader resolves the range against the file size and returns only the covering chunks
+    params = {"chunk_size": chunk_size}
+    if offset is not None:
+        params["offset"] = offset
+    if length is not None:
+        params["length"] = length
+    with span("leader_lookup"):
+        async with read_from_leader(session, f"/namemappings_binary/{full_path}", params=params) as response:
+            if response.status == 416:
+                raise range_not_satisfiable(response.headers["X-File-Size"])
+            if response.status != 200:
+                raise HTTPException(status_code=response.status, detail="Error fetching file info")
+            return ChunkRange(
+                ChunkList(await response.read()),
+                int(response.headers["X-File-Size"]),
+                int(response.headers["X-Range-Start"]),
+                int(response.headers["X-Range-End"]),
+                int(response.headers["X-First-Chunk"]),
+                int(response.headers["X-First-Chunk-Offset"])
+            )
+
+
+async def find_missing_chunks(session, chunk_hashes):
+    # Returns the hashes of the chunks no stored file references, only those need to be uploaded
+    data = b"".join(bytes.fromhex(chunk_hash) for chunk_hash in chunk_hashes)
+    headers = {"Content-Type": "application/octet-stream"}
+    async with session.post(f"{os.getenv('LEADER_URL')}/chunks/missing/", data=data, headers=headers) as response:
+        if response.status != 200:
+            raise HTTPException(status_code=response.status, detail="Error checking for existing chunks")
+        return set(ChunkList(await response.read()))
+
+
+async def confirm_chunk_deletes(session, chunk_hashes):
+    # Lifts the leader's tombstones of chunks the servers deleted, uploads of them stop waiting
+    data = b"".join(bytes.fromhex(chunk_hash) for chunk_hash in chunk_hashes)
+    headers = {"Content-Type": "application/octet-stream"}
+    async with session.post(f"{os.getenv('LEADER_URL')}/chunks/deleted/", data=data, headers=headers) as response:
+        if response.status != 200:
+            raise HTTPException(status_code=response.status, detail="Error confirming deleted chunks")
+
+
+async def delete_file_mapping(session, full_path):
+    # Deletes the name mapping and returns the chunks no other file references
+    with span("leader_delete"):
+        async with session.delete(f"{os.getenv('LEADER_URL')}/namemappings_binary/{full_path}") as response:
+            if response.status != 200:
+                raise HTTPException(status_code=response.status, detail="Error deleting name mapping")
+            return ChunkList(await response.read())
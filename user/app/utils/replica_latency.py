@@ -0,0 +1,137 @@
+import os
+import time
+from collections import deque
+from app.utils.metrics import Counter, Histogram
+
+# Weight of the newest sample in a server's moving average
+LATENCY_EWMA_ALPHA = float(os.getenv("LATENCY_EWMA_ALPHA", 0.2))
+# Recent samples kept per server for percentiles
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", 1024))
+# A replica further down the ring is only preferred when the closer one is this many times slower,
+# so comparable servers keep serving their own ranges and the load stays spread
+LATENCY_TOLERANCE = float(os.getenv("LATENCY_TOLERANCE", 1.5))
+# A server avoided for being slow gets no new samples, after this long it is tried again
+LATENCY_EXPIRY = float(os.getenv("LATENCY_EXPIRY", 30))  # Seconds
+# A request slower than this percentile of its server's recent latency gets a hedged request to
+# another replica, 0 disables hedging. The delay is kept within HEDGE_MIN_DELAY and the timeout.
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 0.01))  # Seconds
+HEDGE_MIN_SAMPLES = 20
+# At most this share of batch requests is hedged, plus a small burst, so hedges cannot pile
+# extra load onto servers that are slow because they are busy
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", 0.05))
+HEDGE_BURST = 10
+# Percentiles are recomputed after this many new samples rather than on every request
+PERCENTILE_REFRESH = 32
+
+
+fetch_latency = Histogram("chunk_server_fetch_duration_seconds", "Time per chunk request to a chunk server", ("server",))
+fetch_errors = Counter("chunk_server_fetch_errors_total", "Failed chunk requests per chunk server", ("server",))
+
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * p / 100))]
+
+
+class ServerLatency:
+    def __init__(self):
+        self.ewma = None
+        self.samples = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.errors = 0
+        self.hedge_delay = None
+        self.updated_at = 0.0
+
+    def record(self, elapsed, ok=True):
+        self.updated_at = time.monotonic()
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        self.ewma = elapsed if self.ewma is None else self.ewma + LATENCY_EWMA_ALPHA * (elapsed - self.ewma)
+        self.samples.append(elapsed)
+        if len(self.samples) >= HEDGE_MIN_SAMPLES and (self.hedge_delay is None or self.requests % PERCENTILE_REFRESH == 0):
+            self.hedge_delay = max(HEDGE_MIN_DELAY, percentile(sorted(self.samples), HEDGE_PERCENTILE))
+
+
+# Latency of every chunk server as seen from this user instance. Failed and abandoned requests
+# are recorded with the time they took, which pushes slow and broken servers down the order.
+class LatencyTracker:
+    def __init__(self):
+        self.servers = {}
+        self.stats = {"batches": 0, "hedged": 0, "hedge_wins": 0}
+        self.fetch_samples = deque(maxlen=LATENCY_WINDOW)
+        self.primary_samples = deque(maxlen=LATENCY_WINDOW)
+
+    def server(self, url):
+        latency = self.servers.get(url)
+        if latency is None:
+            latency = self.servers[url] = ServerLatency()
+        return latency
+
+    def record(self, url, elapsed, ok=True):
+        self.server(url).record(elapsed, ok)
+        fetch_latency.observe(elapsed, server=url)
+        if not ok:
+            fetch_errors.inc(server=url)
+
+    def ewma(self, url):
+        latency = self.servers.get(url)
+        if latency is None or latency.ewma is None or time.monotonic() - latency.updated_at > LATENCY_EXPIRY:
+            return 0.0
+        return latency.ewma
+
+    def order(self, replicas):
+        # The closest replica stays first unless another one is clearly faster, the others follow
+        # fastest first. Servers without samples yet count as fast so they get measured.
+        if len(replicas) < 2:
+            return replicas
+        ewmas = [self.ewma(server['url']) for server in replicas]
+        rest = sorted(range(1, len(replicas)), key=ewmas.__getitem__)
+        if ewmas[0] > ewmas[rest[0]] * LATENCY_TOLERANCE:
+            return [replicas[rest[0]], replicas[0]] + [replicas[i] for i in rest[1:]]
+        return [replicas[0]] + [replicas[i] for i in rest]
+
+    def hedge_delay(self, url, timeout):
+        # None until the server has enough samples to tell what slow means for it
+        if HEDGE_PERCENTILE <= 0:
+            return None
+        delay = self.server(url).hedge_delay
+        return min(delay, timeout) if delay is not None else None
+
+    def may_hedge(self):
+        return self.stats["hedged"] < HEDGE_BUDGET * self.stats["batches"] + HEDGE_BURST
+
+    def record_fetch(self, elapsed, primary_elapsed, hedged, hedge_won):
+        # elapsed is what the caller waited, primary_elapsed what the first choice took or had
+        # taken when it was abandoned, so the difference in the tail is what hedging saved
+        self.stats["batches"] += 1
+        self.stats["hedged"] += hedged
+        self.stats["hedge_wins"] += hedge_won
+        self.fetch_samples.append(elapsed)
+        self.primary_samples.append(primary_elapsed)
+
+    def get_stats(self):
+        fetches = sorted(self.fetch_samples)
+        primaries = sorted(self.primary_samples)
+        return {
+            **self.stats,
+            "hedge_rate": self.stats["hedged"] / self.stats["batches"] if self.stats["batches"] else 0.0,
+            "fetch_latency": {f"p{p}": percentile(fetches, p) for p in (50, 95, 99)},
+            # A lower bound for abandoned requests, so the improvement is understated
+            "primary_latency": {f"p{p}": percentile(primaries, p) for p in (50, 95, 99)},
+            "servers": {
+                url: {
+                    "ewma": latency.ewma,
+                    "requests": latency.requests,
+                    "errors": latency.errors,
+                    "hedge_delay": latency.hedge_delay,
+                    **{f"p{p}": percentile(sorted(latency.samples), p) for p in (50, 95, 99)},
+                }
+                for url, latency in self.servers.items()
+            },
+        }
+
+
+latency_tracker = LatencyTracker()
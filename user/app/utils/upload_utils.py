@@ -0,0 +1,252 @@
+import os
+import uuid
+import struct
+import zlib
+import asyncio
+from fastapi import HTTPException
+from multipart.multipart import MultipartParser, parse_options_header
+from multipart.exceptions import MultipartParseError
+from app.utils.chunk_utils import hash_chunk, abort_transactions_on_servers
+from app.utils.hash_ring import chunk_position
+from app.utils.framing import encode_frame
+from app.utils.leader_utils import find_missing_chunks
+from app.utils.compression import TRANSFER_COMPRESSION, TRANSFER_COMPRESSION_LEVEL
+
+READ_BLOCK_SIZE = int(os.getenv("UPLOAD_READ_BLOCK_SIZE", 64 * 1024))
+UPLOAD_QUEUE_SIZE = int(os.getenv("UPLOAD_QUEUE_SIZE", 4))
+# Chunks per existence check on the leader
+DEDUP_BATCH_SIZE = int(os.getenv("DEDUP_BATCH_SIZE", 1024))
+MAX_FORM_FIELD_SIZE = 64 * 1024
+
+
+# Splits a multipart/form-data upload while it arrives. The data of the "file" part is yielded
+# in blocks of READ_BLOCK_SIZE and the other parts are kept as form fields. Unlike Starlette's
+# form parsing, the file is never spooled to a temporary file.
+class MultipartUpload:
+    def __init__(self, request):
+        self.request = request
+        self.fields = {}
+        self.has_file = False
+        self.buffer = bytearray()
+        self.header_name = b""
+        self.header_value = b""
+        self.disposition = b""
+        self.part_name = None
+        self.part_is_file = False
+        self.part_data = bytearray()
+
+    def on_part_begin(self):
+        self.disposition = b""
+        self.part_data = bytearray()
+
+    def on_header_field(self, data, start, end):
+        self.header_name += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        if self.header_name.lower() == b"content-disposition":
+            self.disposition = self.header_value
+        self.header_name = b""
+        self.header_value = b""
+
+    def on_headers_finished(self):
+        disposition, options = parse_options_header(self.disposition)
+        if b"name" not in options:
+            raise HTTPException(status_code=400, detail='The Content-Disposition of every part needs a "name"')
+        self.part_name = options[b"name"].decode("utf-8", "replace")
+        self.part_is_file = self.part_name == "file"
+        if self.part_is_file:
+            if self.has_file:
+                raise HTTPException(status_code=400, detail="Only one file can be uploaded per request")
+            self.has_file = True
+
+    def on_part_data(self, data, start, end):
+        if self.part_is_file:
+            self.buffer += data[start:end]
+        else:
+            self.part_data += data[start:end]
+            if len(self.part_data) > MAX_FORM_FIELD_SIZE:
+                raise HTTPException(status_code=400, detail=f"Form field {self.part_name} is too large")
+
+    def on_part_end(self):
+        if not self.part_is_file:
+            self.fields[self.part_name] = self.part_data.decode("utf-8", "replace")
+
+    async def blocks(self):
+        content_type, params = parse_options_header(self.request.headers.get("Content-Type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+        parser = MultipartParser(params[b"boundary"], {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        })
+        try:
+            async for data in self.request.stream():
+                parser.write(data)
+                while len(self.buffer) >= READ_BLOCK_SIZE:
+                    block = bytes(self.buffer[:READ_BLOCK_SIZE])
+                    del self.buffer[:READ_BLOCK_SIZE]
+                    yield block
+            parser.finalize()
+        except MultipartParseError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid multipart body: {e}")
+        if self.buffer:
+            block = bytes(self.buffer)
+            self.buffer = bytearray()
+            yield block
+
+
+# Buffers chunks for one chunk server and sends them in batches from its own task.
+# The queue is bounded, so a slow server makes the producer wait instead of growing memory.
+# The batches are grouped on the server under the upload's transaction, unless it is an
+# older server that does not confirm the transaction and finalizes by chunk hash.
+class ServerUploader:
+    def __init__(self, session, server_url, batch_size, transaction):
+        self.session = session
+        self.server_url = server_url
+        self.batch_size = batch_size
+        self.transaction = transaction
+        self.transactional = False
+        self.queue = asyncio.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+        self.frames = []
+        # Hashes of the chunks sent, only kept until the server confirms the transaction.
+        # Older servers are finalized by hash and need all of them.
+        self.chunk_hashes = {}
+        self.error = None
+        self.compress = TRANSFER_COMPRESSION
+        self.task = asyncio.create_task(self._run())
+
+    async def add(self, chunk_hash, chunk):
+        if self.chunk_hashes is not None:
+            if chunk_hash in self.chunk_hashes:
+                # Repeated blocks within a file only need to be sent once
+                return
+            self.chunk_hashes[chunk_hash] = None
+            if self.transactional:
+                # The transaction is committed as a whole, and the server skips chunks it already
+                # holds for it, so the hashes are not needed anymore
+                self.chunk_hashes = None
+        self.frames.append(encode_frame(chunk_hash, chunk))
+        if len(self.frames) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if self.error:
+            raise self.error
+        if self.frames:
+            data = b"".join(self.frames)
+            self.frames = []
+            await self.queue.put(data)
+
+    async def close(self):
+        await self.flush()
+        await self.queue.put(None)
+        await self.task
+        if self.error:
+            raise self.error
+        if self.chunk_hashes is None and not self.transactional:
+            raise Exception(f"Chunk server {self.server_url} stopped confirming the upload transaction")
+
+    def cancel(self):
+        self.task.cancel()
+
+    async def _run(self):
+        url = f"{self.server_url}/store_chunks_pending_raw/"
+        params = {"transaction": self.transaction}
+        headers = {"Content-Type": "application/octet-stream"}
+        while (data := await self.queue.get()) is not None:
+            if self.error:
+                # Keep draining so the producer never blocks on a dead server
+                continue
+            try:
+                status = None
+                if self.compress:
+                    body = await asyncio.to_thread(zlib.compress, data, TRANSFER_COMPRESSION_LEVEL)
+                    async with self.session.post(url, params=params, data=body, headers={**headers, "Content-Encoding": "deflate"}) as response:
+                        status = response.status
+                        self.transactional = response.headers.get("X-Upload-Transaction") == self.transaction
+                    if status in (400, 415):
+                        # Older servers reject compressed bodies, send this and later batches as they are
+                        self.compress = False
+                if status is None or not self.compress:
+                    async with self.session.post(url, params=params, data=data, headers=headers) as response:
+                        status = response.status
+                        self.transactional = response.headers.get("X-Upload-Transaction") == self.transaction
+                if status != 200:
+                    raise Exception(f"Failed to store chunks on server {self.server_url}, status code: {status}")
+            except Exception as e:
+                self.error = e
+
+
+async def stream_chunks_to_servers(session, blocks, ring, chunker, batch_size):
+    # Reads, chunks, hashes and routes the upload while the per-server senders are already
+    # transmitting, so at most a few batches per server are held in memory. The leader is asked
+    # which chunks of each group already exist, and only the missing ones are sent. The check of
+    # one group runs while the next one is being read.
+    transaction = uuid.uuid4().hex
+    uploaders = {}
+    chunk_digests = bytearray()
+    chunk_lengths = bytearray()
+    file_size = 0
+    group = {}
+    lookup = None
+
+    async def send(group, missing):
+        for chunk_hash in await missing:
+            chunk, position = group[chunk_hash]
+            for server in ring.place_position(position):
+                uploader = uploaders.get(server['url'])
+                if uploader is None:
+                    uploader = uploaders[server['url']] = ServerUploader(session, server['url'], batch_size, transaction)
+                await uploader.add(chunk_hash, chunk)
+
+    async def flush():
+        nonlocal group, lookup
+        previous = lookup
+        lookup = (group, asyncio.ensure_future(find_missing_chunks(session, group))) if group else None
+        group = {}
+        if previous:
+            await send(*previous)
+
+    async def route(chunk):
+        chunk_hash = hash_chunk(chunk)
+        chunk_digests.extend(bytes.fromhex(chunk_hash))
+        chunk_lengths.extend(struct.pack(">I", len(chunk)))
+        group[chunk_hash] = (chunk, chunk_position(chunk_hash))
+        if len(group) >= DEDUP_BATCH_SIZE:
+            await flush()
+
+    try:
+        async for block in blocks:
+            file_size += len(block)
+            # Content-defined chunking hashes every byte, keep it off the event loop
+            chunks = await asyncio.to_thread(chunker.feed, block) if chunker.variable else chunker.feed(block)
+            for chunk in chunks:
+                await route(chunk)
+        for chunk in chunker.finish():
+            await route(chunk)
+        # Check the last group, then send it
+        await flush()
+        await flush()
+        await asyncio.gather(*(uploader.close() for uploader in uploaders.values()))
+    except BaseException:
+        if lookup:
+            lookup[1].cancel()
+        for uploader in uploaders.values():
+            uploader.cancel()
+        # Release what was stored so far now instead of when it expires
+        asyncio.ensure_future(abort_transactions_on_servers(session, {url: transaction for url in uploaders}))
+        raise
+
+    # Only servers without transactions are finalized by hash
+    server_hashes = {url: list(uploader.chunk_hashes) for url, uploader in uploaders.items() if not uploader.transactional}
+    transactions = {url: transaction for url, uploader in uploaders.items() if uploader.transactional}
+    # Fixed-size chunks need no lengths, they follow from the chunk size
+    return bytes(chunk_digests), bytes(chunk_lengths) if chunker.variable else None, file_size, server_hashes, transactions
@@ -0,0 +1,83 @@
+# Compares fixed-size and content-defined chunking on a synthetic versioned document:
+# every version is the previous one with a few lines inserted, removed or edited.
+# Run from the user directory: python -m benchmarks.chunking [versions] [document KB]
+import sys
+import time
+import random
+from app.utils.chunk_utils import CHUNK_SIZE, hash_chunk
+from app.utils.chunkers import FixedChunker, GearChunker, CDC_MIN_SIZE, CDC_AVG_SIZE, CDC_MAX_SIZE
+
+WORDS = (
+    "chunk server leader replica hash ring upload read delete version pending finalize metadata "
+    "request response cluster node storage segment index cache latency throughput the a of to and "
+    "is in for with on that by this be are from as it at or"
+).split()
+FEED_BLOCK_SIZE = 64 * 1024
+
+
+def make_line(rng):
+    if rng.random() < 0.1:
+        return "## " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).title()
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 18))) + "."
+
+
+def make_versions(count, size_kb, seed=1):
+    rng = random.Random(seed)
+    lines = []
+    while sum(len(line) + 1 for line in lines) < size_kb * 1024:
+        lines.append(make_line(rng))
+    versions = ["\n".join(lines).encode("utf-8")]
+    for _ in range(count - 1):
+        for _ in range(rng.randint(1, 5)):
+            position = rng.randrange(len(lines))
+            edit = rng.random()
+            if edit < 0.4:
+                lines.insert(position, make_line(rng))
+            elif edit < 0.7 and len(lines) > 1:
+                del lines[position]
+            else:
+                lines[position] = make_line(rng)
+        versions.append("\n".join(lines).encode("utf-8"))
+    return versions
+
+
+def chunk(chunker, data):
+    chunks = []
+    for offset in range(0, len(data), FEED_BLOCK_SIZE):
+        chunks += chunker.feed(data[offset:offset + FEED_BLOCK_SIZE])
+    return chunks + chunker.finish()
+
+
+def measure(label, make_chunker, versions):
+    total_bytes = sum(len(data) for data in versions)
+    unique = {}
+    chunk_count = 0
+    started = time.perf_counter()
+    for data in versions:
+        chunks = chunk(make_chunker(), data)
+        chunk_count += len(chunks)
+        for piece in chunks:
+            unique[hash_chunk(piece)] = len(piece)
+    elapsed = time.perf_counter() - started
+    stored = sum(unique.values())
+    print(
+        f"{label:<28} {total_bytes / elapsed / 1e6:8.2f} MB/s {total_bytes / chunk_count:9.0f} B avg chunk "
+        f"{total_bytes / stored:8.2f}x dedup {stored / 1024:10.0f} KB stored"
+    )
+
+
+def main():
+    version_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    size_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    versions = make_versions(version_count, size_kb)
+    print(f"{version_count} versions of a {size_kb} KB document, {sum(map(len, versions)) / 1024:.0f} KB in total")
+    measure(f"fixed {CHUNK_SIZE}", lambda: FixedChunker(CHUNK_SIZE), versions)
+    measure(
+        f"gear {CDC_MIN_SIZE}/{CDC_AVG_SIZE}/{CDC_MAX_SIZE}",
+        lambda: GearChunker(CDC_MIN_SIZE, CDC_AVG_SIZE, CDC_MAX_SIZE),
+        versions
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Compares chunk placement through HashRing with the per-chunk lookup it replaced.
+# Run from the user directory: python -m benchmarks.hash_ring [servers] [chunks]
+import sys
+import time
+import bisect
+import hashlib
+from app.utils.hash_ring import HashRing
+
+
+def legacy_get_chunk_server_positions(chunk_hash, chunk_servers):
+    position = int(hashlib.md5(chunk_hash.encode('utf-8')).hexdigest(), 16)
+    idx = bisect.bisect([int(server['position']) for server in chunk_servers], int(position))
+    servers = []
+    for i in range(len(chunk_servers)):
+        server = chunk_servers[(idx + i) % len(chunk_servers)]
+        if server['fail_count'] == 0:
+            servers.append(server)
+        if len(servers) == 3:
+            break
+    return servers
+
+
+def make_servers(count):
+    servers = []
+    for i in range(count):
+        url = f"http://chunk-server-{i}:8100"
+        position = str(int(hashlib.md5(url.encode('utf-8')).hexdigest(), 16))
+        servers.append({"url": url, "position": position, "fail_count": 0})
+    servers.sort(key=lambda server: int(server['position']))
+    return servers
+
+
+def measure(label, func, chunk_count):
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<32} {elapsed * 1000:10.1f} ms {chunk_count / elapsed:14,.0f} chunks/s")
+    return elapsed
+
+
+def main():
+    server_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    chunk_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    servers = make_servers(server_count)
+    chunk_hashes = [hashlib.md5(str(i).encode()).hexdigest() for i in range(chunk_count)]
+    print(f"{server_count} servers, {chunk_count} chunks")
+
+    legacy = measure("legacy per-chunk lookup", lambda: [legacy_get_chunk_server_positions(h, servers) for h in chunk_hashes], chunk_count)
+    ring = None
+
+    def build_and_place():
+        nonlocal ring
+        ring = HashRing(servers)
+        ring.place_many(chunk_hashes)
+
+    current = measure("HashRing build + place_many", build_and_place, chunk_count)
+    measure("HashRing place (per chunk)", lambda: [ring.place(h) for h in chunk_hashes], chunk_count)
+    measure("HashRing with 64 vnodes", lambda: HashRing(servers, vnodes=64).place_many(chunk_hashes), chunk_count)
+    print(f"speedup: {legacy / current:.1f}x")
+
+    mismatches = sum(
+        [s['url'] for s in legacy_get_chunk_server_positions(h, servers)] != [s['url'] for s in ring.place(h)]
+        for h in chunk_hashes[:1000]
+    )
+    print(f"placement mismatches against legacy (first 1000 chunks): {mismatches}")
+
+
+if __name__ == "__main__":
+    main()